@@ -1,5 +1,4 @@
-from common.numpy_fast import mean
-from common.kalman.simple_kalman import KF1D
+import numpy as np
 from selfdrive.config import RADAR_TO_CAMERA
 
 
@@ -14,123 +13,145 @@ SPEED, ACCEL = 0, 1   # Kalman filter states enum
 v_ego_stationary = 4.   # no stationary object flag below this speed
 
 
-class Track():
-  def __init__(self, v_lead, kalman_params):
-    self.cnt = 0
-    self.aLeadTau = _LEAD_ACCEL_TAU
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
-
-  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
-    self.vLead = v_lead
-    self.measured = measured   # measured or estimate
+class Tracks():
+  """Radar tracks, sorted by track id, as arrays with an element per track.
+  The speed and acceleration of every track are estimated with the same constant gain Kalman filter as KF1D,
+  stepped for all the tracks at once.
+  """
+  def __init__(self, kalman_params):
+    A, C, K = kalman_params.A, kalman_params.C, kalman_params.K
+    self.K0, self.K1 = K[0][0], K[1][0]
+    self.A_K = [[A[0][0] - self.K0 * C[0], A[0][1] - self.K0 * C[1]],
+                [A[1][0] - self.K1 * C[0], A[1][1] - self.K1 * C[1]]]
+
+    self.ids = np.array([], dtype=np.int64)
+    self.dRel = np.array([])   # LONG_DIST
+    self.yRel = np.array([])   # -LAT_DIST
+    self.vRel = np.array([])   # REL_SPEED
+    self.vLead = np.array([])
+    self.measured = np.array([], dtype=bool)   # measured or estimate
+    self.cnt = np.array([], dtype=np.int64)
+    self.x = np.zeros((0, 2))   # Kalman filter states
+    self.vLeadK = np.array([])
+    self.aLeadK = np.array([])
+    self.aLeadTau = np.array([])
+
+  def __len__(self):
+    return len(self.ids)
+
+  def update(self, ids, d_rel, y_rel, v_rel, v_lead, measured):
+    """Updates the tracks with the radar points of the given sorted and unique `ids`. Tracks with no point are
+    removed and points with a new id start a track.
+    """
+    # Carry over the state of the tracks still reported.
+    prev_idxs = np.minimum(np.searchsorted(self.ids, ids), max(len(self.ids) - 1, 0))
+    kept = np.zeros(len(ids), dtype=bool) if len(self.ids) == 0 else self.ids[prev_idxs] == ids
+    prev_idxs = prev_idxs[kept]
+
+    cnt = np.zeros(len(ids), dtype=np.int64)
+    cnt[kept] = self.cnt[prev_idxs]
+    a_lead_tau = np.full(len(ids), _LEAD_ACCEL_TAU)
+    a_lead_tau[kept] = self.aLeadTau[prev_idxs]
+    x = np.column_stack((v_lead, np.zeros(len(ids))))
+    x[kept] = self.x[prev_idxs]
+
+    self.ids = ids
+    self.dRel, self.yRel, self.vRel, self.vLead, self.measured = d_rel, y_rel, v_rel, v_lead, measured
 
     # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
-
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
+    upd = cnt > 0
+    x0, x1, meas = x[upd, SPEED], x[upd, ACCEL], v_lead[upd]
+    x[upd, SPEED] = self.A_K[0][0] * x0 + self.A_K[0][1] * x1 + self.K0 * meas
+    x[upd, ACCEL] = self.A_K[1][0] * x0 + self.A_K[1][1] * x1 + self.K1 * meas
+    self.x = x
+    self.vLeadK = x[:, SPEED].copy()
+    self.aLeadK = x[:, ACCEL].copy()
 
     # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau *= 0.9
+    self.aLeadTau = np.where(np.abs(self.aLeadK) < 0.5, _LEAD_ACCEL_TAU, a_lead_tau * 0.9)
 
-    self.cnt += 1
+    self.cnt = cnt + 1
 
-  def get_key_for_cluster(self):
+  def keys_for_cluster(self):
     # Weigh y higher since radar is inaccurate in this dimension
-    return [self.dRel, self.yRel*2, self.vRel]
-
-  def reset_a_lead(self, aLeadK, aLeadTau):
-    self.kf = KF1D([[self.vLead], [aLeadK]], self.K_A, self.K_C, self.K_K)
-    self.aLeadK = aLeadK
-    self.aLeadTau = aLeadTau
+    return np.column_stack((self.dRel, self.yRel * 2, self.vRel))
+
+  def reset_a_lead(self, mask, aLeadK, aLeadTau):
+    self.x[mask, SPEED] = self.vLead[mask]
+    self.x[mask, ACCEL] = aLeadK
+    self.aLeadK[mask] = aLeadK
+    self.aLeadTau[mask] = aLeadTau
+
+
+class Clusters():
+  """The clusters of the tracks, as arrays with the mean values of the tracks of every cluster. These are computed
+  once for all the clusters when created.
+  """
+  def __init__(self, tracks, cluster_idxs):
+    count = int(np.max(cluster_idxs)) + 1 if len(cluster_idxs) > 0 else 0
+
+    # Sum the values of the tracks of every cluster at once, with a (clusters, tracks) one hot matrix.
+    # Acceleration is only learned after the second update of a track.
+    learned = tracks.cnt > 1
+    one_hot = (cluster_idxs == np.arange(count)[:, np.newaxis]).astype(float)
+    sums = one_hot @ np.column_stack((tracks.dRel, tracks.yRel, tracks.vRel, tracks.vLead, tracks.vLeadK,
+                                      np.where(learned, tracks.aLeadK, 0.), np.where(learned, tracks.aLeadTau, 0.),
+                                      tracks.measured, learned, np.ones(len(learned))))
+    n, n_learned = sums[:, 9], sums[:, 8]
+
+    self.dRel, self.yRel, self.vRel, self.vLead, self.vLeadK = sums[:, :5].T / n
+    self.measured = sums[:, 7] > 0
+    self.aLeadK = np.where(n_learned > 0, sums[:, 5] / np.maximum(n_learned, 1), 0.)
+    self.aLeadTau = np.where(n_learned > 0, sums[:, 6] / np.maximum(n_learned, 1), _LEAD_ACCEL_TAU)
+
+  def __len__(self):
+    return len(self.dRel)
+
+  def __getitem__(self, idx):
+    return Cluster(float(self.dRel[idx]), float(self.yRel[idx]), float(self.vRel[idx]), float(self.vLead[idx]),
+                   float(self.vLeadK[idx]), float(self.aLeadK[idx]), float(self.aLeadTau[idx]),
+                   bool(self.measured[idx]))
+
+  def __iter__(self):
+    return (self[idx] for idx in range(len(self)))
+
+  def potential_low_speed_leads(self, v_ego):
+    # stop for stuff in front of you and low speed, even without model confirmation
+    if v_ego >= v_ego_stationary:
+      return np.zeros(len(self), dtype=bool)
+    return (np.abs(self.yRel) < 1.5) & (self.dRel < 25)
 
 
 class Cluster():
-  def __init__(self):
-    self.tracks = set()
-
-  def add(self, t):
-    # add the first track
-    self.tracks.add(t)
-
-  # TODO: make generic
-  @property
-  def dRel(self):
-    return mean([t.dRel for t in self.tracks])
-
-  @property
-  def yRel(self):
-    return mean([t.yRel for t in self.tracks])
-
-  @property
-  def vRel(self):
-    return mean([t.vRel for t in self.tracks])
-
-  @property
-  def aRel(self):
-    return mean([t.aRel for t in self.tracks])
-
-  @property
-  def vLead(self):
-    return mean([t.vLead for t in self.tracks])
-
-  @property
-  def dPath(self):
-    return mean([t.dPath for t in self.tracks])
-
-  @property
-  def vLat(self):
-    return mean([t.vLat for t in self.tracks])
-
-  @property
-  def vLeadK(self):
-    return mean([t.vLeadK for t in self.tracks])
-
-  @property
-  def aLeadK(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return 0.
-    else:
-      return mean([t.aLeadK for t in self.tracks if t.cnt > 1])
-
-  @property
-  def aLeadTau(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return _LEAD_ACCEL_TAU
-    else:
-      return mean([t.aLeadTau for t in self.tracks if t.cnt > 1])
-
-  @property
-  def measured(self):
-    return any(t.measured for t in self.tracks)
+  """A single cluster of `Clusters`, with the mean values of its tracks.
+  """
+  def __init__(self, dRel, yRel, vRel, vLead, vLeadK, aLeadK, aLeadTau, measured):
+    self.dRel = dRel
+    self.yRel = yRel
+    self.vRel = vRel
+    self.vLead = vLead
+    self.vLeadK = vLeadK
+    self.aLeadK = aLeadK
+    self.aLeadTau = aLeadTau
+    self.measured = measured
 
   def get_RadarState(self, model_prob=0.0):
     return {
-      "dRel": float(self.dRel),
-      "yRel": float(self.yRel),
-      "vRel": float(self.vRel),
-      "vLead": float(self.vLead),
-      "vLeadK": float(self.vLeadK),
-      "aLeadK": float(self.aLeadK),
+      "dRel": self.dRel,
+      "yRel": self.yRel,
+      "vRel": self.vRel,
+      "vLead": self.vLead,
+      "vLeadK": self.vLeadK,
+      "aLeadK": self.aLeadK,
       "status": True,
       "fcw": self.is_potential_fcw(model_prob),
       "modelProb": model_prob,
       "radar": True,
-      "aLeadTau": float(self.aLeadTau)
+      "aLeadTau": self.aLeadTau
     }
 
-  def get_RadarState_from_vision(self, lead_msg, v_ego):
+  @staticmethod
+  def get_RadarState_from_vision(lead_msg, v_ego):
     return {
       "dRel": float(lead_msg.x[0] - RADAR_TO_CAMERA),
       "yRel": float(-lead_msg.y[0]),
@@ -149,9 +170,5 @@ class Cluster():
     ret = f"x: {self.dRel:4.1f}  y: {self.yRel:4.1f}  v: {self.vRel:4.1f}  a: {self.aLeadK:4.1f}"
     return ret
 
-  def potential_low_speed_lead(self, v_ego):
-    # stop for stuff in front of you and low speed, even without model confirmation
-    return abs(self.yRel) < 1.5 and (v_ego < v_ego_stationary) and self.dRel < 25
-
   def is_potential_fcw(self, model_prob):
     return model_prob > .9
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import importlib
-import math
-from collections import defaultdict, deque
+from collections import deque
+
+import numpy as np
 
 import cereal.messaging as messaging
 from cereal import car
@@ -10,7 +11,7 @@ from common.params import Params
 from common.realtime import Ratekeeper, Priority, config_realtime_process
 from selfdrive.config import RADAR_TO_CAMERA
 from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid
-from selfdrive.controls.lib.radar_helpers import Cluster, Track
+from selfdrive.controls.lib.radar_helpers import Cluster, Clusters, Tracks
 from selfdrive.swaglog import cloudlog
 from selfdrive.hardware import TICI, JETSON
 
@@ -38,65 +39,68 @@ class KalmanParams():
 
 
 def laplacian_cdf(x, mu, b):
-  b = max(b, 1e-4)
-  return math.exp(-abs(x-mu)/b)
-
+  b = np.maximum(b, 1e-4)
+  return np.exp(-np.abs(x-mu)/b)
 
-def match_vision_to_cluster(v_ego, lead, clusters):
-  # match vision point to best statistical cluster match
-  offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
 
-  def prob(c):
-    prob_d = laplacian_cdf(c.dRel, offset_vision_dist, lead.xStd[0])
-    prob_y = laplacian_cdf(c.yRel, -lead.y[0], lead.yStd[0])
-    prob_v = laplacian_cdf(c.vRel + v_ego, lead.v[0], lead.vStd[0])
+def match_vision_to_clusters(v_ego, leads, clusters):
+  # match every vision lead to its best statistical cluster match, all at once as a (leads, clusters) array
+  lead_data = np.array([(lead.x[0], lead.y[0], lead.v[0], lead.xStd[0], lead.yStd[0], lead.vStd[0]) for lead in leads])
+  offset_vision_dist = lead_data[:, 0] - RADAR_TO_CAMERA
+  lead_v = lead_data[:, 2]
+  lead_data = lead_data[:, :, np.newaxis]
 
-    # This is isn't exactly right, but good heuristic
-    return prob_d * prob_y * prob_v
+  prob_d = laplacian_cdf(clusters.dRel, offset_vision_dist[:, np.newaxis], lead_data[:, 3])
+  prob_y = laplacian_cdf(clusters.yRel, -lead_data[:, 1], lead_data[:, 4])
+  prob_v = laplacian_cdf(clusters.vRel + v_ego, lead_data[:, 2], lead_data[:, 5])
 
-  cluster = max(clusters, key=prob)
+  # This is isn't exactly right, but good heuristic
+  idxs = np.argmax(prob_d * prob_y * prob_v, axis=1)
 
-  # if no 'sane' match is found return -1
+  # if no 'sane' match is found return None
   # stationary radar points can be false positives
-  dist_sane = abs(cluster.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(cluster.vRel + v_ego - lead.v[0]) < 10) or (v_ego + cluster.vRel > 3)
-  if dist_sane and vel_sane:
-    return cluster
-  else:
-    return None
+  d_rel, v_rel = clusters.dRel[idxs], clusters.vRel[idxs]
+  dist_sane = np.abs(d_rel - offset_vision_dist) < np.maximum(offset_vision_dist * .25, 5.0)
+  vel_sane = (np.abs(v_rel + v_ego - lead_v) < 10) | (v_ego + v_rel > 3)
+  return [int(idx) if sane else None for idx, sane in zip(idxs, dist_sane & vel_sane)]
 
 
-def get_lead(v_ego, ready, clusters, lead_msg, low_speed_override=True):
+def get_leads(v_ego, ready, clusters, lead_msgs):
   # Determine leads, this is where the essential logic happens
-  if len(clusters) > 0 and ready and lead_msg.prob > .5:
-    cluster = match_vision_to_cluster(v_ego, lead_msg, clusters)
-  else:
-    cluster = None
-
-  lead_dict = {'status': False}
-  if cluster is not None:
-    lead_dict = cluster.get_RadarState(lead_msg.prob)
-  elif (cluster is None) and ready and (lead_msg.prob > .5):
-    lead_dict = Cluster().get_RadarState_from_vision(lead_msg, v_ego)
-
-  if low_speed_override:
-    low_speed_clusters = [c for c in clusters if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_clusters) > 0:
-      closest_cluster = min(low_speed_clusters, key=lambda c: c.dRel)
-
-      # Only choose new cluster if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_cluster.dRel < lead_dict['dRel']):
-        lead_dict = closest_cluster.get_RadarState()
-
-  return lead_dict
+  # Only the first lead can be a close low speed cluster not seen by the model.
+  vision_leads = [i for i, lead_msg in enumerate(lead_msgs) if ready and lead_msg.prob > .5]
+  cluster_idxs = [None] * len(lead_msgs)
+  if len(clusters) > 0 and len(vision_leads) > 0:
+    for i, cluster_idx in zip(vision_leads, match_vision_to_clusters(v_ego, [lead_msgs[i] for i in vision_leads],
+                                                                     clusters)):
+      cluster_idxs[i] = cluster_idx
+
+  lead_dicts = []
+  for i, (lead_msg, cluster_idx) in enumerate(zip(lead_msgs, cluster_idxs)):
+    lead_dict = {'status': False}
+    if cluster_idx is not None:
+      lead_dict = clusters[cluster_idx].get_RadarState(lead_msg.prob)
+    elif i in vision_leads:
+      lead_dict = Cluster.get_RadarState_from_vision(lead_msg, v_ego)
+    lead_dicts.append(lead_dict)
+
+  low_speed_idxs = np.nonzero(clusters.potential_low_speed_leads(v_ego))[0]
+  if len(lead_dicts) > 0 and len(low_speed_idxs) > 0:
+    closest_idx = low_speed_idxs[np.argmin(clusters.dRel[low_speed_idxs])]
+
+    # Only choose new cluster if it is actually closer than the previous one
+    if (not lead_dicts[0]['status']) or (clusters.dRel[closest_idx] < lead_dicts[0]['dRel']):
+      lead_dicts[0] = clusters[closest_idx].get_RadarState()
+
+  return lead_dicts
 
 
 class RadarD():
   def __init__(self, radar_ts, delay=0):
     self.current_time = 0
 
-    self.tracks = defaultdict(dict)
     self.kalman_params = KalmanParams(radar_ts)
+    self.tracks = Tracks(self.kalman_params)
 
     # v_ego
     self.v_ego = 0.
@@ -115,52 +119,29 @@ class RadarD():
 
     ar_pts = {}
     for pt in rr.points:
-      ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
-
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
+      ar_pts[pt.trackId] = (pt.dRel, pt.yRel, pt.vRel, pt.measured)
+    ids = sorted(ar_pts)
+    pts = np.array([ar_pts[iden] for iden in ids], dtype=float).reshape(-1, 4)
 
     # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
-
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
-
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
+    # align v_ego by a fixed time to align it with the radar measurement
+    v_lead = pts[:, 2] + self.v_ego_hist[0]
+    self.tracks.update(np.array(ids, dtype=np.int64), pts[:, 0], pts[:, 1], pts[:, 2], v_lead, pts[:, 3] > 0.)
 
-    idens = list(sorted(self.tracks.keys()))
-    track_pts = [self.tracks[iden].get_key_for_cluster() for iden in idens]
+    track_pts = self.tracks.keys_for_cluster()
 
     # If we have multiple points, cluster them
     if len(track_pts) > 1:
-      cluster_idxs = cluster_points_centroid(track_pts, 2.5)
-      clusters = [None] * (max(cluster_idxs) + 1)
-
-      for idx in range(len(track_pts)):
-        cluster_i = cluster_idxs[idx]
-        if clusters[cluster_i] is None:
-          clusters[cluster_i] = Cluster()
-        clusters[cluster_i].add(self.tracks[idens[idx]])
-    elif len(track_pts) == 1:
-      # FIXME: cluster_point_centroid hangs forever if len(track_pts) == 1
-      cluster_idxs = [0]
-      clusters = [Cluster()]
-      clusters[0].add(self.tracks[idens[0]])
+      cluster_idxs = np.array(cluster_points_centroid(track_pts, 2.5), dtype=np.int64)
     else:
-      clusters = []
+      # FIXME: cluster_point_centroid hangs forever if len(track_pts) == 1
+      cluster_idxs = np.zeros(len(track_pts), dtype=np.int64)
+    clusters = Clusters(self.tracks, cluster_idxs)
 
     # if a new point, reset accel to the rest of the cluster
-    for idx in range(len(track_pts)):
-      if self.tracks[idens[idx]].cnt <= 1:
-        aLeadK = clusters[cluster_idxs[idx]].aLeadK
-        aLeadTau = clusters[cluster_idxs[idx]].aLeadTau
-        self.tracks[idens[idx]].reset_a_lead(aLeadK, aLeadTau)
+    new_tracks = self.tracks.cnt <= 1
+    self.tracks.reset_a_lead(new_tracks, clusters.aLeadK[cluster_idxs[new_tracks]],
+                             clusters.aLeadTau[cluster_idxs[new_tracks]])
 
     # *** publish radarState ***
     dat = messaging.new_message('radarState')
@@ -174,8 +155,7 @@ class RadarD():
     if enable_lead:
       leads_v3 = sm['modelV2'].leadsV3
       if len(leads_v3) > 1:
-        radarState.leadOne = get_lead(self.v_ego, self.ready, clusters, leads_v3[0], low_speed_override=True)
-        radarState.leadTwo = get_lead(self.v_ego, self.ready, clusters, leads_v3[1], low_speed_override=False)
+        radarState.leadOne, radarState.leadTwo = get_leads(self.v_ego, self.ready, clusters, [leads_v3[0], leads_v3[1]])
     return dat
 
 
@@ -226,12 +206,13 @@ def radard_thread(sm=None, pm=None, can_sock=None):
     tracks = RD.tracks
     dat = messaging.new_message('liveTracks', len(tracks))
 
-    for cnt, ids in enumerate(sorted(tracks.keys())):
+    for cnt, (ids, d_rel, y_rel, v_rel) in enumerate(zip(tracks.ids.tolist(), tracks.dRel.tolist(),
+                                                          tracks.yRel.tolist(), tracks.vRel.tolist())):
       dat.liveTracks[cnt] = {
         "trackId": ids,
-        "dRel": float(tracks[ids].dRel),
-        "yRel": float(tracks[ids].yRel),
-        "vRel": float(tracks[ids].vRel),
+        "dRel": d_rel,
+        "yRel": y_rel,
+        "vRel": v_rel,
       }
     pm.send('liveTracks', dat)
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from common.kalman.simple_kalman_old import KF1D
+from common.numpy_fast import mean
+from selfdrive.controls.lib.radar_helpers import _LEAD_ACCEL_TAU, SPEED, ACCEL, Clusters, Tracks
+
+DT = 0.05
+KalmanParams = namedtuple("KalmanParams", ["A", "C", "K"])
+KALMAN_PARAMS = KalmanParams([[1.0, DT], [0.0, 1.0]], [1.0, 0.0], [[0.21372394], [0.28342219]])
+
+
+class RefTrack():
+  # the per object track radard used before Tracks
+  def __init__(self, v_lead):
+    self.cnt = 0
+    self.aLeadTau = _LEAD_ACCEL_TAU
+    self.kf = KF1D(np.array([[v_lead], [0.0]]), np.array(KALMAN_PARAMS.A), np.array(KALMAN_PARAMS.C),
+                   np.array(KALMAN_PARAMS.K))
+
+  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
+    self.dRel, self.yRel, self.vRel, self.vLead, self.measured = d_rel, y_rel, v_rel, v_lead, measured
+    if self.cnt > 0:
+      self.kf.update(self.vLead)
+    self.vLeadK = float(self.kf.x[SPEED][0])
+    self.aLeadK = float(self.kf.x[ACCEL][0])
+    if abs(self.aLeadK) < 0.5:
+      self.aLeadTau = _LEAD_ACCEL_TAU
+    else:
+      self.aLeadTau *= 0.9
+    self.cnt += 1
+
+  def reset_a_lead(self, aLeadK, aLeadTau):
+    self.kf = KF1D(np.array([[self.vLead], [aLeadK]]), np.array(KALMAN_PARAMS.A), np.array(KALMAN_PARAMS.C),
+                   np.array(KALMAN_PARAMS.K))
+    self.aLeadK = aLeadK
+    self.aLeadTau = aLeadTau
+
+
+class RefCluster():
+  # the per object cluster radard used before Clusters
+  def __init__(self):
+    self.tracks = []
+
+  def __getattr__(self, name):
+    if name == "measured":
+      return any(t.measured for t in self.tracks)
+    learned = [t for t in self.tracks if t.cnt > 1]
+    if name == "aLeadK":
+      return mean([t.aLeadK for t in learned]) if len(learned) else 0.
+    if name == "aLeadTau":
+      return mean([t.aLeadTau for t in learned]) if len(learned) else _LEAD_ACCEL_TAU
+    return mean([getattr(t, name) for t in self.tracks])
+
+  def get_RadarState(self, model_prob=0.0):
+    return {
+      "dRel": float(self.dRel),
+      "yRel": float(self.yRel),
+      "vRel": float(self.vRel),
+      "vLead": float(self.vLead),
+      "vLeadK": float(self.vLeadK),
+      "aLeadK": float(self.aLeadK),
+      "status": True,
+      "fcw": model_prob > .9,
+      "modelProb": model_prob,
+      "radar": True,
+      "aLeadTau": float(self.aLeadTau)
+    }
+
+  def potential_low_speed_lead(self, v_ego):
+    return abs(self.yRel) < 1.5 and (v_ego < 4.) and self.dRel < 25
+
+
+class TestRadarHelpers(unittest.TestCase):
+  def setUp(self):
+    self.rng = np.random.default_rng(0)
+    self.tracks = Tracks(KALMAN_PARAMS)
+    self.ref_tracks = {}
+
+  def assertRadarStateEqual(self, state, ref_state):
+    self.assertEqual(state.keys(), ref_state.keys())
+    for k, v in ref_state.items():
+      if isinstance(v, bool):
+        self.assertEqual(state[k], v, k)
+      else:
+        self.assertAlmostEqual(state[k], v, places=9, msg=k)
+
+  def _step(self, ids, v_ego, cluster_idxs=None):
+    n = len(ids)
+    pts = np.column_stack((self.rng.uniform(0., 80., n), self.rng.uniform(-5., 5., n), self.rng.uniform(-10., 5., n),
+                           self.rng.random(n) < 0.7))
+    if cluster_idxs is None:
+      # any contiguous labels will do, the clustering itself is not under test
+      cluster_idxs = np.unique(self.rng.integers(0, max(n // 2, 1), n), return_inverse=True)[1]
+    cluster_idxs = np.asarray(cluster_idxs, dtype=np.int64).reshape(-1)
+    v_lead = pts[:, 2] + v_ego
+
+    # array path, as in RadarD.update
+    self.tracks.update(np.array(ids, dtype=np.int64), pts[:, 0], pts[:, 1], pts[:, 2], v_lead, pts[:, 3] > 0.)
+    clusters = Clusters(self.tracks, cluster_idxs)
+    new_tracks = self.tracks.cnt <= 1
+    self.tracks.reset_a_lead(new_tracks, clusters.aLeadK[cluster_idxs[new_tracks]],
+                             clusters.aLeadTau[cluster_idxs[new_tracks]])
+
+    # per object path
+    for iden in list(self.ref_tracks):
+      if iden not in ids:
+        del self.ref_tracks[iden]
+    for iden, pt, vl in zip(ids, pts, v_lead):
+      if iden not in self.ref_tracks:
+        self.ref_tracks[iden] = RefTrack(vl)
+      self.ref_tracks[iden].update(pt[0], pt[1], pt[2], vl, bool(pt[3]))
+    ref_clusters = [RefCluster() for _ in range(len(clusters))]
+    for iden, cluster_idx in zip(ids, cluster_idxs):
+      ref_clusters[cluster_idx].tracks.append(self.ref_tracks[iden])
+    for iden, cluster_idx in zip(ids, cluster_idxs):
+      t = self.ref_tracks[iden]
+      if t.cnt <= 1:
+        t.reset_a_lead(ref_clusters[cluster_idx].aLeadK, ref_clusters[cluster_idx].aLeadTau)
+
+    self.assertEqual(list(self.tracks.ids), list(ids))
+    self.assertEqual(list(self.tracks.cnt), [self.ref_tracks[iden].cnt for iden in ids])
+    for attr in ("vLeadK", "aLeadK", "aLeadTau"):
+      np.testing.assert_allclose(getattr(self.tracks, attr), [getattr(self.ref_tracks[iden], attr) for iden in ids],
+                                 rtol=1e-9, atol=1e-9, err_msg=attr)
+    np.testing.assert_allclose(self.tracks.x[:, SPEED], [self.ref_tracks[iden].kf.x[SPEED][0] for iden in ids],
+                               rtol=1e-9, atol=1e-9)
+
+    self.assertEqual(len(clusters), len(ref_clusters))
+    for cluster, ref_cluster in zip(clusters, ref_clusters):
+      for model_prob in (0.0, 0.95):
+        self.assertRadarStateEqual(cluster.get_RadarState(model_prob), ref_cluster.get_RadarState(model_prob))
+    for v in (0., v_ego, 10.):
+      self.assertEqual(list(clusters.potential_low_speed_leads(v)),
+                       [c.potential_low_speed_lead(v) for c in ref_clusters])
+    return clusters
+
+  def test_random_points(self):
+    for i in range(300):
+      n = 0 if i % 25 == 10 else self.rng.integers(0, 10)
+      ids = sorted(self.rng.choice(20, size=n, replace=False).tolist())
+      self._step(ids, self.rng.uniform(0., 30.))
+
+  def test_new_and_dropped_tracks(self):
+    # acceleration is learned on the second update of a track
+    for _ in range(3):
+      self._step([1, 2, 3], 20., cluster_idxs=[0, 0, 1])
+    self.assertTrue(np.all(self.tracks.cnt == 3))
+
+    # 1 is dropped, 4 and 5 are new tracks joining a learned cluster and a new cluster
+    clusters = self._step([2, 3, 4, 5], 20., cluster_idxs=[0, 1, 0, 2])
+    self.assertEqual(list(self.tracks.cnt), [4, 4, 1, 1])
+    self.assertAlmostEqual(self.tracks.aLeadK[2], clusters.aLeadK[0])
+    self.assertEqual(self.tracks.aLeadK[3], 0.)
+    self.assertEqual(self.tracks.aLeadTau[3], _LEAD_ACCEL_TAU)
+
+    # a cluster of new tracks only
+    self._step([4, 6, 7], 20., cluster_idxs=[0, 1, 1])
+
+  def test_no_points(self):
+    self._step([1, 2], 2.)
+    clusters = self._step([], 2.)
+    self.assertEqual(len(self.tracks), 0)
+    self.assertEqual(len(clusters), 0)
+    self.assertEqual(list(clusters.potential_low_speed_leads(2.)), [])
+    self.assertEqual(self.tracks.keys_for_cluster().shape, (0, 3))
+
+    # tracks start over after an empty update
+    self._step([1], 2.)
+    self.assertEqual(list(self.tracks.cnt), [1])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import math
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from selfdrive.config import RADAR_TO_CAMERA
+from selfdrive.controls.lib.radar_helpers import Cluster, Clusters, Tracks
+from selfdrive.controls.radard import KalmanParams, get_leads, laplacian_cdf, match_vision_to_clusters
+
+Lead = namedtuple("Lead", ["x", "y", "v", "xStd", "yStd", "vStd", "prob"])
+
+
+def make_lead(d_rel, y_rel, v_lead, prob=0.9, std=(2., 1., 2.)):
+  # model leads are in the camera frame, with the lateral axis pointing the other way
+  return Lead([d_rel + RADAR_TO_CAMERA], [-y_rel], [v_lead], [std[0]], [std[1]], [std[2]], prob)
+
+
+def make_clusters(pts, v_ego):
+  # one cluster per radar point
+  pts = np.array(pts, dtype=float).reshape(-1, 3)
+  tracks = Tracks(KalmanParams(0.05))
+  tracks.update(np.arange(len(pts), dtype=np.int64), pts[:, 0], pts[:, 1], pts[:, 2], pts[:, 2] + v_ego,
+                np.ones(len(pts), dtype=bool))
+  return Clusters(tracks, np.arange(len(pts), dtype=np.int64))
+
+
+# the scalar lead matching radard used before get_leads
+def ref_match_vision_to_cluster(v_ego, lead, clusters):
+  offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
+
+  def prob(c):
+    b_d, b_y, b_v = (max(b, 1e-4) for b in (lead.xStd[0], lead.yStd[0], lead.vStd[0]))
+    prob_d = math.exp(-abs(c.dRel - offset_vision_dist) / b_d)
+    prob_y = math.exp(-abs(c.yRel + lead.y[0]) / b_y)
+    prob_v = math.exp(-abs(c.vRel + v_ego - lead.v[0]) / b_v)
+    return prob_d * prob_y * prob_v
+
+  cluster = max(clusters, key=prob)
+  dist_sane = abs(cluster.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(cluster.vRel + v_ego - lead.v[0]) < 10) or (v_ego + cluster.vRel > 3)
+  return cluster if dist_sane and vel_sane else None
+
+
+def ref_get_lead(v_ego, ready, clusters, lead_msg, low_speed_override=True):
+  clusters = list(clusters)
+  if len(clusters) > 0 and ready and lead_msg.prob > .5:
+    cluster = ref_match_vision_to_cluster(v_ego, lead_msg, clusters)
+  else:
+    cluster = None
+
+  lead_dict = {'status': False}
+  if cluster is not None:
+    lead_dict = cluster.get_RadarState(lead_msg.prob)
+  elif ready and (lead_msg.prob > .5):
+    lead_dict = Cluster.get_RadarState_from_vision(lead_msg, v_ego)
+
+  if low_speed_override:
+    low_speed_clusters = [c for c in clusters if abs(c.yRel) < 1.5 and v_ego < 4. and c.dRel < 25]
+    if len(low_speed_clusters) > 0:
+      closest_cluster = min(low_speed_clusters, key=lambda c: c.dRel)
+      if (not lead_dict['status']) or (closest_cluster.dRel < lead_dict['dRel']):
+        lead_dict = closest_cluster.get_RadarState()
+  return lead_dict
+
+
+class TestRadard(unittest.TestCase):
+  def assertLeadsEqual(self, v_ego, ready, clusters, leads):
+    expected = [ref_get_lead(v_ego, ready, clusters, leads[0], low_speed_override=True),
+                ref_get_lead(v_ego, ready, clusters, leads[1], low_speed_override=False)]
+    self.assertEqual(get_leads(v_ego, ready, clusters, leads), expected)
+    return expected
+
+  def test_laplacian_cdf(self):
+    x = np.array([-3., 0., 1e-5, 2.5, 40.])
+    for mu, b in ((0., 1.), (2., 0.5), (1., 0.), (1., -2.)):
+      expected = [math.exp(-abs(v - mu) / max(b, 1e-4)) for v in x]
+      np.testing.assert_allclose(laplacian_cdf(x, mu, b), expected, rtol=1e-12)
+      self.assertAlmostEqual(float(laplacian_cdf(x[1], mu, b)), expected[1], places=12)
+
+  def test_random_leads(self):
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+      v_ego = rng.choice([rng.uniform(0., 4.), rng.uniform(4., 35.)])
+      n = rng.integers(0, 12)
+      pts = np.column_stack((rng.uniform(0., 100., n), rng.uniform(-4., 4., n), rng.uniform(-v_ego - 2., 5., n)))
+      clusters = make_clusters(pts, v_ego)
+      leads = []
+      for _ in range(2):
+        if n > 0 and rng.random() < 0.6:
+          # near one of the clusters
+          d, y, v = pts[rng.integers(n)] + rng.normal(0., [2., 0.5, 1.])
+          leads.append(make_lead(d, y, v + v_ego, prob=rng.random()))
+        else:
+          leads.append(make_lead(rng.uniform(0., 100.), rng.uniform(-4., 4.), rng.uniform(0., 35.), prob=rng.random()))
+      self.assertLeadsEqual(v_ego, bool(rng.random() < 0.9), clusters, leads)
+
+  def test_argmax_ties(self):
+    # the first two clusters are as likely, the first one is chosen
+    v_ego = 20.
+    clusters = make_clusters([[30., 1., 0.], [30., -1., 0.], [32., 0., 0.]], v_ego)
+    lead = make_lead(30., 0., v_ego, std=(1., 1., 1.))
+    self.assertEqual(match_vision_to_clusters(v_ego, [lead, lead], clusters), [0, 0])
+    leads = self.assertLeadsEqual(v_ego, True, clusters, [lead, lead])
+    self.assertEqual(leads[0]['yRel'], 1.)
+
+    clusters = make_clusters([[30., -1., 0.], [30., 1., 0.]], v_ego)
+    leads = self.assertLeadsEqual(v_ego, True, clusters, [lead, lead])
+    self.assertEqual(leads[1]['yRel'], -1.)
+
+  def test_dist_sane(self):
+    # the best match is too far from the vision lead, the vision lead is used instead
+    v_ego = 20.
+    clusters = make_clusters([[80., 0., 0.], [10., 3., 0.]], v_ego)
+    near, far = make_lead(50., 0., v_ego), make_lead(70., 0., v_ego)
+    self.assertEqual(match_vision_to_clusters(v_ego, [near, far], clusters), [None, 0])
+    leads = self.assertLeadsEqual(v_ego, True, clusters, [near, far])
+    self.assertFalse(leads[0]['radar'])
+    self.assertTrue(leads[1]['radar'])
+
+  def test_low_speed_override(self):
+    # only the first lead is overridden by a close cluster at low speed
+    clusters = make_clusters([[8., 0.5, -1.], [60., 0., 0.]], 2.)
+    leads = [make_lead(60., 0., 2.), make_lead(60., 0., 2.)]
+    expected = self.assertLeadsEqual(2., True, clusters, leads)
+    self.assertEqual(expected[0]['dRel'], 8.)
+    self.assertEqual(expected[1]['dRel'], 60.)
+
+    # also when the model sees no lead
+    leads = [make_lead(60., 0., 2., prob=0.1), make_lead(60., 0., 2., prob=0.1)]
+    expected = self.assertLeadsEqual(2., True, clusters, leads)
+    self.assertEqual(expected[0]['dRel'], 8.)
+    self.assertEqual(expected[1], {'status': False})
+
+    # not above the stationary speed
+    expected = self.assertLeadsEqual(5., True, make_clusters([[8., 0.5, -1.], [60., 0., 0.]], 5.), leads)
+    self.assertEqual(expected, [{'status': False}, {'status': False}])
+
+  def test_vision_only(self):
+    clusters = make_clusters([], 10.)
+    leads = [make_lead(30., 0.5, 12.), make_lead(50., -1., 14., prob=0.6)]
+    expected = self.assertLeadsEqual(10., True, clusters, leads)
+    self.assertTrue(all(lead['status'] and not lead['radar'] for lead in expected))
+    self.assertEqual(self.assertLeadsEqual(10., False, clusters, leads), [{'status': False}, {'status': False}])
+
+
+if __name__ == "__main__":
+  unittest.main()
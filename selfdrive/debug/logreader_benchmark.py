@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import argparse
+import time
+from collections import Counter
+
+from tools.lib.logreader import LogReader
+
+
+def count_services(log_path, services=None, stream=False):
+  t = time.monotonic()
+  cnt: Counter = Counter()
+  for msg in LogReader(log_path, services=services, stream=stream):
+    cnt[msg.which()] += 1
+  return cnt, time.monotonic() - t
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare LogReader parse time with and without a services filter")
+  parser.add_argument("log_path", help="rlog or qlog path or url")
+  parser.add_argument("services", nargs="+", help="services to keep, e.g. carState controlsState")
+  parser.add_argument("--stream", action="store_true", help="use the streaming LogReader")
+  args = parser.parse_args()
+
+  cnt_all, t_all = count_services(args.log_path, stream=args.stream)
+  cnt_filtered, t_filtered = count_services(args.log_path, args.services, stream=args.stream)
+
+  print(f"{'service':<30} {'all':>8} {'filtered':>8}")
+  for s in sorted(cnt_all, key=cnt_all.get, reverse=True):
+    print(f"{s:<30} {cnt_all[s]:>8} {cnt_filtered[s]:>8}")
+  print()
+  print(f"all events:      {sum(cnt_all.values()):>8} in {t_all:.3f} s")
+  print(f"filtered events: {sum(cnt_filtered.values()):>8} in {t_filtered:.3f} s ({t_all / t_filtered:.1f}x faster)")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+
+import overpy
+
+from selfdrive.mapd.lib.WayRelation import WayRelation
+from selfdrive.mapd.lib.WayRelationIndex import WayRelationIndex
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../mapd/test")
+FIXTURES = ["mock_osm_response_01.xml", "mock_osm_response_02.xml"]
+
+
+def build_list_concat_index(way_relations):
+  # the previous WayRelationIndex construction, copying a bucket on every insert
+  edge_nodes_index_dict, full_nodes_index_dict = {}, {}
+  for wr in way_relations:
+    for node in wr.way.nodes:
+      full_nodes_index_dict[node.id] = full_nodes_index_dict.get(node.id, []) + [wr]
+      if node.id in wr.edge_nodes_ids:
+        edge_nodes_index_dict[node.id] = edge_nodes_index_dict.get(node.id, []) + [wr]
+  return full_nodes_index_dict
+
+
+def shared_node_way_relations(n):
+  # n ways with all their nodes in common, the worst case for copying buckets
+  xml = ['<osm version="0.6">']
+  xml += [f'<node id="{i}" lat="52.{i:04d}" lon="13.{i:04d}"/>' for i in range(1, 11)]
+  for w in range(n):
+    xml.append(f'<way id="{w + 1}">' + "".join(f'<nd ref="{i}"/>' for i in range(1, 11)) + '<tag k="highway" v="primary"/></way>')
+  xml.append('</osm>')
+  return [WayRelation(way) for way in overpy.Overpass().parse_xml("".join(xml)).ways]
+
+
+def timeit(f, repeat):
+  times = []
+  for _ in range(repeat):
+    t = time.monotonic()
+    f()
+    times.append(time.monotonic() - t)
+  return min(times)
+
+
+def report(name, way_relations, repeat):
+  node_ids = [node.id for wr in way_relations for node in wr.way.nodes]
+  t_old = timeit(lambda: build_list_concat_index(way_relations), repeat)
+  t_new = timeit(lambda: WayRelationIndex(way_relations), repeat)
+
+  def build_and_lookup():
+    wr_index = WayRelationIndex(way_relations)
+    for node_id in node_ids:
+      wr_index.way_relations_with_node_id(node_id)
+  t_lookup = timeit(build_and_lookup, repeat)
+
+  print(f"{name:<28} {len(way_relations):>6} ways {len(node_ids):>7} nodes | "
+        f"list concat {t_old * 1e3:8.2f} ms | index {t_new * 1e3:7.2f} ms | index + all lookups {t_lookup * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time WayRelationIndex construction on the mapd OSM fixtures")
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  for fixture in FIXTURES:
+    with open(os.path.join(FIXTURES_DIR, fixture)) as f:
+      ways = overpy.Overpass().parse_xml(f.read()).ways
+    report(fixture, [WayRelation(way) for way in ways], args.repeat)
+
+  for n in (100, 1000, 4000):
+    report(f"{n} ways sharing nodes", shared_node_way_relations(n), args.repeat)
+
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import overpy
+
+from selfdrive.mapd.mapd import MapD
+from selfdrive.mapd.config import QUERY_RADIUS, OSM_CACHE_GEOHASH_PRECISION, OSM_CACHE_MAX_AGE, OSM_CACHE_MAX_BYTES
+from selfdrive.mapd.lib.geo import R, bearing_to_points, distance_to_points
+from selfdrive.mapd.lib.OSMTileStore import OSMTileStore
+from selfdrive.mapd.lib.OSMQueryCache import OSMQueryCache
+from selfdrive.mapd.lib.OSMQueryScheduler import OSMQueryScheduler
+
+SERVICES = ['gpsLocationExternal', 'controlsState']
+STAGES = ['update_gps', 'updated_osm_data', 'update_route', 'publish']
+MAPD_PERIOD = 1.  # s. mapd runs at 1 Hz.
+GPX_ACCURACY = 5.  # mts. gpxd only logs fixes at least this accurate.
+
+
+def gpx_events(fn):
+  # gpxd only writes the time and position of the fixes, speed and bearing are derived from consecutive points.
+  points = []
+  for trkpt in ET.parse(fn).getroot().iterfind('.//{*}trkpt'):
+    t = datetime.fromisoformat(trkpt.findtext('{*}time').rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+    points.append((t, float(trkpt.get('lat')), float(trkpt.get('lon'))))
+  if len(points) < 2:
+    return
+
+  t, lat_lon = np.array([p[0] for p in points]), np.array([p[1:] for p in points])
+  rad = np.radians(lat_lon)
+  bearings = np.array([bearing_to_points(a, b[np.newaxis])[0] for a, b in zip(rad[:-1], rad[1:])])
+  distances = np.array([distance_to_points(a, b[np.newaxis])[0] for a, b in zip(rad[:-1], rad[1:])])
+  speeds = distances / np.maximum(np.diff(t), 1e-3)
+
+  for i, (lat, lon) in enumerate(lat_lon.tolist()):
+    j = min(i, len(bearings) - 1)
+    gps = SimpleNamespace(flags=1, timestamp=int(t[i] * 1e3), latitude=lat, longitude=lon, speed=float(speeds[j]),
+                          bearingDeg=float(np.degrees(bearings[j]) % 360.), accuracy=GPX_ACCURACY,
+                          bearingAccuracyDeg=1.)
+    yield float(t[i]), 'gpsLocationExternal', gps, True
+
+
+def rlog_events(fn):
+  from tools.lib.logreader import LogReader
+  for msg in LogReader(fn, sort_by_time=True, services=SERVICES):
+    yield msg.logMonoTime * 1e-9, msg.which(), getattr(msg, msg.which()), msg.valid
+
+
+def trace_events(fn):
+  return gpx_events(fn) if fn.endswith('.gpx') else rlog_events(fn)
+
+
+class LocalOSM():
+  """Serves the road ways of a local tile store or of Overpass XML responses, so replays never use the network.
+  """
+  def __init__(self, tile_store=None, xml_files=()):
+    self.tile_store = tile_store
+    self.ways = []
+    for fn in xml_files:
+      with open(fn) as f:
+        self.ways.extend(overpy.Overpass().parse_xml(f.read()).ways)
+    self._bboxes = np.array([[min(float(nd.lat) for nd in way.nodes), min(float(nd.lon) for nd in way.nodes),
+                              max(float(nd.lat) for nd in way.nodes), max(float(nd.lon) for nd in way.nodes)]
+                             for way in self.ways]).reshape(-1, 4)
+    self.query_times = []
+
+  def fetch_road_ways_around_location(self, lat, lon, radius):
+    t = time.monotonic()
+    bbox_angle = np.degrees(radius / R)
+    bbox = (lat - bbox_angle, lon - bbox_angle, lat + bbox_angle, lon + bbox_angle)
+    if self.tile_store is not None:
+      ways = self.tile_store.fetch_ways_in_bbox(*bbox)
+    else:
+      overlaps = (self._bboxes[:, 0] <= bbox[2]) & (self._bboxes[:, 2] >= bbox[0]) & \
+        (self._bboxes[:, 1] <= bbox[3]) & (self._bboxes[:, 3] >= bbox[1])
+      ways = [self.ways[i] for i in np.nonzero(overlaps)[0]]
+    self.query_times.append(time.monotonic() - t)
+    return ways
+
+
+class ReplaySubMaster():
+  def __init__(self):
+    self.data = {}
+    self.updated = {s: False for s in SERVICES}
+    self.valid = {s: False for s in SERVICES}
+
+  def __getitem__(self, s):
+    return self.data[s]
+
+  def all_alive_and_valid(self, service_list=None):
+    return all(self.valid[s] for s in (service_list or SERVICES))
+
+
+class ReplayPubMaster():
+  def __init__(self):
+    self.send_time = None
+
+  def send(self, s, dat):
+    self.send_time = time.monotonic()
+
+
+class ReplayStats():
+  def __init__(self):
+    self.stage_times = {stage: [] for stage in STAGES}
+    self.query_wait_times = []
+    self.latencies = []
+    self.cycles = 0
+    self.fix_cycles = 0
+    self.map_cycles = 0
+    self.located_cycles = 0
+    self.first_fix_time = None
+    self.first_publish_time = None
+
+
+def run_cycle(mapd, sm, pm, stats, t):
+  stats.cycles += 1
+  mapd.udpate_state(sm)
+
+  stages = {
+    'update_gps': lambda: mapd.update_gps(sm),
+    'updated_osm_data': mapd.updated_osm_data,
+    'update_route': mapd.update_route,
+    'publish': lambda: mapd.publish(pm, sm),
+  }
+
+  pm.send_time = None
+  t_cycle = time.monotonic()
+  for stage in STAGES:
+    t_stage = time.monotonic()
+    stages[stage]()
+    stats.stage_times[stage].append(time.monotonic() - t_stage)
+
+  if pm.send_time is not None:
+    stats.latencies.append(pm.send_time - t_cycle)
+    if stats.first_publish_time is None:
+      stats.first_publish_time = t
+
+  if mapd.location_rad is not None:
+    stats.fix_cycles += 1
+    if stats.first_fix_time is None:
+      stats.first_fix_time = t
+    if mapd.way_collection is not None:
+      stats.map_cycles += 1
+      stats.located_cycles += mapd.route is not None and mapd.route.located
+
+  # Wait for any query requested to finish, so the map data is swapped in on the next cycle on every replay.
+  t_wait = time.monotonic()
+  if mapd.query_scheduler.busy:
+    while mapd.query_scheduler.busy:
+      time.sleep(0.001)
+    stats.query_wait_times.append(time.monotonic() - t_wait)
+
+  for s in SERVICES:
+    sm.updated[s] = False
+
+
+def replay(events, osm, cache_dir):
+  mapd = MapD()
+  mapd.osm = osm
+  mapd.tile_prefetcher = None
+  mapd.query_scheduler = OSMQueryScheduler(osm, OSMQueryCache(cache_dir, OSM_CACHE_MAX_AGE, OSM_CACHE_MAX_BYTES),
+                                           QUERY_RADIUS, OSM_CACHE_GEOHASH_PRECISION)
+  sm, pm, stats = ReplaySubMaster(), ReplayPubMaster(), ReplayStats()
+
+  # Run a mapd cycle every MAPD_PERIOD of log time with the latest message of every service.
+  next_cycle = None
+  for t, s, msg, valid in events:
+    if next_cycle is None:
+      next_cycle = t + MAPD_PERIOD
+    while t >= next_cycle:
+      run_cycle(mapd, sm, pm, stats, next_cycle)
+      next_cycle += MAPD_PERIOD
+    sm.data[s], sm.updated[s], sm.valid[s] = msg, True, valid
+  if next_cycle is not None:
+    run_cycle(mapd, sm, pm, stats, next_cycle)
+
+  return stats
+
+
+def percentiles_ms(times):
+  if len(times) == 0:
+    return "       -"
+  times = np.array(times) * 1e3
+  return " ".join(f"{v:8.2f}" for v in (np.mean(times), np.percentile(times, 50), np.percentile(times, 95),
+                                         np.max(times)))
+
+
+def report(name, stats, query_times):
+  print(f"{name}: {stats.cycles} cycles, {stats.fix_cycles} with a fix, {stats.map_cycles} with map data, "
+        f"{len(query_times)} OSM queries")
+  hit_rate = stats.located_cycles / stats.map_cycles * 100. if stats.map_cycles > 0 else 0.
+  print(f"  route located on {stats.located_cycles} of {stats.map_cycles} cycles with map data ({hit_rate:.1f}%)")
+  if stats.first_publish_time is not None:
+    print(f"  first liveMapData {stats.first_publish_time - stats.first_fix_time:.0f} s after the first fix")
+  print(f"  {'ms':<28} {'mean':>8} {'p50':>8} {'p95':>8} {'max':>8}")
+  for stage in STAGES:
+    print(f"  {stage:<28} {percentiles_ms(stats.stage_times[stage])}")
+  print(f"  {'liveMapData latency':<28} {percentiles_ms(stats.latencies)}")
+  print(f"  {'map data query (worker)':<28} {percentiles_ms(query_times)}")
+  # What the worker still had to do after the cycle requested the data, including building the way collection.
+  print(f"  {'worker wait':<28} {percentiles_ms(stats.query_wait_times)}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Replay GPS traces from rlogs or gpxd .gpx files through mapd "
+                                               "with a local OSM stand-in and time every stage")
+  parser.add_argument("traces", nargs="+", help="rlog paths or urls, or .gpx files")
+  osm_source = parser.add_mutually_exclusive_group(required=True)
+  osm_source.add_argument("--tiles", help="local OSM tile store directory, see selfdrive/mapd/build_osm_tiles.py")
+  osm_source.add_argument("--osm-xml", nargs="+", help="Overpass XML responses, e.g. selfdrive/mapd/test/*.xml")
+  parser.add_argument("--cache-dir", help="OSM query cache directory, a new empty one by default")
+  parser.add_argument("--runs", type=int, default=2, help="replays of every trace, the first one with a cold cache "
+                                                          "unless --cache-dir is given")
+  args = parser.parse_args()
+
+  tile_store = OSMTileStore(args.tiles) if args.tiles is not None else None
+  if tile_store is not None and not tile_store.available:
+    raise SystemExit(f"no OSM tile store in {args.tiles}")
+  osm = LocalOSM(tile_store, args.osm_xml or ())
+
+  for trace in args.traces:
+    events = list(trace_events(trace))
+    cache_dir = args.cache_dir or tempfile.mkdtemp()
+    try:
+      for run in range(args.runs):
+        queries = len(osm.query_times)
+        stats = replay(events, osm, cache_dir)
+        report(f"{os.path.basename(trace)} run {run + 1}", stats, osm.query_times[queries:])
+    finally:
+      if args.cache_dir is None:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import argparse
+import overpy
+from selfdrive.mapd.lib.osm import EXCLUDED_HIGHWAY_TYPES
+from selfdrive.mapd.lib.OSMTileStore import TILE_ZOOM, build_tiles
+from selfdrive.mapd.config import OSM_TILES_DIR
+
+try:
+  import osmium
+except ImportError:
+  osmium = None
+
+
+def _is_road(tags):
+  highway = tags.get('highway')
+  return highway is not None and highway not in EXCLUDED_HIGHWAY_TYPES
+
+
+def road_ways_from_pbf(fn):
+  """Provides (way_id, tags, nodes) for the road ways of an .osm.pbf extract, streaming it with pyosmium.
+  """
+  if osmium is None:
+    raise ImportError("reading .osm.pbf files requires pyosmium, install it with `pip install osmium`")
+
+  ways = []
+
+  class RoadHandler(osmium.SimpleHandler):
+    def way(self, w):
+      tags = {t.k: t.v for t in w.tags}
+      if _is_road(tags):
+        ways.append((w.id, tags, [(n.ref, n.lat, n.lon) for n in w.nodes if n.location.valid()]))
+
+  RoadHandler().apply_file(fn, locations=True)
+  return ways
+
+
+def road_ways_from_xml(fn):
+  """Yields (way_id, tags, nodes) for the road ways of an .osm XML extract or Overpass response.
+  """
+  with open(fn) as f:
+    result = overpy.Result.from_xml(f.read())
+  for way in result.ways:
+    if not _is_road(way.tags):
+      continue
+    try:
+      nodes = [(nd.id, float(nd.lat), float(nd.lon)) for nd in way.nodes]
+    except overpy.exception.DataIncomplete:
+      continue  # ways clipped by the extract
+    yield way.id, way.tags, nodes
+
+
+def pbf_bounds(fn):
+  if osmium is None:
+    return None
+  box = osmium.io.Reader(fn, osmium.osm.osm_entity_bits.NOTHING).header().box()
+  if not box.valid():
+    return None
+  return (box.bottom_left.lat, box.bottom_left.lon, box.top_right.lat, box.top_right.lon)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Build the local OSM tile store used by mapd from an OSM extract")
+  parser.add_argument("extract", help=".osm.pbf or .osm XML file")
+  parser.add_argument("out_dir", nargs="?", default=OSM_TILES_DIR)
+  parser.add_argument("--zoom", type=int, default=TILE_ZOOM)
+  parser.add_argument("--bounds", type=float, nargs=4, metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"),
+                      help="area covered by the extract, defaults to the pbf header box or the extent of the ways")
+  args = parser.parse_args()
+
+  if args.extract.endswith(".pbf"):
+    ways = road_ways_from_pbf(args.extract)
+    bounds = args.bounds if args.bounds is not None else pbf_bounds(args.extract)
+  else:
+    ways = road_ways_from_xml(args.extract)
+    bounds = args.bounds
+
+  n = build_tiles(ways, args.out_dir, bounds, args.zoom)
+  print(f"wrote {n} tiles to {args.out_dir}")
@@ -4,4 +4,11 @@ QUERY_RADIUS = 3000  # mts. Radius to use on OSM data queries.
 MIN_DISTANCE_FOR_NEW_QUERY = 1000  # mts. Minimum distance to query area edge before issuing a new query.
 FULL_STOP_MAX_SPEED = 1.39  # m/s Max speed for considering car is stopped.
 LOOK_AHEAD_HORIZON_TIME = 15.  # s. Time horizon for look ahead of turn speed sections to provide on liveMapData msg.
+QUERY_LEAD_TIME = 30.  # s. Time ahead of getting within MIN_DISTANCE_FOR_NEW_QUERY of the query area edge to query.
+OSM_TILES_DIR = '/data/media/0/osm_tiles/'  # Local OSM tile store, see build_osm_tiles.py. Overpass is used without it.
+PREFETCH_HORIZON = 3000  # mts. Distance ahead along the recent trajectory to prefetch local OSM tiles for.
+OSM_CACHE_DIR = '/data/media/0/osm_cache/'  # Persistent cache of OSM query results.
+OSM_CACHE_GEOHASH_PRECISION = 6  # Geohash characters of the cached query centers. ~1.2 x 0.6 km cells.
+OSM_CACHE_MAX_AGE = 30 * 24 * 3600  # s. Cached query results older than this are queried again.
+OSM_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Least recently used query results are removed over this size.
 LANE_WIDTH = 3.7  # Lane width estimate. Used for detecting departures from way.
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict
 from enum import Enum
 from selfdrive.mapd.lib.geo import DIRECTION, R, vectors
 
@@ -19,20 +20,9 @@ _MAX_CURV_SPLIT_ARC_ANGLE = 90.  # degrees. Arc section to split into new speed
 _MIN_NODE_DISTANCE = 50.  # mts. Minimum distance between nodes for spline evaluation. Data is enhanced if not met.
 _ADDED_NODES_DIST = 15.  # mts. Distance between added nodes when data is enhanced for spline evaluation.
 _DIVERTION_SEARCH_RANGE = [-200., 50.]  # mt. Range of distance to current location for divertion search.
+_CURVATURE_SPEED_SECTIONS_CACHE_SIZE = 32  # Number of routes to keep the turn speed limit sections for.
 
-
-def nodes_raw_data_array_for_wr(wr, drop_last=False):
-  """Provides an array of raw node data (id, lat, lon, speed_limit) for all nodes in way relation
-  """
-  sl = wr.speed_limit
-  data = np.array([(n.id, n.lat, n.lon, sl) for n in wr.way.nodes], dtype=float)
-
-  # reverse the order if way direction is backwards
-  if wr.direction == DIRECTION.BACKWARD:
-    data = np.flip(data, axis=0)
-
-  # drop last if requested
-  return data[:-1] if drop_last else data
+_curvature_speed_sections_cache = OrderedDict()
 
 
 def node_calculations(points):
@@ -54,6 +44,13 @@ def node_calculations(points):
   # (N-1, 1) array. No bearing for v[-1]
   b = np.arctan2(v[:, 0], v[:, 1])
 
+  return node_calculations_for_vectors(v, d, b)
+
+
+def node_calculations_for_vectors(v, d, b):
+  """Provides node calculations based on the (N-1, 2) array of vectors `v` between consecutive nodes and their
+     distances `d` and bearings `b`.
+  """
   # Add origin to vector space. (i.e first node in list)
   v = np.concatenate(([[0., 0.]], v))
 
@@ -70,6 +67,54 @@ def node_calculations(points):
   return v, dp, dn, dr, b
 
 
+def way_nodes_data(wr):
+  """Provides the node data of the way relation `wr` in its current direction as a tuple of arrays: raw node data
+  (id, lat, lon), points (lat, lon) in radians and the vectors, distances and bearings between consecutive nodes.
+  These do not depend on the route the way is part of, so they are calculated once per direction and kept on `wr`.
+  """
+  data = wr.nodes_data.get(wr.direction)
+  if data is not None:
+    return data
+
+  raw = np.array([(n.id, n.lat, n.lon) for n in wr.way.nodes], dtype=float)
+  if wr.direction == DIRECTION.BACKWARD:
+    raw = np.flip(raw, axis=0)
+
+  points = np.radians(raw[:, [1, 2]])
+  v = vectors(points) * R
+  data = (raw, points, v, np.linalg.norm(v, axis=1), np.arctan2(v[:, 0], v[:, 1]))
+  wr.nodes_data[wr.direction] = data
+  return data
+
+
+def is_wr_a_valid_divertion_from_node(wr, node_id):
+  """
+  Evaluates if the way relation `wr` is a valid divertion from node with id `node_id`. A valid divertion is a way
+  relation with an edge node with the given `node_id` that can be traveled in the direction as if starting from node
+  with id `node_id`. Way relations already included in the route are not valid divertions either, `NodesData`
+  excludes those.
+  """
+  if wr.edge_nodes_ids[0] == node_id:
+    return True
+  return wr.edge_nodes_ids[-1] == node_id and not wr.is_one_way
+
+
+def way_divertions(wr, wr_index):
+  """Provides for every node of the way relation `wr` in its current direction, the list of way relations on
+  `wr_index` with an edge on the node that can be traveled starting from it. Way relations on the route still need
+  to be filtered out. Kept on `wr` as well, so `wr_index` must be the index of the way collection `wr` belongs to.
+  """
+  divertions = wr.divertions.get(wr.direction)
+  if divertions is not None:
+    return divertions
+
+  node_ids = way_nodes_data(wr)[0][:, 0]
+  divertions = [[div for div in wr_index.way_relations_with_edge_node_id(node_id)
+                 if is_wr_a_valid_divertion_from_node(div, node_id)] for node_id in node_ids]
+  wr.divertions[wr.direction] = divertions
+  return divertions
+
+
 def spline_curvature_calculations(vect, dist_prev):
   """Provides an array of curvatures and its distances by applying a spline interpolation
   to the path described by the nodes data.
@@ -78,16 +123,14 @@ def spline_curvature_calculations(vect, dist_prev):
   # inexistent curvature values close to irregularities on the road when the resolution of nodes data
   # approaching the irregularity is low.
 
-  # - Find indexes where dist_prev is greater than threshold
-  too_far_idxs = np.nonzero(dist_prev >= _MIN_NODE_DISTANCE)[0]
+  # - Find the number of vectors each vector needs to be replaced by. Those where dist_prev is greater than
+  # threshold are split in vectors of _ADDED_NODES_DIST at most, the rest are kept.
+  counts = np.ones(len(vect), dtype=int)
+  too_far = dist_prev >= _MIN_NODE_DISTANCE
+  counts[too_far] = np.ceil(dist_prev[too_far] / _ADDED_NODES_DIST).astype(int)
 
-  # - Traversing in reverse order, enhance data by adding points at the found indexes.
-  for idx in too_far_idxs[::-1]:
-    dp = dist_prev[idx]  # distance of vector that needs to be replaced by higher resolution vectors.
-    n = int(np.ceil(dp / _ADDED_NODES_DIST))  # number of vectors that need to be added.
-    new_v = vect[idx, :] / n  # new relative vector to insert.
-    vect = np.delete(vect, idx, axis=0)  # remove the relative vector to be replaced by the insertion of new vectors.
-    vect = np.insert(vect, [idx] * n, [new_v] * n, axis=0)  # insert n new relative vectors
+  # - Enhance data by replacing every vector by `count` vectors of `1 / count` its size, in a single pass.
+  vect = np.repeat(vect / counts[:, np.newaxis], counts, axis=0)
 
   # Data is now enhanced, we can proceed with curvature evaluation.
   # - Create cumulative arrays for distance traveled and vector (x, y)
@@ -114,6 +157,26 @@ def spline_curvature_calculations(vect, dist_prev):
   return curv, curv_ds
 
 
+def curvature_speed_sections_data(points, vect, dist_prev):
+  """Provides the turn speed limit sections data for the path described by the nodes data, see
+  `speed_limits_for_curvatures_data`. Results are memoized by the node points, so routes rebuilt on the same
+  nodes don't evaluate the spline again.
+  """
+  key = points.tobytes()
+  data = _curvature_speed_sections_cache.get(key)
+  if data is not None:
+    _curvature_speed_sections_cache.move_to_end(key)
+    return data
+
+  curv, curv_ds = spline_curvature_calculations(vect, dist_prev)
+  data = speed_limits_for_curvatures_data(curv, curv_ds)
+
+  _curvature_speed_sections_cache[key] = data
+  while len(_curvature_speed_sections_cache) > _CURVATURE_SPEED_SECTIONS_CACHE_SIZE:
+    _curvature_speed_sections_cache.popitem(last=False)
+  return data
+
+
 def speed_section(curv_sec):
   """Map curvature section data into turn speed sections data.
     Returns: [section start distance, section end distance, speed limit based on max curvature, sing of curvature]
@@ -206,18 +269,6 @@ def speed_limits_for_curvatures_data(curv, dist):
   # [start, end, speed_limit, curvature_sign]
   return np.array([speed_section(cs) for cs in curv_secs])
 
-def is_wr_a_valid_divertion_from_node(wr, node_id, wr_ids):
-  """
-  Evaluates if the way relation `wr` is a valid divertion from node with id `node_id`.
-  A valid divertion is a way relation with an edge node with the given `node_id` that is not already included
-  in the list of way relations in the route (`wr_ids`) and that can be travaled in the direction as if starting
-  from node with id `node_id`
-  """
-  if wr.id in wr_ids:
-    return False
-  wr.update_direction_from_starting_node(node_id)
-  return not wr.is_prohibited
-
 
 class SpeedLimitSection():
   """And object representing a speed limited road section ahead.
@@ -257,7 +308,9 @@ class NodeDataIdx(Enum):
 
 
 class NodesData:
-  """Container for the list of node data from a ordered list of way relations to be used in a Route
+  """Container for the list of node data from a ordered list of way relations to be used in a Route.
+  The per way node data is kept on the way relations, so only joining it is needed for routes built again on them.
+  Turn speed sections depend on the whole route and are memoized by its nodes instead.
   """
   def __init__(self, way_relations, wr_index):
     self._nodes_data = np.array([])
@@ -268,39 +321,37 @@ class NodesData:
     if way_count == 0:
       return
 
-    # We want all the nodes from the last way section
-    nodes_data = nodes_raw_data_array_for_wr(way_relations[-1])
-
-    # For the ways before the last in the route we want all the nodes but the last, as that one is the first on
-    # the next section. Collect them, append last way node data and concatenate the numpy arrays.
-    if way_count > 1:
-      wrs_data = tuple([nodes_raw_data_array_for_wr(wr, drop_last=True) for wr in way_relations[:-1]])
-      wrs_data += (nodes_data,)
-      nodes_data = np.concatenate(wrs_data)
+    # The node data of every way is reused between routes. For the ways before the last in the route we want all
+    # the nodes but the last, as that one is the first on the next section.
+    wrs_data = [way_nodes_data(wr) for wr in way_relations]
+    counts = [len(data[0]) - 1 for data in wrs_data[:-1]] + [len(wrs_data[-1][0])]
 
-    # Get a subarray with lat, lon to compute the remaining node values.
-    lat_lon_array = nodes_data[:, [1, 2]]
-    points = np.radians(lat_lon_array)
     # Ensure we have more than 3 points, if not calculations are not possible.
-    if len(points) <= 3:
+    if sum(counts) <= 3:
       return
-    vect, dist_prev, dist_next, dist_route, bearing = node_calculations(points)
+
+    speed_limits = np.repeat(np.array([wr.speed_limit for wr in way_relations], dtype=float), counts)
+    nodes_data = np.column_stack((np.concatenate([data[0][:count] for data, count in zip(wrs_data, counts)]),
+                                  speed_limits))
+    points = np.concatenate([data[1][:count] for data, count in zip(wrs_data, counts)])
+
+    # As consecutive ways share the edge node, the vectors between the route nodes are the ones of every way.
+    vect, dist_prev, dist_next, dist_route, bearing = node_calculations_for_vectors(
+      *[np.concatenate([data[i] for data in wrs_data]) for i in range(2, 5)])
 
     # append calculations to nodes_data
     # nodes_data structure: [id, lat, lon, speed_limit, x, y, dist_prev, dist_next, dist_route, bearing]
     self._nodes_data = np.column_stack((nodes_data, vect, dist_prev, dist_next, dist_route, bearing))
 
-    # Build route divertion options data from the wr_index.
-    wr_ids = [wr.id for wr in way_relations]
-    self._divertions = [[wr for wr in wr_index.way_relations_with_edge_node_id(node_id)
-                        if is_wr_a_valid_divertion_from_node(wr, node_id, wr_ids)]
-                        for node_id in nodes_data[:, 0]]
+    # Build route divertion options data from the divertions of every way, excluding the ways in the route.
+    wr_ids = set(wr.id for wr in way_relations)
+    self._divertions = [[div for div in divs if div.id not in wr_ids]
+                        for wr, count in zip(way_relations, counts) for divs in way_divertions(wr, wr_index)[:count]]
 
     # Store calculcations for curvature sections speed limits. We need more than 3 points to be able to process.
     # _curvature_speed_sections_data structure: [dist_start, dist_stop, speed_limits, curv_sign]
     if len(vect) > 3:
-      curv, curv_ds = spline_curvature_calculations(vect, dist_prev)
-      self._curvature_speed_sections_data = speed_limits_for_curvatures_data(curv, curv_ds)
+      self._curvature_speed_sections_data = curvature_speed_sections_data(points, vect, dist_prev)
 
   @property
   def count(self):
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import overpy
+import numpy as np
+
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_GEOHASH_DECODE = {c: i for i, c in enumerate(_GEOHASH_BASE32)}
+_CACHE_FILE_EXT = '.npz'
+
+
+def geohash_encode(lat, lon, precision):
+  """Provides the geohash of `precision` characters for the location in degrees.
+  """
+  lat_range, lon_range = [-90., 90.], [-180., 180.]
+  chars = []
+  bits, bit_count, even = 0, 0, True
+  while len(chars) < precision:
+    rng, value = (lon_range, lon) if even else (lat_range, lat)
+    mid = (rng[0] + rng[1]) / 2.
+    if value >= mid:
+      bits = (bits << 1) | 1
+      rng[0] = mid
+    else:
+      bits = bits << 1
+      rng[1] = mid
+    even = not even
+    bit_count += 1
+    if bit_count == 5:
+      chars.append(_GEOHASH_BASE32[bits])
+      bits, bit_count = 0, 0
+  return ''.join(chars)
+
+
+def geohash_center(geohash):
+  """Provides the (lat, lon) center in degrees of the `geohash` cell.
+  """
+  lat_range, lon_range = [-90., 90.], [-180., 180.]
+  even = True
+  for c in geohash:
+    bits = _GEOHASH_DECODE[c]
+    for shift in range(4, -1, -1):
+      rng = lon_range if even else lat_range
+      mid = (rng[0] + rng[1]) / 2.
+      if (bits >> shift) & 1:
+        rng[0] = mid
+      else:
+        rng[1] = mid
+      even = not even
+  return (lat_range[0] + lat_range[1]) / 2., (lon_range[0] + lon_range[1]) / 2.
+
+
+class OSMQueryCache():
+  """A persistent cache of OSM query results, keyed by the geohash of the query center.
+
+  Every entry holds the ways of a `WayCollection` (node ids and coordinates, and tags) together with the
+  precomputed geometry of its way relations, so it can be rebuilt without querying or parsing. Entries older than
+  `max_age` are ignored and removed, and the least recently used entries are removed to keep the cache under
+  `max_bytes`.
+  """
+  def __init__(self, path, max_age, max_bytes):
+    self.path = path
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+
+  def _entry_path(self, key):
+    return os.path.join(self.path, key + _CACHE_FILE_EXT)
+
+  def get(self, key):
+    """Provides the (ways, geometries) stored for `key`, as `WayCollection` arguments, or None.
+    """
+    fn = self._entry_path(key)
+    try:
+      if time.time() - os.path.getmtime(fn) > self.max_age:
+        os.remove(fn)
+        return None
+      with np.load(fn, allow_pickle=False) as data:
+        entry = {k: data[k] for k in data.files}
+      # Record the access for the LRU eviction, keeping the mtime for the expiry.
+      os.utime(fn, (time.time(), os.path.getmtime(fn)))
+    except (OSError, ValueError, KeyError):
+      return None
+
+    # Ways share nodes, add each one once.
+    result = overpy.Result()
+    node_ids, idxs = np.unique(entry['node_ids'], return_index=True)
+    for node_id, (lat, lon) in zip(node_ids.tolist(), entry['node_coords'][idxs].tolist()):
+      result.append(overpy.Node(node_id, lat=lat, lon=lon, attributes={}, result=result))
+
+    ways, geometries = [], []
+    offsets = entry['offsets'].tolist()
+    tags = json.loads(str(entry['tags']))
+    for i, way_id in enumerate(entry['way_ids'].tolist()):
+      b, e = offsets[i], offsets[i + 1]
+      nodes_ids = entry['node_ids'][b:e]
+      way = overpy.Way(way_id, node_ids=nodes_ids.tolist(), attributes={}, tags=tags[i], result=result)
+      result.append(way)
+      ways.append(way)
+      # distances and bearings have one element less per way than nodes.
+      geometries.append((entry['nodes_np'][b:e], nodes_ids, entry['way_distances'][b - i:e - i - 1],
+                         entry['way_bearings'][b - i:e - i - 1]))
+
+    return ways, geometries
+
+  def put(self, key, way_collection):
+    """Stores the way relations of `way_collection` for `key`.
+    """
+    wrs = way_collection.way_relations
+    if len(wrs) == 0:
+      return
+
+    entry = {
+      'way_ids': np.array([wr.id for wr in wrs], dtype=np.int64),
+      'offsets': np.cumsum([0] + [len(wr._nodes_ids) for wr in wrs]),
+      'node_ids': np.concatenate([wr._nodes_ids for wr in wrs]).astype(np.int64),
+      'node_coords': np.array([[float(nd.lat), float(nd.lon)] for wr in wrs for nd in wr.way.nodes]),
+      'nodes_np': np.concatenate([wr._nodes_np for wr in wrs]),
+      'way_distances': np.concatenate([wr._way_distances for wr in wrs]),
+      'way_bearings': np.concatenate([wr._way_bearings for wr in wrs]),
+      'tags': np.array(json.dumps([wr.way.tags for wr in wrs])),
+    }
+
+    fn = self._entry_path(key)
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      with open(fn + '.tmp', 'wb') as f:
+        np.savez(f, **entry)
+      os.replace(fn + '.tmp', fn)
+      self.prune()
+    except OSError as e:
+      print(f'Exception while writing OSM query cache:\n{e}')
+
+  def prune(self):
+    """Removes the expired entries and the least recently used ones over the size limit.
+    """
+    now = time.time()
+    entries = []
+    with os.scandir(self.path) as it:
+      for entry in it:
+        if not entry.name.endswith(_CACHE_FILE_EXT):
+          continue
+        st = entry.stat()
+        if now - st.st_mtime > self.max_age:
+          os.remove(entry.path)
+        else:
+          entries.append((st.st_atime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      os.remove(fn)
+      total -= size
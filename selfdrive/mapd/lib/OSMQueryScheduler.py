@@ -0,0 +1,113 @@
+import threading
+from traceback import print_exc
+import numpy as np
+from selfdrive.mapd.lib.OSMQueryCache import geohash_encode, geohash_center
+from selfdrive.mapd.lib.WayCollection import WayCollection
+
+
+class OSMQueryResult():
+  """The `WayCollection` built with the ways of a query, with the query center.
+  """
+  def __init__(self, cache_key, location_deg, ways, geometries=None):
+    self.cache_key = cache_key
+    self.location_deg = location_deg
+    self.location_rad = np.radians(np.array(location_deg, dtype=float))
+    self.way_collection = WayCollection(ways, self.location_rad, geometries)
+
+
+class OSMQueryScheduler():
+  """Runs OSM queries one at a time on a worker thread, building their `WayCollection` there too.
+
+  Query centers are snapped to the center of their geohash cell, so results can be kept in `osm_cache`. Only the
+  latest requested query is kept while one is in flight. Finished results are taken with `pop_result` from the
+  thread using the way collections, which can then swap them in without any locking.
+  """
+  def __init__(self, osm, osm_cache, radius, geohash_precision):
+    self.osm = osm
+    self.osm_cache = osm_cache
+    self.radius = radius
+    self.geohash_precision = geohash_precision
+    self._condition = threading.Condition()
+    self._pending = None  # cache key and center of the next query.
+    self._in_flight = None  # cache key of the running query.
+    self._result = None
+    self._thread = None
+
+  def query_center(self, lat, lon):
+    """Provides the cache key and (lat, lon) center in degrees of the query for a location in degrees.
+    """
+    cache_key = geohash_encode(lat, lon, self.geohash_precision)
+    return cache_key, geohash_center(cache_key)
+
+  def load_cached(self, lat, lon):
+    """Builds the result of the query for a location in degrees right away, if it is cached. Otherwise None.
+    """
+    cache_key, location_deg = self.query_center(lat, lon)
+    cached = self.osm_cache.get(cache_key)
+    if cached is None:
+      return None
+
+    return OSMQueryResult(cache_key, location_deg, *cached)
+
+  @property
+  def busy(self):
+    with self._condition:
+      return self._pending is not None or self._in_flight is not None
+
+  def request(self, lat, lon):
+    """Schedules the query for a location in degrees, replacing any query not started yet. Returns the cache key.
+    """
+    cache_key, location_deg = self.query_center(lat, lon)
+    with self._condition:
+      if cache_key != self._in_flight:
+        self._pending = (cache_key, location_deg)
+        self._condition.notify()
+
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, daemon=True)
+      self._thread.start()
+
+    return cache_key
+
+  def pop_result(self):
+    """Provides the latest finished result not taken yet, or None.
+    """
+    with self._condition:
+      result, self._result = self._result, None
+      return result
+
+  def _query(self, cache_key, location_deg):
+    cached = self.osm_cache.get(cache_key)
+    if cached is not None:
+      ways, geometries = cached
+    else:
+      ways, geometries = self.osm.fetch_road_ways_around_location(*location_deg, self.radius), None
+
+    # Only provide a result if we received some ways. Otherwise it is most likely a conectivity issue and the
+    # query will be requested again.
+    if len(ways) == 0:
+      return None
+
+    result = OSMQueryResult(cache_key, location_deg, ways, geometries)
+    if cached is None:
+      self.osm_cache.put(cache_key, result.way_collection)
+    return result
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while self._pending is None:
+          self._condition.wait()
+        (cache_key, location_deg), self._pending = self._pending, None
+        self._in_flight = cache_key
+
+      try:
+        result = self._query(cache_key, location_deg)
+      except Exception:
+        print_exc()
+        result = None
+
+      with self._condition:
+        self._in_flight = None
+        if result is not None:
+          self._result = result
@@ -0,0 +1,228 @@
+import os
+import gzip
+import json
+import threading
+from collections import OrderedDict, deque
+import overpy
+import numpy as np
+from selfdrive.mapd.lib.geo import R
+
+
+TILE_ZOOM = 14  # Slippy map zoom of the tiles. ~2.4 km wide at the equator.
+MANIFEST_FILE = 'manifest.json'
+_TILE_CACHE_SIZE = 96  # Number of parsed tiles to keep in memory. A 3 km radius query needs ~16 at mid latitudes.
+_PREFETCH_HISTORY = 10  # Number of recent locations used to extrapolate the trajectory.
+_PREFETCH_MIN_TRAVEL = 50.  # mts. Minimum travel on the recent locations to extrapolate the trajectory.
+_PREFETCH_STEP = 500.  # mts. Step for sampling the extrapolated trajectory.
+
+
+def tile_for_location(lat, lon, zoom=TILE_ZOOM):
+  """Provides the (x, y) slippy map tile containing the location in degrees.
+  """
+  n = 2 ** zoom
+  lat_rad = np.radians(np.clip(lat, -85.0511, 85.0511))
+  x = int((lon + 180.) / 360. * n)
+  y = int((1. - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2. * n)
+  return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom=TILE_ZOOM):
+  """Provides the list of (x, y) tiles overlapping the bounding box in degrees.
+  """
+  min_x, min_y = tile_for_location(max_lat, min_lon, zoom)
+  max_x, max_y = tile_for_location(min_lat, max_lon, zoom)
+  return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def tile_path(path, x, y, zoom=TILE_ZOOM):
+  return os.path.join(path, str(zoom), str(x), f'{y}.json.gz')
+
+
+def build_tiles(ways, path, bounds=None, zoom=TILE_ZOOM):
+  """Writes an `OSMTileStore` at `path`.
+
+  Args:
+      ways (Iterable): (way_id, tags, nodes) for every road way, with nodes a list of (node_id, lat, lon).
+      path (String): Directory for the tile store.
+      bounds (Tuple): (min_lat, min_lon, max_lat, max_lon) area covered by the ways, i.e. the extract bounds.
+        Defaults to the bounding box of all the nodes.
+      zoom (Int): Zoom of the tiles.
+
+  Every way is written to all the tiles overlapping its bounding box, with all of its nodes, so any tile
+  has complete ways. Returns the number of tiles written.
+  """
+  tiles = {}
+  data_bounds = [90., 180., -90., -180.]
+  for way_id, tags, nodes in ways:
+    if len(nodes) < 2:
+      continue
+    lats = [nd[1] for nd in nodes]
+    lons = [nd[2] for nd in nodes]
+    min_lat, min_lon, max_lat, max_lon = min(lats), min(lons), max(lats), max(lons)
+    data_bounds = [min(data_bounds[0], min_lat), min(data_bounds[1], min_lon),
+                   max(data_bounds[2], max_lat), max(data_bounds[3], max_lon)]
+
+    way = (way_id, dict(tags), [(int(nd[0]), round(float(nd[1]), 7), round(float(nd[2]), 7)) for nd in nodes])
+    for tile in tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom):
+      tiles.setdefault(tile, []).append(way)
+
+  for (x, y), tile_ways in tiles.items():
+    elements = {}
+    for way_id, tags, nodes in tile_ways:
+      for node_id, lat, lon in nodes:
+        elements[('node', node_id)] = {'type': 'node', 'id': node_id, 'lat': lat, 'lon': lon}
+      elements[('way', way_id)] = {'type': 'way', 'id': way_id, 'nodes': [nd[0] for nd in nodes], 'tags': tags}
+
+    fn = tile_path(path, x, y, zoom)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with gzip.open(fn + '.tmp', 'wt') as f:
+      json.dump({'elements': list(elements.values())}, f, separators=(',', ':'))
+    os.replace(fn + '.tmp', fn)
+
+  # The manifest is written last, so an interrupted build doesn't look complete.
+  with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+    json.dump({'zoom': zoom, 'bounds': list(bounds if bounds is not None else data_bounds)}, f)
+
+  return len(tiles)
+
+
+class OSMTileStore():
+  """A local store of OSM road ways split in slippy map tiles, see `build_tiles`.
+
+  Tiles inside the store bounds with no file have no roads. Parsed tiles are kept in a LRU cache.
+  """
+  def __init__(self, path, cache_size=_TILE_CACHE_SIZE):
+    self.path = path
+    self.bounds = None
+    self.zoom = TILE_ZOOM
+    self._cache = OrderedDict()
+    self._cache_size = cache_size
+    self._lock = threading.Lock()
+
+    try:
+      with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+      self.zoom = manifest['zoom']
+      self.bounds = tuple(manifest['bounds'])
+    except (OSError, ValueError, KeyError):
+      pass
+
+  @property
+  def available(self):
+    return self.bounds is not None
+
+  def covers(self, min_lat, min_lon, max_lat, max_lon):
+    """Indicates if the store has all the ways in the bounding box in degrees.
+    """
+    if self.bounds is None:
+      return False
+    return self.bounds[0] <= min_lat and self.bounds[1] <= min_lon and \
+      max_lat <= self.bounds[2] and max_lon <= self.bounds[3]
+
+  def _load_tile(self, x, y):
+    try:
+      with gzip.open(tile_path(self.path, x, y, self.zoom), 'rt') as f:
+        return overpy.Result.from_json(json.load(f)).ways
+    except FileNotFoundError:
+      return []
+
+  def tile_ways(self, x, y):
+    """Provides the list of OSM way objects in tile (x, y).
+    """
+    with self._lock:
+      ways = self._cache.get((x, y))
+      if ways is not None:
+        self._cache.move_to_end((x, y))
+        return ways
+
+    # Parse outside of the lock, so lookups aren't blocked by the prefetcher.
+    ways = self._load_tile(x, y)
+    with self._lock:
+      self._cache[(x, y)] = ways
+      while len(self._cache) > self._cache_size:
+        self._cache.popitem(last=False)
+    return ways
+
+  def is_cached(self, x, y):
+    with self._lock:
+      return (x, y) in self._cache
+
+  def fetch_ways_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+    """Provides the OSM way objects overlapping the bounding box in degrees. Ways overlapping the tiles of the
+    bounding box but not the box itself might be included too, like on an Overpass bbox query with a larger box.
+    """
+    ways = {}
+    if self.bounds is None:
+      return []
+
+    for x, y in tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, self.zoom):
+      for way in self.tile_ways(x, y):
+        ways.setdefault(way.id, way)
+    return list(ways.values())
+
+
+class OSMTilePrefetcher():
+  """Loads the tiles of `tile_store` along the recent trajectory in a background thread, so the next query
+  around the car location is served from memory.
+  """
+  def __init__(self, tile_store, radius, horizon):
+    """
+    Args:
+        tile_store (OSMTileStore): The store to load the tiles from.
+        radius (Float): Radius in mts of the queries to prefetch for.
+        horizon (Float): Distance in mts ahead of the current location to prefetch.
+    """
+    self.tile_store = tile_store
+    self.radius = radius
+    self.horizon = horizon
+    self._locations = deque(maxlen=_PREFETCH_HISTORY)
+    self._thread = None
+
+  def tiles_ahead(self):
+    """Provides the tiles overlapping the query areas around the extrapolated trajectory.
+    """
+    if len(self._locations) == 0:
+      return []
+
+    lat, lon = self._locations[-1]
+    points = [(lat, lon)]
+
+    # Extrapolate on a local plane, the recent trajectory is short enough.
+    lat0, lon0 = self._locations[0]
+    cos_lat = np.cos(np.radians(lat))
+    north = np.radians(lat - lat0) * R
+    east = np.radians(lon - lon0) * R * cos_lat
+    travel = np.hypot(north, east)
+    if travel >= _PREFETCH_MIN_TRAVEL:
+      for d in np.arange(_PREFETCH_STEP, self.horizon + _PREFETCH_STEP, _PREFETCH_STEP):
+        points.append((lat + np.degrees(north / travel * d / R), lon + np.degrees(east / travel * d / R / cos_lat)))
+
+    tiles = []
+    bbox_angle = np.degrees(self.radius / R)
+    for p_lat, p_lon in points:
+      for tile in tiles_in_bbox(p_lat - bbox_angle, p_lon - bbox_angle, p_lat + bbox_angle, p_lon + bbox_angle,
+                                self.tile_store.zoom):
+        if tile not in tiles:
+          tiles.append(tile)
+
+    # Keep the tiles closer to the car first, in case they don't all fit in the cache.
+    return tiles[:self.tile_store._cache_size]
+
+  def update(self, lat, lon):
+    """Adds a new location in degrees and starts loading the missing tiles ahead, if not loading already.
+    """
+    self._locations.append((lat, lon))
+
+    if not self.tile_store.available or (self._thread is not None and self._thread.is_alive()):
+      return
+
+    tiles = [tile for tile in self.tiles_ahead() if not self.tile_store.is_cached(*tile)]
+    if len(tiles) == 0:
+      return
+
+    def prefetch():
+      for x, y in tiles:
+        self.tile_store.tile_ways(x, y)
+
+    self._thread = threading.Thread(target=prefetch, daemon=True)
+    self._thread.start()
@@ -46,8 +46,9 @@ class Route():
       way_relations = wr_index.way_relations_with_edge_node_id(last_node_id)
 
       # - Add split way relations when necessary and remove parent way relations.
+      # (Concatenate instead of extending, as the list belongs to the index.)
       split_wrs_to_add = [wr for wr in split_wrs if last_node_id in wr.edge_nodes_ids]
-      way_relations.extend(split_wrs_to_add)
+      way_relations = way_relations + split_wrs_to_add
       parent_ids = [wr.parent_wr_id for wr in split_wrs_to_add]
       way_relations = [wr for wr in way_relations if wr.id not in parent_ids]
 
@@ -1,5 +1,6 @@
-from selfdrive.mapd.lib.WayRelation import WayRelation
+from selfdrive.mapd.lib.WayRelation import WayRelation, WayRelationBatch
 from selfdrive.mapd.lib.WayRelationIndex import WayRelationIndex
+from selfdrive.mapd.lib.WayRelationGrid import WayRelationGrid
 from selfdrive.mapd.lib.Route import Route
 from selfdrive.mapd.config import LANE_WIDTH
 import uuid
@@ -11,18 +12,24 @@ _ACCEPTABLE_BEARING_DELTA_IND = 0.7071067811865475  # sin(pi/4) | 45 degrees acc
 class WayCollection():
   """A collection of WayRelations to use for maps data analysis.
   """
-  def __init__(self, ways, query_center):
+  def __init__(self, ways, query_center, geometries=None):
     """Creates a WayCollection with a set of OSM way objects.
 
     Args:
         ways (Array): Collection of Way objects fetched from OSM in a radius around `query_center`
         query_center (Numpy Array): [lat, lon] numpy array in radians indicating the center of the data query.
+        geometries (Array): Optional precomputed geometry of each way, see `WayRelation`.
     """
     self.id = uuid.uuid4()
-    self.way_relations = [WayRelation(way) for way in ways]
+    if geometries is None:
+      geometries = [None] * len(ways)
+    self.way_relations = [WayRelation(way, geometry=geometry) for way, geometry in zip(ways, geometries)]
     self.query_center = query_center
 
     self.wr_index = WayRelationIndex(self.way_relations)
+    self.wr_grid = WayRelationGrid(self.way_relations)
+    self._updated_way_relations = []
+    self._batches = {}  # WayRelationBatch of the way relations of each grid cell, created on first use.
 
   def get_route(self, location_rad, bearing_rad, location_stdev):
     """Provides the best route found in the way collection based on current location and bearing.
@@ -30,13 +37,23 @@ class WayCollection():
     if location_rad is None or bearing_rad is None or location_stdev is None:
       return None
 
-    # Update all way relations in collection to the provided location and bearing.
-    for wr in self.way_relations:
-      wr.update(location_rad, bearing_rad, location_stdev)
+    # Only way relations with a bounding box overlapping the location grid cell can match the location. Clear the
+    # location of the ones updated on the previous call, as they might not be candidates anymore.
+    for wr in self._updated_way_relations:
+      wr.reset_location_variables()
+    cell = self.wr_grid.cell_at(location_rad)
+    batch = self._batches.get(cell)
+    if batch is None:
+      batch = WayRelationBatch(self.wr_grid.way_relations_in_cell(cell))
+      self._batches[cell] = batch
+    self._updated_way_relations = batch.way_relations
+
+    # Update the candidate way relations to the provided location and bearing, all at once.
+    batch.update(location_rad, bearing_rad, location_stdev)
 
     # Get the way relations where a match was found. i.e. those now marked as active as long as the direction of
     # travel is valid.
-    valid_way_relations = [wr for wr in self.way_relations if wr.active and not wr.is_prohibited]
+    valid_way_relations = [wr for wr in self._updated_way_relations if wr.active and not wr.is_prohibited]
 
     # If no active, then we could not find a current way to build a route.
     if len(valid_way_relations) == 0:
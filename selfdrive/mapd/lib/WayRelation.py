@@ -144,11 +144,19 @@ def conditional_speed_limit_for_osm_tag_limit_string(limit_string):
 class WayRelation():
   """A class that represent the relationship of an OSM way and a given `location` and `bearing` of a driving vehicle.
   """
-  def __init__(self, way, parent=None):
+  def __init__(self, way, parent=None, geometry=None):
+    """
+    Args:
+        way (overpy.Way): The OSM way.
+        parent (WayRelation): The way relation this one is a split of, if any.
+        geometry (Tuple): Precomputed (nodes_np, nodes_ids, way_distances, way_bearings) arrays of `way`, e.g. from
+          the `OSMQueryCache`. Calculated from the way nodes when not provided.
+    """
     self.way = way
     self.parent = parent
     self.parent_wr_id = parent.id if parent is not None else None  # For WRs created as splits of other WRs
     self.reset_location_variables()
+    self.reset_nodes_data()
     self.direction = DIRECTION.NONE
     self._speed_limit = None
     self._one_way = way.tags.get("oneway")
@@ -161,18 +169,21 @@ class WayRelation():
     except Exception:
       self.lanes = 2
 
-    # Create numpy arrays with nodes data to support calculations.
-    self._nodes_np = np.radians(np.array([[nd.lat, nd.lon] for nd in way.nodes], dtype=float))
-    self._nodes_ids = np.array([nd.id for nd in way .nodes], dtype=int)
+    if geometry is not None:
+      self._nodes_np, self._nodes_ids, self._way_distances, self._way_bearings = geometry
+    else:
+      # Create numpy arrays with nodes data to support calculations.
+      self._nodes_np = np.radians(np.array([[nd.lat, nd.lon] for nd in way.nodes], dtype=float))
+      self._nodes_ids = np.array([nd.id for nd in way .nodes], dtype=int)
 
-    # Get the vectors representation of the segments betwheen consecutive nodes. (N-1, 2)
-    v = vectors(self._nodes_np) * R
+      # Get the vectors representation of the segments betwheen consecutive nodes. (N-1, 2)
+      v = vectors(self._nodes_np) * R
 
-    # Calculate the vector magnitudes (or distance) between nodes. (N-1)
-    self._way_distances = np.linalg.norm(v, axis=1)
+      # Calculate the vector magnitudes (or distance) between nodes. (N-1)
+      self._way_distances = np.linalg.norm(v, axis=1)
 
-    # Calculate the bearing (from true north clockwise) for every section of the way (vectors between nodes). (N-1)
-    self._way_bearings = np.arctan2(v[:, 0], v[:, 1])
+      # Calculate the bearing (from true north clockwise) for every section of the way (vectors between nodes). (N-1)
+      self._way_bearings = np.arctan2(v[:, 0], v[:, 1])
 
     # Define bounding box to ease the process of locating a node in a way.
     # [[min_lat, min_lon], [max_lat, max_lon]]
@@ -180,7 +191,7 @@ class WayRelation():
                               np.amax(self._nodes_np, 0) + _WAY_BBOX_PADING))
 
     # Get the edge nodes ids.
-    self.edge_nodes_ids = [way.nodes[0].id, way.nodes[-1].id]
+    self.edge_nodes_ids = [int(self._nodes_ids[0]), int(self._nodes_ids[-1])]
 
   def __repr__(self):
     return f'(id: {self.id}, between {self.behind_idx} and {self.ahead_idx}, {self.direction}, active: {self.active})'
@@ -190,6 +201,12 @@ class WayRelation():
         return self.id == other.id
     return False
 
+  def reset_nodes_data(self):
+    # Node data and divertions of the way for routes, by direction. See `NodesData.way_nodes_data` and
+    # `NodesData.way_divertions`.
+    self.nodes_data = {}
+    self.divertions = {}
+
   def reset_location_variables(self):
     self.distance_to_node_ahead = 0.
     self.location_rad = None
@@ -265,32 +282,41 @@ class WayRelation():
     min_h_possible_idx = np.argmin(h_possible)
     min_delta_idx = possible_idxs[min_h_possible_idx]
 
+    self._set_location(location_rad, bearing_rad, location_stdev, min_delta_idx, is_ahead[min_delta_idx],
+                       h[min_delta_idx], abs_sin_bw_delta_possible[min_h_possible_idx],
+                       distances[min_delta_idx:min_delta_idx + 2])
+
+  def _set_location(self, location_rad, bearing_rad, location_stdev, idx, idx_is_ahead, distance_to_way,
+                    bearing_delta, distances):
+    """Populates the location variables given the chosen location between nodes `idx` and `idx + 1`, whether node
+       `idx` is ahead, the distance and bearing delta indicator to the way and the distances to both nodes.
+    """
     # - If the distance to the way is over 4 standard deviations of the gps accuracy + half the maximum road width
     # estimate, then we are way too far to stick to this way (i.e. we are not on this way anymore)
     half_road_width_estimate = self.lanes * LANE_WIDTH / 2.
-    if h_possible[min_h_possible_idx] > 4. * location_stdev + half_road_width_estimate:
+    if distance_to_way > 4. * location_stdev + half_road_width_estimate:
       return
 
     # - If the distance to the road is greater than 2 standard deviations of the gps accuracy + half the maximum road
     # width estimate then we are most likely diverting from this route.
-    diverting = h_possible[min_h_possible_idx] > 2. * location_stdev + half_road_width_estimate
+    diverting = distance_to_way > 2. * location_stdev + half_road_width_estimate
 
     # Populate location variables with result
-    if is_ahead[min_delta_idx]:
+    if idx_is_ahead:
       self.direction = DIRECTION.BACKWARD
-      self.ahead_idx = min_delta_idx
-      self.behind_idx = min_delta_idx + 1
+      self.ahead_idx = idx
+      self.behind_idx = idx + 1
     else:
       self.direction = DIRECTION.FORWARD
-      self.ahead_idx = min_delta_idx + 1
-      self.behind_idx = min_delta_idx
+      self.ahead_idx = idx + 1
+      self.behind_idx = idx
 
-    self._distance_to_way = h[min_delta_idx]
-    self._active_bearing_delta = abs_sin_bw_delta_possible[min_h_possible_idx]
+    self._distance_to_way = distance_to_way
+    self._active_bearing_delta = bearing_delta
     # TODO: The distance to node ahead currently represent the distance from the GPS fix location.
     # It would be perhaps more accurate to use the distance on the projection over the direct line between
     # the two nodes.
-    self.distance_to_node_ahead = distances[self.ahead_idx]
+    self.distance_to_node_ahead = distances[self.ahead_idx - idx]
     self.active = True
     self.diverting = diverting
     self.location_rad = location_rad
@@ -420,3 +446,67 @@ class WayRelation():
     ways = [create_way(way_ids[0], node_ids=self._nodes_ids[:idx + 1], from_way=self.way),
             create_way(way_ids[1], node_ids=self._nodes_ids[idx:], from_way=self.way)]
     return [WayRelation(way, parent=self) for way in ways]
+
+
+class WayRelationBatch():
+  """A ragged layout of the nodes of a list of WayRelations, concatenated with per way offsets. Used to update all
+  of them to a location and bearing with a few numpy calls instead of a few per way relation.
+  """
+  def __init__(self, way_relations):
+    self.way_relations = way_relations
+    if len(way_relations) == 0:
+      return
+
+    lengths = np.array([len(wr._nodes_np) for wr in way_relations])
+    self._offsets = np.concatenate(([0], np.cumsum(lengths)))
+    self._bboxes = np.array([wr.bbox for wr in way_relations])  # (M, 2, 2)
+    self._nodes_np = np.concatenate([wr._nodes_np for wr in way_relations])  # (N, 2)
+
+    # Segment arrays have an element for every pair of consecutive nodes (N - 1), including the pairs formed by the
+    # last node of a way and the first of the next one, which are never valid.
+    self._way_distances = np.concatenate([np.append(wr._way_distances, 1.) for wr in way_relations])[:-1]
+    self._way_bearings = np.concatenate([np.append(wr._way_bearings, 0.) for wr in way_relations])[:-1]
+    self._segment_wr_idxs = np.repeat(np.arange(len(way_relations)), lengths)[:-1]
+    self._valid_segments = np.ones(len(self._nodes_np) - 1, dtype=bool)
+    self._valid_segments[self._offsets[1:-1] - 1] = False
+
+  def update(self, location_rad, bearing_rad, location_stdev):
+    """Updates all the way relations with a given `location_rad` and `bearing_rad`, with the same results as
+       calling `WayRelation.update` on each one.
+    """
+    for wr in self.way_relations:
+      wr.reset_location_variables()
+
+    if len(self.way_relations) == 0:
+      return
+
+    # Ignore way relations where the location is not in the bounding box. (M)
+    in_bbox = np.all((location_rad >= self._bboxes[:, 0, :]) & (location_rad <= self._bboxes[:, 1, :]), axis=1)
+    if not np.any(in_bbox):
+      return
+
+    # See `WayRelation.update` for the details of each step, here done over the nodes of all the way relations.
+    bearings = bearing_to_points(location_rad, self._nodes_np)
+    distances = distance_to_points(location_rad, self._nodes_np)
+    is_ahead = np.cos(np.abs(bearing_rad - bearings)) >= 0.
+
+    possible = (is_ahead[:-1] != is_ahead[1:]) & self._valid_segments & in_bbox[self._segment_wr_idxs]
+    possible_idxs = np.nonzero(possible)[0]
+    if len(possible_idxs) == 0:
+      return
+
+    teta = bearings[possible_idxs + 1] - bearings[possible_idxs]
+    h_possible = distances[possible_idxs] * distances[possible_idxs + 1] * np.abs(np.sin(teta)) / \
+      self._way_distances[possible_idxs]
+    abs_sin_bw_delta_possible = np.abs(np.sin(self._way_bearings[possible_idxs] - bearing_rad))
+
+    # - Get the first possible location with the minimum distance to the way of every way relation. Sort by way
+    # relation, then distance to the way, then index. NaN distances are first, like for `np.argmin`.
+    wr_idxs = self._segment_wr_idxs[possible_idxs]
+    order = np.lexsort((np.where(np.isnan(h_possible), -np.inf, h_possible), wr_idxs))
+    order = order[np.concatenate(([True], np.diff(wr_idxs[order]) != 0))]
+
+    for i, idx, wr_idx in zip(order.tolist(), possible_idxs[order].tolist(), wr_idxs[order].tolist()):
+      self.way_relations[wr_idx]._set_location(location_rad, bearing_rad, location_stdev,
+                                               idx - self._offsets[wr_idx], is_ahead[idx], h_possible[i],
+                                               abs_sin_bw_delta_possible[i], distances[idx:idx + 2])
@@ -0,0 +1,46 @@
+import numpy as np
+from selfdrive.mapd.lib.geo import R
+
+
+_GRID_CELL_SIZE = 250. / R  # 250 mts grid cells (expressed in radians)
+
+
+class WayRelationGrid():
+  """
+  A uniform lat/lon grid indexing WayRelations by their bounding boxes. Used to find the way relations whose
+  bounding box may contain a location without checking all of them.
+  """
+  def __init__(self, way_relations, cell_size=_GRID_CELL_SIZE):
+    self._cell_size = cell_size
+    self._cells = {}
+    self._origin = np.zeros(2)
+
+    if len(way_relations) == 0:
+      return
+
+    # Cell index ranges covered by each way relation bounding box. (N, 2, 2)
+    bboxes = np.array([wr.bbox for wr in way_relations])
+    self._origin = np.amin(bboxes[:, 0, :], axis=0)
+    cell_ranges = np.floor((bboxes - self._origin) / cell_size).astype(int)
+
+    for wr, ((lat_min, lon_min), (lat_max, lon_max)) in zip(way_relations, cell_ranges):
+      for i in range(lat_min, lat_max + 1):
+        for j in range(lon_min, lon_max + 1):
+          self._cells.setdefault((i, j), []).append(wr)
+
+  def cell_at(self, location_rad):
+    """Returns the (i, j) index of the grid cell containing `location_rad`.
+    """
+    i, j = np.floor((location_rad - self._origin) / self._cell_size).astype(int)
+    return int(i), int(j)
+
+  def way_relations_in_cell(self, cell):
+    """Returns the way relations whose bounding box overlaps the grid `cell`, in the order they were provided.
+    """
+    return self._cells.get(cell, [])
+
+  def way_relations_at(self, location_rad):
+    """Returns the way relations whose bounding box overlaps the grid cell of `location_rad`, in the order they
+       were provided.
+    """
+    return self.way_relations_in_cell(self.cell_at(location_rad))
@@ -1,3 +1,4 @@
+import numpy as np
 
 
 class WayRelationIndex():
@@ -8,27 +9,80 @@ class WayRelationIndex():
     self._edge_nodes_index_dict = {}
     self._full_nodes_index_dict = {}
 
-    for wr in way_relations:
-      self.add(wr)
+    # The initial way relations of every node are kept in a CSR layout built in bulk. The way relations of
+    # `self._node_ids[i]` are `self._wr_idxs[self._offsets[i]:self._offsets[i + 1]]` indexes on `self._way_relations`,
+    # with `i` found in `self._node_rows`.
+    # Lists for the nodes in `_full_nodes_index_dict` are only created when a node is first looked up or modified.
+    self._way_relations = list(way_relations)
+    self._build_csr()
+
+    for wr in self._way_relations:
+      self._add_edge_nodes(wr)
+
+  def _build_csr(self):
+    if len(self._way_relations) == 0:
+      self._node_ids = np.array([], dtype=int)
+      self._node_rows = {}
+      self._offsets = [0]
+      self._wr_idxs = []
+      return
+
+    node_ids = np.concatenate([wr._nodes_ids for wr in self._way_relations])
+    wr_idxs = np.repeat(np.arange(len(self._way_relations)), [len(wr._nodes_ids) for wr in self._way_relations])
+
+    # A stable sort keeps the way relations of each node in insertion order.
+    order = np.argsort(node_ids, kind='stable')
+    node_ids = node_ids[order]
+    self._node_ids, starts = np.unique(node_ids, return_index=True)
+    self._node_rows = dict(zip(self._node_ids.tolist(), range(len(self._node_ids))))
+    # Plain lists are faster than numpy arrays for the small slices read on lookups.
+    self._wr_idxs = wr_idxs[order].tolist()
+    self._offsets = np.append(starts, len(node_ids)).tolist()
+
+  def _csr_bucket(self, node_id):
+    i = self._node_rows.get(node_id)
+    if i is None:
+      return []
+    return [self._way_relations[idx] for idx in self._wr_idxs[self._offsets[i]:self._offsets[i + 1]]]
+
+  def _full_bucket(self, node_id):
+    bucket = self._full_nodes_index_dict.get(node_id)
+    if bucket is None:
+      bucket = self._csr_bucket(node_id)
+      self._full_nodes_index_dict[node_id] = bucket
+    return bucket
+
+  def _add_edge_nodes(self, way_relation):
+    first_id, last_id = way_relation.edge_nodes_ids
+    for node_id in way_relation._nodes_ids.tolist():
+      if node_id == first_id or node_id == last_id:
+        self._edge_nodes_index_dict.setdefault(node_id, []).append(way_relation)
 
   def add(self, way_relation):
-    for node in way_relation.way.nodes:
-      node_id = node.id
-      self._full_nodes_index_dict[node_id] = self._full_nodes_index_dict.get(node_id, []) + [way_relation]
-      if node_id in way_relation.edge_nodes_ids:
-        self._edge_nodes_index_dict[node_id] = self._edge_nodes_index_dict.get(node_id, []) + [way_relation]
+    for node_id in way_relation._nodes_ids.tolist():
+      self._full_bucket(node_id).append(way_relation)
+    self._add_edge_nodes(way_relation)
 
   def remove(self, way_relation):
-    for node in way_relation.way.nodes:
-      node_id = node.id
-      self._full_nodes_index_dict[node_id] = [wr for wr in self._full_nodes_index_dict.get(node_id, [])
-                                              if wr is not way_relation]
-      if node_id in way_relation.edge_nodes_ids:
+    first_id, last_id = way_relation.edge_nodes_ids
+    for node_id in set(way_relation._nodes_ids.tolist()):
+      self._full_nodes_index_dict[node_id] = [wr for wr in self._full_bucket(node_id) if wr is not way_relation]
+      if node_id == first_id or node_id == last_id:
         self._edge_nodes_index_dict[node_id] = [wr for wr in self._edge_nodes_index_dict.get(node_id, [])
                                                 if wr is not way_relation]
 
+  @property
+  def node_ids(self):
+    """All the node ids in the index."""
+    return set(self._node_rows.keys()) | set(self._full_nodes_index_dict.keys())
+
   def way_relations_with_edge_node_id(self, node_id):
     return self._edge_nodes_index_dict.get(node_id, [])
 
   def way_relations_with_node_id(self, node_id):
-    return self._full_nodes_index_dict.get(node_id, [])
+    bucket = self._full_nodes_index_dict.get(node_id)
+    if bucket is None:
+      bucket = self._csr_bucket(node_id)
+      if len(bucket):
+        self._full_nodes_index_dict[node_id] = bucket
+    return bucket
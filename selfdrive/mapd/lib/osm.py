@@ -3,6 +3,11 @@ import numpy as np
 from selfdrive.mapd.lib.geo import R
 
 
+# Highway types that are not driveable roads and are left out of the queried ways.
+EXCLUDED_HIGHWAY_TYPES = ('footway', 'path', 'corridor', 'bridleway', 'steps', 'cycleway', 'construction',
+                          'bus_guideway', 'escape', 'service', 'track')
+
+
 def create_way(way_id, node_ids, from_way):
   """
   Creates and OSM Way with the given `way_id` and list of `node_ids`, copying attributes and tags from `from_way`
@@ -12,19 +17,29 @@ def create_way(way_id, node_ids, from_way):
 
 
 class OSM():
-  def __init__(self):
+  def __init__(self, tile_store=None):
+    """Fetches road ways from the Overpass API, or from `tile_store` (an `OSMTileStore`) when it covers the
+    queried area.
+    """
     self.api = overpy.Overpass()
     # self.api = overpy.Overpass(url='https://z.overpass-api.de/api/interpreter')
+    self.tile_store = tile_store
 
   def fetch_road_ways_around_location(self, lat, lon, radius):
     # Calculate the bounding box coordinates for the bbox containing the circle around location.
     bbox_angle = np.degrees(radius / R)
+    bbox = (lat - bbox_angle, lon - bbox_angle, lat + bbox_angle, lon + bbox_angle)
+
+    # Serve the ways from the local tiles when they cover the whole area, this works with no network.
+    if self.tile_store is not None and self.tile_store.covers(*bbox):
+      return self.tile_store.fetch_ways_in_bbox(*bbox)
+
     # fetch all ways and nodes on this ways in bbox
-    bbox_str = f'{str(lat - bbox_angle)},{str(lon - bbox_angle)},{str(lat + bbox_angle)},{str(lon + bbox_angle)}'
+    bbox_str = ','.join(str(v) for v in bbox)
     q = """
         way(""" + bbox_str + """)
           [highway]
-          [highway!~"^(footway|path|corridor|bridleway|steps|cycleway|construction|bus_guideway|escape|service|track)$"];
+          [highway!~"^(""" + '|'.join(EXCLUDED_HIGHWAY_TYPES) + """)$"];
         (._;>;);
         out;
         """
@@ -32,6 +47,7 @@ class OSM():
       ways = self.api.query(q).ways
     except Exception as e:
       print(f'Exception while querying OSM:\n{e}')
-      ways = []
+      # Use whatever part of the area the local tiles cover.
+      ways = self.tile_store.fetch_ways_in_bbox(*bbox) if self.tile_store is not None else []
 
     return ways
@@ -6,9 +6,13 @@ from time import strftime, gmtime
 import cereal.messaging as messaging
 from common.realtime import Ratekeeper
 from selfdrive.mapd.lib.osm import OSM
-from selfdrive.mapd.lib.geo import distance_to_points
-from selfdrive.mapd.lib.WayCollection import WayCollection
-from selfdrive.mapd.config import QUERY_RADIUS, MIN_DISTANCE_FOR_NEW_QUERY, FULL_STOP_MAX_SPEED, LOOK_AHEAD_HORIZON_TIME
+from selfdrive.mapd.lib.OSMTileStore import OSMTileStore, OSMTilePrefetcher
+from selfdrive.mapd.lib.OSMQueryCache import OSMQueryCache
+from selfdrive.mapd.lib.OSMQueryScheduler import OSMQueryScheduler
+from selfdrive.mapd.lib.geo import distance_to_points, bearing_to_points, destination_point
+from selfdrive.mapd.config import QUERY_RADIUS, MIN_DISTANCE_FOR_NEW_QUERY, FULL_STOP_MAX_SPEED, \
+  LOOK_AHEAD_HORIZON_TIME, OSM_TILES_DIR, PREFETCH_HORIZON, OSM_CACHE_DIR, OSM_CACHE_GEOHASH_PRECISION, \
+  OSM_CACHE_MAX_AGE, OSM_CACHE_MAX_BYTES, QUERY_LEAD_TIME
 
 
 _DEBUG = False
@@ -30,7 +34,13 @@ threading.excepthook = excepthook
 
 class MapD():
   def __init__(self):
-    self.osm = OSM()
+    tile_store = OSMTileStore(OSM_TILES_DIR)
+    self.osm = OSM(tile_store if tile_store.available else None)
+    self.tile_prefetcher = OSMTilePrefetcher(tile_store, QUERY_RADIUS, PREFETCH_HORIZON) \
+      if tile_store.available else None
+    self.query_scheduler = OSMQueryScheduler(self.osm, OSMQueryCache(OSM_CACHE_DIR, OSM_CACHE_MAX_AGE,
+                                                                      OSM_CACHE_MAX_BYTES),
+                                             QUERY_RADIUS, OSM_CACHE_GEOHASH_PRECISION)
     self.way_collection = None
     self.route = None
     self.last_gps_fix_timestamp = 0
@@ -41,12 +51,11 @@ class MapD():
     self.location_stdev = None  # The current location accuracy in mts. 1 standard devitation.
     self.gps_speed = 0.
     self.last_fetch_location = None
+    self.last_fetch_key = None
     self.last_route_update_fix_timestamp = 0
     self.last_publish_fix_timestamp = 0
     self._op_enabled = False
     self._disengaging = False
-    self._query_thread = None
-    self._lock = threading.RLock()
 
   def udpate_state(self, sm):
     sock = 'controlsState'
@@ -76,106 +85,122 @@ class MapD():
     self.gps_speed = log.speed
     self.location_stdev = log.accuracy  # log accuracies are presumably 1 standard deviation.
 
+    if self.tile_prefetcher is not None:
+      self.tile_prefetcher.update(log.latitude, log.longitude)
+
     _debug('Mapd: ********* Got GPS fix'
            + f'Pos: {self.location_deg} +/- {self.location_stdev * 2.} mts.\n'
            + f'Bearing: {log.bearingDeg} +/- {log.bearingAccuracyDeg * 2.} deg.\n'
            + f'timestamp: {strftime("%d-%m-%y %H:%M:%S", gmtime(self.last_gps_fix_timestamp * 1e-3))}'
            + '*******')
 
-  def _query_osm_not_blocking(self):
-    def query(osm, location_deg, location_rad, radius):
-      _debug(f'Mapd: Start query for OSM map data at {location_deg}')
-      lat, lon = location_deg
-      ways = osm.fetch_road_ways_around_location(lat, lon, radius)
-      _debug(f'Mapd: Query to OSM finished with {len(ways)} ways')
-
-      # Only issue an update if we received some ways. Otherwise it is most likely a conectivity issue.
-      # Will retry on next loop.
-      if len(ways) > 0:
-        new_way_collection = WayCollection(ways, location_rad)
-
-        # Use the lock to update the way_collection as it might be being used to update the route.
-        _debug('Mapd: Locking to write results from osm.')
-        with self._lock:
-          self.way_collection = new_way_collection
-          self.last_fetch_location = location_rad
-          _debug(f'Mapd: Updated map data @ {location_deg} - got {len(ways)} ways')
-
-        _debug('Mapd: Releasing Lock to write results from osm')
-
-    # Ignore if we have a query thread already running.
-    if self._query_thread is not None and self._query_thread.is_alive():
-      return
-
-    self._query_thread = threading.Thread(target=query, args=(self.osm, self.location_deg, self.location_rad,
-                                                              QUERY_RADIUS))
-    self._query_thread.start()
+  def _swap_way_collection(self, result):
+    # The way collection is only read and replaced from the main loop, a plain assignment swaps it atomically.
+    self.way_collection = result.way_collection
+    self.last_fetch_location = result.location_rad
+    self.last_fetch_key = result.cache_key
+    _debug(f'Mapd: Updated map data @ {result.location_deg} - got {len(result.way_collection.way_relations)} ways')
+
+  def _distance_ahead_in_query_area(self):
+    # Distance in mts from the current location to the edge of the last query area, following the current bearing.
+    # Negative when outside of it.
+    distance = distance_to_points(self.location_rad, np.array([self.last_fetch_location]))[0]
+    bearing = bearing_to_points(self.location_rad, np.array([self.last_fetch_location]))[0]
+    along = distance * np.cos(bearing - self.bearing_rad)
+    across_sq = distance**2 - along**2
+    if across_sq > QUERY_RADIUS**2:
+      return -distance
+    return along + np.sqrt(QUERY_RADIUS**2 - across_sq)
+
+  def _next_query_location(self):
+    # Predict the next query center ahead of the car, so the area behind the car is only what is needed to locate
+    # it on the new data. When stopped the bearing is unreliable, so query around the current location.
+    if self.bearing_rad is None or self.gps_speed < FULL_STOP_MAX_SPEED:
+      return self.location_deg
+
+    location = destination_point(self.location_rad, self.bearing_rad, QUERY_RADIUS - MIN_DISTANCE_FOR_NEW_QUERY)
+    return tuple(np.degrees(location))
 
   def updated_osm_data(self):
-    if self.route is not None:
-      distance_to_end = self.route.distance_to_end
-      if distance_to_end is not None and distance_to_end >= MIN_DISTANCE_FOR_NEW_QUERY:
-        # do not query as long as we have a route with enough distance ahead.
-        return
+    result = self.query_scheduler.pop_result()
+    if result is not None:
+      self._swap_way_collection(result)
 
     if self.location_rad is None:
       return
 
-    if self.last_fetch_location is not None:
-      distance_since_last = distance_to_points(self.last_fetch_location, np.array([self.location_rad]))[0]
-      if distance_since_last < QUERY_RADIUS - MIN_DISTANCE_FOR_NEW_QUERY:
-        # do not query if are still not close to the border of previous query area
+    # Without any map data, e.g. on start, load cached data right away so the route can be located on this cycle.
+    if self.way_collection is None and not self.query_scheduler.busy:
+      result = self.query_scheduler.load_cached(*self.location_deg)
+      if result is not None:
+        self._swap_way_collection(result)
         return
 
-    self._query_osm_not_blocking()
+    if self.last_fetch_location is not None and self.bearing_rad is not None:
+      # Start the next query early enough for it to finish before getting close to the edge of the current area.
+      prefetch_distance = MIN_DISTANCE_FOR_NEW_QUERY + self.gps_speed * QUERY_LEAD_TIME
 
-  def update_route(self):
-    def update_proc():
-      # Ensure we clear the route on op disengage, this way we can correct possible incorrect map data due
-      # to wrongly locating or picking up the wrong route.
-      if self._disengaging:
-        self.route = None
-        _debug('Mapd *****: Clearing Route as system is disengaging. ********')
-
-      if self.way_collection is None or self.location_rad is None or self.bearing_rad is None:
-        _debug('Mapd *****: Can not update route. Missing WayCollection, location or bearing ********')
-        return
+      if self.route is not None:
+        distance_to_end = self.route.distance_to_end
+        if distance_to_end is not None and distance_to_end >= prefetch_distance:
+          # do not query as long as we have a route with enough distance ahead.
+          return
 
-      if self.route is not None and self.last_route_update_fix_timestamp == self.last_gps_fix_timestamp:
-        _debug('Mapd *****: Skipping route update. No new fix since last update ********')
+      if self._distance_ahead_in_query_area() >= prefetch_distance:
         return
 
-      self.last_route_update_fix_timestamp = self.last_gps_fix_timestamp
+    # The prediction is done when requesting, a query in flight for an older prediction is not replaced.
+    if self.query_scheduler.busy:
+      return
 
-      # Create the route if not existent or if it was generated by an older way collection
-      if self.route is None or self.route.way_collection_id != self.way_collection.id:
-        self.route = self.way_collection.get_route(self.location_rad, self.bearing_rad, self.location_stdev)
-        _debug(f'Mapd *****: Route created: \n{self.route}\n********')
-        return
+    query_location = self._next_query_location()
+    if self.query_scheduler.query_center(*query_location)[0] == self.last_fetch_key:
+      return
 
-      # Do not attempt to update the route if the car is going close to a full stop, as the bearing can start
-      # jumping and creating unnecesary loosing of the route. Since the route update timestamp has been updated
-      # a new liveMapData message will be published with the current values (which is desirable)
-      if self.gps_speed < FULL_STOP_MAX_SPEED:
-        _debug('Mapd *****: Route Not updated as car has Stopped ********')
-        return
+    cache_key = self.query_scheduler.request(*query_location)
+    _debug(f'Mapd: Requested query for OSM map data at {query_location}, key: {cache_key}')
+
+  def update_route(self):
+    # Ensure we clear the route on op disengage, this way we can correct possible incorrect map data due
+    # to wrongly locating or picking up the wrong route.
+    if self._disengaging:
+      self.route = None
+      _debug('Mapd *****: Clearing Route as system is disengaging. ********')
+
+    if self.way_collection is None or self.location_rad is None or self.bearing_rad is None:
+      _debug('Mapd *****: Can not update route. Missing WayCollection, location or bearing ********')
+      return
+
+    if self.route is not None and self.last_route_update_fix_timestamp == self.last_gps_fix_timestamp:
+      _debug('Mapd *****: Skipping route update. No new fix since last update ********')
+      return
+
+    self.last_route_update_fix_timestamp = self.last_gps_fix_timestamp
 
-      self.route.update(self.location_rad, self.bearing_rad, self.location_stdev)
-      if self.route.located:
-        _debug(f'Mapd *****: Route updated: \n{self.route}\n********')
+    # Create the route if not existent or if it was generated by an older way collection. A route from an older
+    # collection is kept until the new one locates, so there is no gap in the published data after a swap.
+    if self.route is None or self.route.way_collection_id != self.way_collection.id:
+      route = self.way_collection.get_route(self.location_rad, self.bearing_rad, self.location_stdev)
+      if self.route is None or (route is not None and route.located):
+        self.route = route
+        _debug(f'Mapd *****: Route created: \n{self.route}\n********')
         return
 
-      # if an old route did not mange to locate, attempt to regenerate form way collection.
-      self.route = self.way_collection.get_route(self.location_rad, self.bearing_rad, self.location_stdev)
-      _debug(f'Mapd *****: Failed to update location in route. Regenerated with route: \n{self.route}\n********')
+    # Do not attempt to update the route if the car is going close to a full stop, as the bearing can start
+    # jumping and creating unnecesary loosing of the route. Since the route update timestamp has been updated
+    # a new liveMapData message will be published with the current values (which is desirable)
+    if self.gps_speed < FULL_STOP_MAX_SPEED:
+      _debug('Mapd *****: Route Not updated as car has Stopped ********')
+      return
 
-    # We use the lock when updating the route, as it reads `way_collection` which can ben updated by
-    # a new query result from the _query_thread.
-    _debug('Mapd: Locking to update route.')
-    with self._lock:
-      update_proc()
+    self.route.update(self.location_rad, self.bearing_rad, self.location_stdev)
+    if self.route.located:
+      _debug(f'Mapd *****: Route updated: \n{self.route}\n********')
+      return
 
-    _debug('Mapd: Releasing Lock to update route')
+    # if an old route did not mange to locate, attempt to regenerate form way collection.
+    self.route = self.way_collection.get_route(self.location_rad, self.bearing_rad, self.location_stdev)
+    _debug(f'Mapd *****: Failed to update location in route. Regenerated with route: \n{self.route}\n********')
 
   def publish(self, pm, sm):
     # Ensure we have a route currently located
@@ -1,13 +1,28 @@
 from selfdrive.mapd.lib.WayCollection import WayCollection
-from selfdrive.mapd.lib.geo import vectors, R
+from selfdrive.mapd.lib.geo import DIRECTION, vectors, R
 from selfdrive.mapd.lib.NodesData import _MIN_NODE_DISTANCE, _ADDED_NODES_DIST, _SPLINE_EVAL_STEP, \
-  _MIN_SPEED_SECTION_LENGTH, nodes_raw_data_array_for_wr, node_calculations, is_wr_a_valid_divertion_from_node, \
-  spline_curvature_calculations, speed_limits_for_curvatures_data
+  _MIN_SPEED_SECTION_LENGTH, node_calculations, is_wr_a_valid_divertion_from_node, spline_curvature_calculations, \
+  speed_limits_for_curvatures_data
 from scipy.interpolate import splev, splprep
 import numpy as np
 import overpy
 
 
+def nodes_raw_data_array_for_wr(wr, drop_last=False):
+  """Provides an array of raw node data (id, lat, lon, speed_limit) for all nodes in way relation, to build the
+  expected node data of routes independently of `NodesData.way_nodes_data`.
+  """
+  sl = wr.speed_limit
+  data = np.array([(n.id, n.lat, n.lon, sl) for n in wr.way.nodes], dtype=float)
+
+  # reverse the order if way direction is backwards
+  if wr.direction == DIRECTION.BACKWARD:
+    data = np.flip(data, axis=0)
+
+  # drop last if requested
+  return data[:-1] if drop_last else data
+
+
 class MockNodesData():
   def __init__(self, way_coords):
     self.degrees = np.array(way_coords)
@@ -116,7 +131,7 @@ class MockRouteData():
     # Build route divertion options data from the wr_index.
     wr_ids = [wr.id for wr in way_relations]
     self._divertions = [[wr for wr in wr_index.way_relations_with_edge_node_id(node_id)
-                        if is_wr_a_valid_divertion_from_node(wr, node_id, wr_ids)]
+                        if wr.id not in wr_ids and is_wr_a_valid_divertion_from_node(wr, node_id)]
                         for node_id in nodes_data[:, 0]]
     # Store calculcations for curvature sections speed limits. We need more than 3 points to be able to process.
     # _curvature_speed_sections_data structure: [dist_start, dist_stop, speed_limits, curv_sign]
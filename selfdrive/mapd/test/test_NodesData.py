@@ -1,9 +1,10 @@
 import unittest
 import numpy as np
+from unittest import mock
 from selfdrive.mapd.lib.geo import DIRECTION
 from selfdrive.config import Conversions as CV
 from selfdrive.mapd.lib.WayRelation import WayRelation
-from selfdrive.mapd.lib.NodesData import nodes_raw_data_array_for_wr, node_calculations, \
+from selfdrive.mapd.lib.NodesData import way_nodes_data, way_divertions, node_calculations, \
   spline_curvature_calculations, split_speed_section_by_sign, split_speed_section_by_curv_degree, speed_section, \
   speed_limits_for_curvatures_data, is_wr_a_valid_divertion_from_node, SpeedLimitSection, TurnSpeedLimitSection, \
   NodesData, NodeDataIdx
@@ -15,30 +16,32 @@ from numpy.testing import assert_array_almost_equal
 
 
 class TestNodesDataFileFunctions(unittest.TestCase):
-  def test_nodes_raw_data_array_for_wr(self):
+  def test_way_nodes_data(self):
     wr = WayRelation(mockOSMWay_01_01_LongCurvy)
-    data_e = np.array([(n.id, n.lat, n.lon, wr.speed_limit) for n in wr.way.nodes], dtype=float)
-    data = nodes_raw_data_array_for_wr(wr)
-
-    assert_array_almost_equal(data, data_e)
-
-  def test_nodes_raw_data_array_for_wr_flips_when_backwards(self):
+    wr.direction = DIRECTION.FORWARD
+    raw_e = np.array([(n.id, n.lat, n.lon) for n in wr.way.nodes], dtype=float)
+    raw, points, v, d, b = way_nodes_data(wr)
+
+    assert_array_almost_equal(raw, raw_e)
+    assert_array_almost_equal(points, np.radians(raw_e[:, [1, 2]]))
+    v_e, _, dn_e, _, b_e = node_calculations(points)
+    assert_array_almost_equal(v, v_e[1:])
+    assert_array_almost_equal(d, dn_e[:-1])
+    assert_array_almost_equal(b, b_e[:-1])
+
+    # Kept on the way relation per direction.
+    self.assertIs(way_nodes_data(wr), way_nodes_data(wr))
+    self.assertListEqual(list(wr.nodes_data), [DIRECTION.FORWARD])
+
+  def test_way_nodes_data_flips_when_backwards(self):
     wr = WayRelation(mockOSMWay_01_01_LongCurvy)
+    wr.direction = DIRECTION.FORWARD
+    raw_forward = way_nodes_data(wr)[0]
     wr.direction = DIRECTION.BACKWARD
+    raw = way_nodes_data(wr)[0]
 
-    data_e = np.array([(n.id, n.lat, n.lon, wr.speed_limit) for n in wr.way.nodes], dtype=float)
-    data_e = np.flip(data_e, axis=0)
-
-    data = nodes_raw_data_array_for_wr(wr)
-
-    assert_array_almost_equal(data, data_e)
-
-  def test_nodes_raw_data_array_for_wr_drops_last(self):
-    wr = WayRelation(mockOSMWay_01_01_LongCurvy)
-    data_e = np.array([(n.id, n.lat, n.lon, wr.speed_limit) for n in wr.way.nodes], dtype=float)[:-1]
-    data = nodes_raw_data_array_for_wr(wr, drop_last=True)
-
-    assert_array_almost_equal(data, data_e)
+    assert_array_almost_equal(raw, np.flip(raw_forward, axis=0))
+    self.assertListEqual(list(wr.nodes_data), [DIRECTION.FORWARD, DIRECTION.BACKWARD])
 
   def test_node_calculations(self):
     points = mockNodesData01.radians
@@ -145,23 +148,38 @@ class TestNodesDataFileFunctions(unittest.TestCase):
     assert_array_almost_equal(limits, expected)
 
   def test_is_wr_a_valid_divertion_from_node(self):
-    wr = WayRelation(mockOSMWay_02_01_CurvyTownWithIntersections)
     mockOSMWay_02_02_Divertion_34785115.tags['oneway'] = 'yes'
     wr_div = WayRelation(mockOSMWay_02_02_Divertion_34785115)
 
-    # False if id already in route
-    wr_ids = [wr.id, wr_div.id]
-    self.assertFalse(is_wr_a_valid_divertion_from_node(wr_div, 34785115, wr_ids))
+    # True if node_id is edge and not prohibited
+    self.assertTrue(is_wr_a_valid_divertion_from_node(wr_div, 34785115))
 
-    # True if id not in route, node_id is edge and not prohibited
-    wr_ids = [wr.id, 11111, 22222]
-    self.assertTrue(is_wr_a_valid_divertion_from_node(wr_div, 34785115, wr_ids))
+    # False if node_id is edge but prohibited (wrong direction from node 319503453)
+    self.assertFalse(is_wr_a_valid_divertion_from_node(wr_div, 319503453))
 
-    # False if id not in route, node_id is edge but prohibited (wrong direction from node 319503453)
-    self.assertFalse(is_wr_a_valid_divertion_from_node(wr_div, 319503453, wr_ids))
+    # True from either edge if not one way
+    mockOSMWay_02_02_Divertion_34785115.tags['oneway'] = 'no'
+    wr_div = WayRelation(mockOSMWay_02_02_Divertion_34785115)
+    self.assertTrue(is_wr_a_valid_divertion_from_node(wr_div, 319503453))
+
+    # False if node_id is not edge
+    self.assertFalse(is_wr_a_valid_divertion_from_node(wr_div, 44444))
+
+    # The direction of the way relation is not changed
+    self.assertEqual(wr_div.direction, DIRECTION.NONE)
+
+  def test_way_divertions(self):
+    mockRouteData_02_01.reset()
+    wr = mockRouteData_02_01.wrs[0]
+    wr_index = mockRouteData_02_01.way_collection.wr_index
+    divertions = way_divertions(wr, wr_index)
 
-    # False if id not in route, node_id is not edge
-    self.assertFalse(is_wr_a_valid_divertion_from_node(wr_div, 44444, wr_ids))
+    node_ids = way_nodes_data(wr)[0][:, 0]
+    self.assertEqual(len(divertions), len(node_ids))
+    for node_id, divs in zip(node_ids, divertions):
+      self.assertListEqual(divs, [div for div in wr_index.way_relations_with_edge_node_id(node_id)
+                                  if is_wr_a_valid_divertion_from_node(div, node_id)])
+    self.assertIs(way_divertions(wr, wr_index), divertions)
 
 
 class TestSpeedLimitSection(unittest.TestCase):
@@ -232,6 +250,43 @@ class TestNodesData(unittest.TestCase):
     num_diverstions = sum([len(d) for d in nd._divertions])
     self.assertEqual(num_diverstions, 14)
 
+  def test_init_memoizes_curvature_speed_sections(self):
+    mockRouteData_02_01.reset()
+    way_relations = mockRouteData_02_01.wrs
+    wr_index = mockRouteData_02_01.way_collection.wr_index
+    nd = NodesData(way_relations, wr_index)
+
+    # The spline is not evaluated again for a route on the same nodes.
+    with mock.patch('selfdrive.mapd.lib.NodesData.spline_curvature_calculations') as spline:
+      nd_again = NodesData(way_relations, wr_index)
+      spline.assert_not_called()
+    assert_array_almost_equal(nd_again._curvature_speed_sections_data, nd._curvature_speed_sections_data)
+
+  def test_init_reuses_way_nodes_data(self):
+    mockRouteData_02_01.reset()
+    way_relations = mockRouteData_02_01.wrs
+    wr_index = mockRouteData_02_01.way_collection.wr_index
+    nd = NodesData(way_relations, wr_index)
+
+    # A route on the ways ahead only joins the node data of the ways.
+    with mock.patch('selfdrive.mapd.lib.NodesData.vectors') as vectors:
+      nd_ahead = NodesData(way_relations[1:], wr_index)
+      vectors.assert_not_called()
+
+    start = len(way_relations[0].way.nodes) - 1
+    cols = [NodeDataIdx.node_id.value, NodeDataIdx.lat.value, NodeDataIdx.lon.value, NodeDataIdx.speed_limit.value,
+            NodeDataIdx.x.value, NodeDataIdx.y.value, NodeDataIdx.dist_next.value, NodeDataIdx.bearing.value]
+    assert_array_almost_equal(nd_ahead._nodes_data[1:, cols], nd._nodes_data[start + 1:, cols])
+    self.assertListEqual(nd_ahead._divertions[1:], nd._divertions[start + 1:])
+    self.assertListEqual(list(way_relations[1].divertions), [way_relations[1].direction])
+
+    # Distances are taken from the first node of the route.
+    dist_prev, dist_route = NodeDataIdx.dist_prev.value, NodeDataIdx.dist_route.value
+    self.assertEqual(nd_ahead._nodes_data[0, dist_prev], 0.)
+    assert_array_almost_equal(nd_ahead._nodes_data[1:, dist_prev], nd._nodes_data[start + 1:, dist_prev])
+    assert_array_almost_equal(nd_ahead._nodes_data[:, dist_route],
+                              nd._nodes_data[start:, dist_route] - nd._nodes_data[start, dist_route])
+
   def test_count(self):
     mockRouteData_02_01.reset()
     way_relations = mockRouteData_02_01.wrs
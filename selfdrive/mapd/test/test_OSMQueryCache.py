@@ -0,0 +1,84 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from selfdrive.mapd.lib.OSMQueryCache import OSMQueryCache, geohash_encode, geohash_center
+from selfdrive.mapd.lib.WayCollection import WayCollection
+from selfdrive.mapd.test.mock_data import mockOSMResponse01, mockWayCollection01
+
+
+class TestOSMQueryCache(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_geohash(self):
+    self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+    self.assertEqual(geohash_encode(52.314, 13.447, 6), 'u3399g')
+
+    lat, lon = geohash_center('u3399g')
+    self.assertEqual(geohash_encode(lat, lon, 6), 'u3399g')
+    self.assertLess(abs(lat - 52.314), 0.003)
+    self.assertLess(abs(lon - 13.447), 0.006)
+
+  def test_put_get(self):
+    cache = OSMQueryCache(self.path, 3600, 10 * 1024 * 1024)
+    self.assertIsNone(cache.get('u3399g'))
+
+    cache.put('u3399g', mockWayCollection01)
+    ways, geometries = cache.get('u3399g')
+    wc = WayCollection(ways, mockOSMResponse01.query_center, geometries)
+
+    self.assertEqual(len(wc.way_relations), len(mockWayCollection01.way_relations))
+    for wr, expected in zip(wc.way_relations, mockWayCollection01.way_relations):
+      self.assertEqual(wr.id, expected.id)
+      self.assertDictEqual(wr.way.tags, expected.way.tags)
+      self.assertListEqual([(nd.id, nd.lat, nd.lon) for nd in wr.way.nodes],
+                           [(nd.id, float(nd.lat), float(nd.lon)) for nd in expected.way.nodes])
+      np.testing.assert_array_equal(wr._nodes_np, expected._nodes_np)
+      np.testing.assert_array_equal(wr._nodes_ids, expected._nodes_ids)
+      np.testing.assert_array_equal(wr._way_distances, expected._way_distances)
+      np.testing.assert_array_equal(wr._way_bearings, expected._way_bearings)
+      self.assertListEqual(wr.edge_nodes_ids, expected.edge_nodes_ids)
+
+    # The same route is found on the cached collection.
+    expected_wr = mockWayCollection01.way_relations[10]
+    location = (expected_wr._nodes_np[0] + expected_wr._nodes_np[1]) / 2.
+    bearing = expected_wr._way_bearings[0]
+    route = wc.get_route(location, bearing, 5.)
+    expected_route = mockWayCollection01.get_route(location, bearing, 5.)
+    self.assertEqual(route.current_wr.id, expected_route.current_wr.id)
+    self.assertEqual(route.current_speed_limit, expected_route.current_speed_limit)
+
+  def test_expiry(self):
+    cache = OSMQueryCache(self.path, 3600, 10 * 1024 * 1024)
+    cache.put('u3399g', mockWayCollection01)
+    fn = os.path.join(self.path, 'u3399g.npz')
+    os.utime(fn, (time.time(), time.time() - 7200))
+
+    self.assertIsNone(cache.get('u3399g'))
+    self.assertFalse(os.path.exists(fn))
+
+  def test_size_limit(self):
+    cache = OSMQueryCache(self.path, 3600, 10 * 1024 * 1024)
+    cache.put('u3399g', mockWayCollection01)
+    size = os.path.getsize(os.path.join(self.path, 'u3399g.npz'))
+
+    # Only room for two entries, the least recently used is removed.
+    cache.max_bytes = 2 * size
+    cache.put('u3399h', mockWayCollection01)
+    now = time.time()
+    os.utime(os.path.join(self.path, 'u3399g.npz'), (now - 20, now))
+    os.utime(os.path.join(self.path, 'u3399h.npz'), (now - 10, now))
+    self.assertIsNotNone(cache.get('u3399g'))
+    cache.put('u3399j', mockWayCollection01)
+
+    self.assertListEqual(sorted(os.listdir(self.path)), ['u3399g.npz', 'u3399j.npz'])
+
+
+if __name__ == "__main__":
+  unittest.main()
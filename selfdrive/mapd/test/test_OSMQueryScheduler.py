@@ -0,0 +1,83 @@
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from selfdrive.mapd.lib.OSMQueryCache import OSMQueryCache
+from selfdrive.mapd.lib.OSMQueryScheduler import OSMQueryScheduler
+from selfdrive.mapd.test.mock_data import mockOSMResponse01
+
+
+class MockOSM():
+  def __init__(self, ways):
+    self.ways = ways
+    self.queries = []
+    self.release = threading.Event()
+    self.release.set()
+
+  def fetch_road_ways_around_location(self, lat, lon, radius):
+    self.queries.append((lat, lon))
+    self.release.wait()
+    return self.ways
+
+
+def wait_for_result(scheduler, timeout=10.):
+  t = time.monotonic()
+  while time.monotonic() - t < timeout:
+    result = scheduler.pop_result()
+    if result is not None:
+      return result
+    time.sleep(0.01)
+  return None
+
+
+class TestOSMQueryScheduler(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.osm = MockOSM(mockOSMResponse01.ways)
+    self.scheduler = OSMQueryScheduler(self.osm, OSMQueryCache(self.path, 3600, 10 * 1024 * 1024), 3000, 6)
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_request(self):
+    self.assertIsNone(self.scheduler.load_cached(52.314, 13.447))
+    cache_key = self.scheduler.request(52.314, 13.447)
+    result = wait_for_result(self.scheduler)
+
+    self.assertEqual(result.cache_key, cache_key)
+    self.assertEqual(self.scheduler.query_center(52.314, 13.447), (cache_key, result.location_deg))
+    self.assertListEqual(self.osm.queries, [result.location_deg])
+    self.assertEqual(len(result.way_collection.way_relations), len(mockOSMResponse01.ways))
+    self.assertIsNone(self.scheduler.pop_result())
+    self.assertFalse(self.scheduler.busy)
+
+    # The result was cached.
+    cached = self.scheduler.load_cached(52.314, 13.447)
+    self.assertEqual(cached.cache_key, cache_key)
+    self.assertEqual(len(cached.way_collection.way_relations), len(mockOSMResponse01.ways))
+    self.scheduler.request(52.314, 13.447)
+    self.assertIsNotNone(wait_for_result(self.scheduler))
+    self.assertEqual(len(self.osm.queries), 1)
+
+  def test_latest_request_replaces_pending(self):
+    self.osm.release.clear()
+    first_key = self.scheduler.request(52.314, 13.447)
+    while len(self.osm.queries) == 0:
+      time.sleep(0.01)
+
+    # While the first query is in flight, only the last request is kept.
+    self.scheduler.request(52.33, 13.447)
+    last_key = self.scheduler.request(52.35, 13.447)
+    self.assertTrue(self.scheduler.busy)
+    self.osm.release.set()
+
+    keys = [wait_for_result(self.scheduler).cache_key]
+    if keys[0] == first_key:
+      keys.append(wait_for_result(self.scheduler).cache_key)
+    self.assertEqual(keys[-1], last_key)
+    self.assertEqual(len(self.osm.queries), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from selfdrive.mapd.lib.osm import OSM
+from selfdrive.mapd.lib.OSMTileStore import OSMTileStore, OSMTilePrefetcher, build_tiles, tiles_in_bbox
+from selfdrive.mapd.build_osm_tiles import road_ways_from_xml
+
+MOCK_RESPONSE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_osm_response_01.xml')
+
+
+class TestOSMTileStore(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.path = tempfile.mkdtemp()
+    cls.ways = {way_id: (tags, nodes) for way_id, tags, nodes in road_ways_from_xml(MOCK_RESPONSE)}
+    build_tiles(((way_id, tags, nodes) for way_id, (tags, nodes) in cls.ways.items()), cls.path)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.path)
+
+  def test_fetch_ways_in_bbox(self):
+    store = OSMTileStore(self.path)
+    bbox = (52.30, 13.42, 52.32, 13.46)
+    ways = store.fetch_ways_in_bbox(*bbox)
+
+    # No duplicates and every way with a node in the bbox is included.
+    self.assertEqual(len(ways), len(set(way.id for way in ways)))
+    expected = [way_id for way_id, (_, nodes) in self.ways.items()
+                if any(bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3] for _, lat, lon in nodes)]
+    self.assertGreater(len(expected), 0)
+    self.assertTrue(set(expected) <= set(way.id for way in ways))
+
+    # Ways are complete, with the same tags and nodes.
+    for way in ways:
+      tags, nodes = self.ways[way.id]
+      self.assertDictEqual(way.tags, dict(tags))
+      self.assertListEqual([(nd.id, nd.lat, nd.lon) for nd in way.nodes], [(nd[0], round(nd[1], 7), round(nd[2], 7))
+                                                                          for nd in nodes])
+
+  def test_covers(self):
+    store = OSMTileStore(self.path)
+    min_lat, min_lon, max_lat, max_lon = store.bounds
+    self.assertTrue(store.covers(min_lat, min_lon, max_lat, max_lon))
+    self.assertFalse(store.covers(min_lat - 0.1, min_lon, max_lat, max_lon))
+
+    missing = OSMTileStore(os.path.join(self.path, 'missing'))
+    self.assertFalse(missing.available)
+    self.assertFalse(missing.covers(min_lat, min_lon, max_lat, max_lon))
+    self.assertListEqual(missing.fetch_ways_in_bbox(min_lat, min_lon, max_lat, max_lon), [])
+
+  def test_osm_backend(self):
+    store = OSMTileStore(self.path)
+    osm = OSM(store)
+    with mock.patch.object(osm.api, 'query', side_effect=Exception('no network')) as query:
+      # Inside the store bounds, Overpass is not queried.
+      ways = osm.fetch_road_ways_around_location(52.314, 13.447, 1000)
+      query.assert_not_called()
+      self.assertGreater(len(ways), 0)
+
+      # Outside, Overpass is queried and the ways in the store are used if it fails.
+      ways = osm.fetch_road_ways_around_location(52.314, 13.447, 10000)
+      query.assert_called_once()
+      self.assertGreater(len(ways), 0)
+
+  def test_prefetcher(self):
+    store = OSMTileStore(self.path)
+    prefetcher = OSMTilePrefetcher(store, 500, 3000)
+
+    # Driving north, the tiles 3 km ahead are loaded.
+    for i in range(5):
+      prefetcher.update(52.30 + i * 0.001, 13.44)
+      if prefetcher._thread is not None:
+        prefetcher._thread.join()
+
+    ahead = tiles_in_bbox(52.33, 13.44, 52.33, 13.44, store.zoom)[0]
+    self.assertTrue(store.is_cached(*ahead))
+    behind = tiles_in_bbox(52.27, 13.44, 52.27, 13.44, store.zoom)[0]
+    self.assertFalse(store.is_cached(*behind))
+
+
+if __name__ == "__main__":
+  unittest.main()
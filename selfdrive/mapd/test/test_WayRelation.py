@@ -5,12 +5,12 @@ from unittest import mock
 from numpy.testing import assert_array_almost_equal
 from datetime import datetime as dt, timezone, timedelta
 from selfdrive.config import Conversions as CV
-from selfdrive.mapd.lib.WayRelation import WayRelation, is_osm_time_condition_active, \
+from selfdrive.mapd.lib.WayRelation import WayRelation, WayRelationBatch, is_osm_time_condition_active, \
   conditional_speed_limit_for_osm_tag_limit_string, speed_limit_for_osm_tag_limit_string
 from selfdrive.mapd.config import LANE_WIDTH
 from selfdrive.mapd.lib.geo import DIRECTION, R, vectors
 from selfdrive.mapd.test.mock_data import mockOSMWay_01_01_LongCurvy, mockOSMWay_01_02_Loop, \
-  mockOSMWay_02_01_CurvyTownWithIntersections
+  mockOSMWay_02_01_CurvyTownWithIntersections, mockOSMResponse02
 
 
 class TestWayRelationFileFunctions(unittest.TestCase):
@@ -649,3 +649,38 @@ class TestWayRelation(unittest.TestCase):
 
   def wayRelation_mid_point_rad(self, wayRelation):
     return np.average(wayRelation.bbox, axis=0)
+
+
+class TestWayRelationBatch(unittest.TestCase):
+  def test_update_matches_way_relation_update(self):
+    wrs = [WayRelation(way) for way in mockOSMResponse02.ways]
+    expected_wrs = [WayRelation(way) for way in mockOSMResponse02.ways]
+    batch = WayRelationBatch(wrs)
+
+    # Locations on the nodes and in between them, with a few bearings and accuracies.
+    rng = np.random.default_rng(0)
+    for wr in expected_wrs[::10]:
+      for idx in range(len(wr._nodes_np) - 1):
+        location = wr._nodes_np[idx] + rng.uniform(0., 1.) * (wr._nodes_np[idx + 1] - wr._nodes_np[idx])
+        location += rng.normal(0., 5. / R, 2)
+        bearing = wr._way_bearings[idx] + rng.choice([0., np.pi, rng.uniform(-np.pi, np.pi)])
+        stdev = rng.choice([2., 10.])
+
+        batch.update(location, bearing, stdev)
+        for expected in expected_wrs:
+          expected.update(location, bearing, stdev)
+
+        for wr_b, expected in zip(wrs, expected_wrs):
+          self.assertEqual(wr_b.active, expected.active)
+          self.assertEqual(wr_b.diverting, expected.diverting)
+          self.assertEqual(wr_b.direction, expected.direction)
+          self.assertEqual(wr_b.ahead_idx, expected.ahead_idx)
+          self.assertEqual(wr_b.behind_idx, expected.behind_idx)
+          self.assertEqual(wr_b.distance_to_node_ahead, expected.distance_to_node_ahead)
+          self.assertEqual(wr_b._distance_to_way, expected._distance_to_way)
+          self.assertEqual(wr_b._active_bearing_delta, expected._active_bearing_delta)
+
+  def test_empty_batch(self):
+    batch = WayRelationBatch([])
+    batch.update(np.radians(np.array([52.3, 13.4])), 0., 5.)
+    self.assertListEqual(batch.way_relations, [])
@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+from selfdrive.mapd.lib.WayRelationGrid import WayRelationGrid
+from selfdrive.mapd.test.mock_data import mockWayCollection01, mockWayCollection02
+
+
+class TestWayRelationGrid(unittest.TestCase):
+  def test_way_relations_at(self):
+    rng = np.random.default_rng(0)
+    for wc in (mockWayCollection01, mockWayCollection02):
+      grid = WayRelationGrid(wc.way_relations)
+      bboxes = np.array([wr.bbox for wr in wc.way_relations])
+      locations = rng.uniform(np.amin(bboxes[:, 0, :], axis=0), np.amax(bboxes[:, 1, :], axis=0), (500, 2))
+
+      for location in locations:
+        candidates = grid.way_relations_at(location)
+        expected = [wr for wr in wc.way_relations if wr.is_location_in_bbox(location)]
+
+        # All the way relations containing the location are found, in collection order.
+        self.assertListEqual([wr for wr in candidates if wr.is_location_in_bbox(location)], expected)
+
+  def test_location_outside_grid(self):
+    grid = WayRelationGrid(mockWayCollection01.way_relations)
+    self.assertListEqual(grid.way_relations_at(np.radians(np.array([0., 0.]))), [])
+    self.assertListEqual(WayRelationGrid([]).way_relations_at(np.radians(np.array([52., 13.]))), [])
+
+  def test_get_route_matches_all_way_relations(self):
+    wc = mockWayCollection02
+    for wr in wc.way_relations[:100:5]:
+      location = (wr._nodes_np[0] + wr._nodes_np[1]) / 2.
+      bearing = wr._way_bearings[0]
+      route = wc.get_route(location, bearing, 5.)
+
+      # expected, updating all way relations in the collection.
+      for other_wr in wc.way_relations:
+        other_wr.update(location, bearing, 5.)
+      valid = [other_wr for other_wr in wc.way_relations if other_wr.active and not other_wr.is_prohibited]
+
+      if route is None:
+        self.assertListEqual(valid, [])
+      else:
+        self.assertIn(route.current_wr, valid)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -20,9 +20,17 @@ class TestWayRelationIndex(unittest.TestCase):
 
     # assert logic delivers same result
     self.assertDictEqual(edge_nodes_index_dict, wr_index._edge_nodes_index_dict)
-    self.assertDictEqual(full_nodes_index_dict, wr_index._full_nodes_index_dict)
+    self.assertSetEqual(set(full_nodes_index_dict.keys()), wr_index.node_ids)
+    for node_id, wrs_with_node in full_nodes_index_dict.items():
+      self.assertListEqual(wrs_with_node, wr_index.way_relations_with_node_id(node_id))
     self.assertEqual(len(wr_index._edge_nodes_index_dict), 586)
-    self.assertEqual(len(wr_index._full_nodes_index_dict), 2342)
+    self.assertEqual(len(wr_index.node_ids), 2342)
+
+    # add after init appends to the existing lists.
+    wr_index.add(wrs[0])
+    for node in wrs[0].way.nodes:
+      self.assertIs(wr_index.way_relations_with_node_id(node.id)[-1], wrs[0])
+    self.assertListEqual(wr_index.way_relations_with_node_id(-1), [])
 
   def test_remove(self):
     wrs = mockWayCollection01.way_relations
@@ -32,7 +40,7 @@ class TestWayRelationIndex(unittest.TestCase):
     affected_full_node_ids = [nd.id for nd in wr_to_remove.way.nodes]
     affected_edge_node_ids = wr_to_remove.edge_nodes_ids
 
-    initial_full_lists = [wr_index._full_nodes_index_dict[ndid] for ndid in affected_full_node_ids]
+    initial_full_lists = [wr_index.way_relations_with_node_id(ndid) for ndid in affected_full_node_ids]
     initial_edge_lists = [wr_index._edge_nodes_index_dict[ndid] for ndid in affected_edge_node_ids]
 
     expected_final_full_lists = [[wr for wr in li if wr is not wr_to_remove] for li in initial_full_lists]
@@ -40,7 +48,7 @@ class TestWayRelationIndex(unittest.TestCase):
 
     wr_index.remove(wr_to_remove)
 
-    final_full_lists = [wr_index._full_nodes_index_dict[ndid] for ndid in affected_full_node_ids]
+    final_full_lists = [wr_index.way_relations_with_node_id(ndid) for ndid in affected_full_node_ids]
     final_edge_lists = [wr_index._edge_nodes_index_dict[ndid] for ndid in affected_edge_node_ids]
 
     for idx, li in enumerate(final_full_lists):
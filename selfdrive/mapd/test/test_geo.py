@@ -1,5 +1,5 @@
 import unittest
-from selfdrive.mapd.lib.geo import vectors, ref_vectors, bearing_to_points, distance_to_points
+from selfdrive.mapd.lib.geo import vectors, ref_vectors, bearing_to_points, distance_to_points, destination_point
 import numpy as np
 from numpy.testing import assert_array_almost_equal
 from selfdrive.mapd.test.mock_data import mockNodesData01
@@ -232,3 +232,12 @@ class TestMapsdGeoLibrary(unittest.TestCase):
 
     v = distance_to_points(points[20], points)
     assert_array_almost_equal(v, expected)
+
+  def test_destination_point(self):
+    points = mockNodesData01.radians
+    bearings = bearing_to_points(points[20], points)
+    distances = distance_to_points(points[20], points)
+
+    # Travelling the distance and bearing to every point from points[20] reaches the point.
+    for point, bearing, distance in zip(points, bearings, distances):
+      assert_array_almost_equal(destination_point(points[20], bearing, distance), point, decimal=10)
@@ -0,0 +1,211 @@
+import os
+import sqlite3
+import threading
+import time
+
+from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+
+#  "dir" stores each chunk in its own file, "sqlite" keeps all of them in a single database file
+CACHE_BACKEND = os.environ.get("COMMA_CACHE_BACKEND", "dir")
+#  0 means unbounded
+CACHE_MAX_BYTES = int(os.environ.get("COMMA_CACHE_MAX_BYTES", "0"))
+#  Eviction frees space down to this fraction of the limit, so it doesn't run on every write
+EVICT_TARGET = 0.9
+
+
+class CacheStats:
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.hits = 0
+      self.misses = 0
+      self.bytes_saved = 0
+      self.bytes_downloaded = 0
+      self.evictions = 0
+
+  def record_hit(self, size):
+    with self._lock:
+      self.hits += 1
+      self.bytes_saved += size
+
+  def record_miss(self, size):
+    with self._lock:
+      self.misses += 1
+      self.bytes_downloaded += size
+
+  def record_evictions(self, count):
+    with self._lock:
+      self.evictions += count
+
+  def as_dict(self):
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / total if total else 0.,
+        'bytes_saved': self.bytes_saved,
+        'bytes_downloaded': self.bytes_downloaded,
+        'evictions': self.evictions,
+      }
+
+
+#  Counters of all URLFile cache lookups in this process
+stats = CacheStats()
+
+
+class DirectoryChunkStore:
+  """Stores each entry in its own file, evicting by least recent access time."""
+  def __init__(self, cache_dir, max_bytes=0):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._size = None
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def get(self, key):
+    try:
+      with open(self._path(key), "rb") as f:
+        dat = f.read()
+    except FileNotFoundError:
+      return None
+    if self.max_bytes:
+      #  atime isn't updated on noatime mounts
+      try:
+        os.utime(self._path(key))
+      except FileNotFoundError:
+        #  evicted by another process since it was read
+        pass
+    return dat
+
+  def put(self, key, dat):
+    mkdirs_exists_ok(self.cache_dir)
+    with atomic_write_in_dir(self._path(key), mode="wb", overwrite=True) as f:
+      f.write(dat)
+    if self.max_bytes:
+      with self._lock:
+        if self._size is None:
+          self._size = self._scan_size()
+        else:
+          self._size += len(dat)
+        if self._size > self.max_bytes:
+          self._evict()
+
+  def _entries(self):
+    entries = []
+    for f in os.scandir(self.cache_dir):
+      try:
+        st = f.stat()
+      except FileNotFoundError:
+        continue
+      #  the sqlite store may share the directory
+      if f.is_file() and not f.name.startswith(SqliteChunkStore.DB_NAME):
+        entries.append((st.st_atime, st.st_size, f.path))
+    return entries
+
+  def _scan_size(self):
+    return sum(size for _, size, _ in self._entries())
+
+  def _evict(self):
+    entries = sorted(self._entries())
+    self._size = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in entries:
+      if self._size <= self.max_bytes * EVICT_TARGET:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      self._size -= size
+      evicted += 1
+    stats.record_evictions(evicted)
+
+  def size(self):
+    return self._scan_size()
+
+
+class SqliteChunkStore:
+  """Stores all entries in a single sqlite database, instead of one file per entry."""
+  DB_NAME = "chunks.db"
+
+  def __init__(self, cache_dir, max_bytes=0):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.db_path = os.path.join(cache_dir, self.DB_NAME)
+    self._tlocal = threading.local()
+    self._lock = threading.Lock()
+    self._size = None
+
+  @property
+  def _db(self):
+    try:
+      return self._tlocal.db
+    except AttributeError:
+      mkdirs_exists_ok(self.cache_dir)
+      db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+      db.execute("PRAGMA journal_mode=WAL")
+      #  data goes last, so reading the size and atime of a row doesn't read its overflow pages
+      db.execute("CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, size INTEGER, atime REAL, data BLOB)")
+      db.execute("CREATE INDEX IF NOT EXISTS chunks_atime ON chunks (atime)")
+      self._tlocal.db = db
+      return db
+
+  def get(self, key):
+    row = self._db.execute("SELECT data FROM chunks WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      return None
+    self._db.execute("UPDATE chunks SET atime = ? WHERE key = ?", (time.time(), key))
+    return row[0]
+
+  def put(self, key, dat):
+    self._db.execute("INSERT OR REPLACE INTO chunks (key, data, size, atime) VALUES (?, ?, ?, ?)",
+                     (key, dat, len(dat), time.time()))
+    if self.max_bytes:
+      with self._lock:
+        if self._size is None:
+          self._size = self.size()
+        else:
+          self._size += len(dat)
+        if self._size > self.max_bytes:
+          self._evict()
+
+  def _evict(self):
+    db = self._db
+    self._size = self.size()
+    evict = []
+    for key, size in db.execute("SELECT key, size FROM chunks ORDER BY atime"):
+      if self._size <= self.max_bytes * EVICT_TARGET:
+        break
+      evict.append((key,))
+      self._size -= size
+    db.executemany("DELETE FROM chunks WHERE key = ?", evict)
+    stats.record_evictions(len(evict))
+
+  def size(self):
+    return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+
+
+STORES = {
+  'dir': DirectoryChunkStore,
+  'sqlite': SqliteChunkStore,
+}
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(cache_dir, backend=None, max_bytes=None):
+  """Returns the store shared by all URLFiles using the same directory and backend."""
+  backend = CACHE_BACKEND if backend is None else backend
+  max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+  with _stores_lock:
+    key = (cache_dir, backend)
+    if key not in _stores:
+      _stores[key] = STORES[backend](cache_dir, max_bytes)
+    _stores[key].max_bytes = max_bytes
+    return _stores[key]
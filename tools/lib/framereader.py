@@ -1,28 +1,36 @@
 # pylint: skip-file
+import io
 import json
+import mmap
 import os
 import pickle
 import struct
 import subprocess
+import sys
 import tempfile
 import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
 from functools import wraps
 
 import numpy as np
-from lru import LRU
 
-import _io
 from tools.lib.cache import cache_path_for_file_path
 from tools.lib.exceptions import DataUnreadableError
 from common.file_helpers import atomic_write_in_dir
 
 from tools.lib.filereader import FileReader
+from tools.lib.hevc_index import hevc_index, hevc_probe
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+# memory budget for decoded frames kept by GOPFrameReader
+FRAME_CACHE_BYTES = int(os.getenv("FRAME_CACHE_BYTES", str(256 * 1024 * 1024)))
+
 
 class GOPReader:
   def get_gop(self, num):
@@ -77,6 +85,17 @@ def ffprobe(fn, fmt=None):
 
 
 def vidindex(fn, typ):
+  if typ == "hevc":
+    with FileReader(fn) as f:
+      dat = _map_file(f)
+      try:
+        return hevc_index(dat)
+      except ValueError:
+        raise DataUnreadableError(f"vidindex failed on file {fn}")
+      finally:
+        if isinstance(dat, mmap.mmap):
+          dat.close()
+
   vidindex_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "vidindex")
   vidindex = os.path.join(vidindex_dir, "vidindex")
 
@@ -101,6 +120,14 @@ def vidindex(fn, typ):
   return index, prefix
 
 
+def _map_file(f):
+  # local files are indexed straight from the page cache, remote ones are downloaded
+  try:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (AttributeError, io.UnsupportedOperation, ValueError):
+    return f.read()
+
+
 def cache_fn(func):
   @wraps(func)
   def cache_inner(fn, *args, **kwargs):
@@ -129,10 +156,11 @@ def cache_fn(func):
 def index_stream(fn, typ):
   assert typ in ("hevc", )
 
-  with FileReader(fn) as f:
-    assert os.path.exists(f.name), fn
-    index, prefix = vidindex(f.name, typ)
-    probe = ffprobe(f.name, typ)
+  index, prefix = vidindex(fn, typ)
+  try:
+    probe = hevc_probe(prefix)
+  except ValueError:
+    raise DataUnreadableError(f"no SPS in {fn}")
 
   return {
     'index': index,
@@ -141,14 +169,22 @@ def index_stream(fn, typ):
   }
 
 
-def index_videos(camera_paths, cache_prefix=None):
-  """Requires that paths in camera_paths are contiguous and of the same type."""
+def index_videos(camera_paths, cache_prefix=None, processes=None):
+  """Requires that paths in camera_paths are contiguous and of the same type.
+     Videos are indexed in parallel, by up to processes worker processes."""
   if len(camera_paths) < 1:
     raise ValueError("must provide at least one video to index")
 
   frame_type = fingerprint_video(camera_paths[0])
-  for fn in camera_paths:
-    index_video(fn, frame_type, cache_prefix)
+  todo = [fn for fn in camera_paths if not os.path.exists(cache_path_for_file_path(fn, cache_prefix))]
+  if len(todo) <= 1 or processes == 1:
+    for fn in todo:
+      index_video(fn, frame_type, cache_prefix)
+    return
+
+  with ProcessPoolExecutor(max_workers=processes) as pool:
+    for f in [pool.submit(index_video, fn, frame_type, cache_prefix) for fn in todo]:
+      f.result()
 
 
 def index_video(fn, frame_type=None, cache_prefix=None):
@@ -158,7 +194,7 @@ def index_video(fn, frame_type=None, cache_prefix=None):
     return
 
   if frame_type is None:
-    frame_type = fingerprint_video(fn[0])
+    frame_type = fingerprint_video(fn)
 
   if frame_type == FrameType.h265_stream:
     index_stream(fn, "hevc", cache_prefix=cache_prefix)
@@ -263,30 +299,43 @@ class BaseFrameReader:
     raise NotImplementedError
 
 
-def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None):
+def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None, cache_bytes=FRAME_CACHE_BYTES):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_prefix)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind, cache_bytes=cache_bytes)
   else:
     raise NotImplementedError(frame_type)
 
 
 class RawData:
+  # frames are stored as a uint32 length followed by the bayer data, memory mapped
   def __init__(self, f):
-    self.f = _io.FileIO(f, 'rb')
-    self.lenn = struct.unpack("I", self.f.read(4))[0]
-    self.count = os.path.getsize(f) / (self.lenn+4)
+    with open(f, 'rb') as fh:
+      self.lenn = struct.unpack("I", fh.read(4))[0]
+      self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+      self.mm.madvise(mmap.MADV_SEQUENTIAL)
+    self.count = len(self.mm) // (self.lenn+4)
+    self.frames = np.ndarray((self.count, self.lenn), dtype=np.uint8, buffer=self.mm,
+                             offset=4, strides=(self.lenn+4, 1))
 
   def read(self, i):
-    self.f.seek((self.lenn+4)*i + 4)
-    return self.f.read(self.lenn)
+    # a view into the file, valid until close
+    return self.frames[i]
+
+  def close(self):
+    self.frames = None
+    self.mm.close()
 
 
 class RawFrameReader(BaseFrameReader):
+  # frames are debayered in batches, to bound the size of temporaries
+  batch_size = 32
+
   def __init__(self, fn):
     # raw camera
     self.fn = fn
@@ -295,39 +344,68 @@ class RawFrameReader(BaseFrameReader):
     self.frame_count = self.rawfile.count
     self.w, self.h = 640, 480
 
-  def load_and_debayer(self, img):
-    img = np.frombuffer(img, dtype='uint8').reshape(960, 1280)
-    cimg = np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
-    return cimg
-
-  def get(self, num, count=1, pix_fmt="yuv420p"):
+  def close(self):
+    self.rawfile.close()
+
+  def bayer(self, num, count=1):
+    """Returns a (count, 960, 1280) view of the bayer data of frames num to num+count."""
+    return self.rawfile.frames[num:num+count].reshape(count, self.h*2, self.w*2)
+
+  def load_and_debayer(self, img, out=None):
+    """Debayers one frame or a batch of frames of bayer data into rgb24, written to out if given."""
+    if not isinstance(img, np.ndarray):
+      img = np.frombuffer(img, dtype='uint8')
+    if img.ndim == 1:
+      img = img.reshape(self.h*2, self.w*2)
+    if out is None:
+      out = np.empty(img.shape[:-2] + (self.h, self.w, 3), dtype=np.uint8)
+
+    # (row pair, row in pair, column pair, column in pair), looping over frames keeps them in cache
+    quads = img.reshape(-1, self.h, 2, self.w, 2)
+    frames = out if out.ndim == 4 else out[np.newaxis]
+    green = np.empty((self.h, self.w), dtype=np.uint16)
+    for q, o in zip(quads, frames):
+      o[..., 0] = q[:, 0, :, 1]
+      np.add(q[:, 0, :, 0], q[:, 1, :, 1], out=green, dtype=np.uint16)
+      np.right_shift(green, 1, out=green)
+      o[..., 1] = green
+      o[..., 2] = q[:, 1, :, 0]
+    return out
+
+  def get(self, num, count=1, pix_fmt="yuv420p", out=None):
+    """Returns a list of count frames, or, for rgb24, fills out of shape
+       (count, h, w, 3) if given and returns it."""
     assert self.frame_count is not None
     assert num+count <= self.frame_count
 
     if pix_fmt not in ("yuv420p", "rgb24"):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
+    if out is not None and pix_fmt != "rgb24":
+      raise ValueError("out is only supported for rgb24")
 
-    app = []
-    for i in range(num, num+count):
-      dat = self.rawfile.read(i)
-      rgb_dat = self.load_and_debayer(dat)
-      if pix_fmt == "rgb24":
-        app.append(rgb_dat)
-      elif pix_fmt == "yuv420p":
-        app.append(rgb24toyuv420(rgb_dat))
-      else:
-        raise NotImplementedError
+    rgb = out if out is not None else np.empty((count, self.h, self.w, 3), dtype=np.uint8)
+    for b in range(0, count, self.batch_size):
+      n = min(self.batch_size, count - b)
+      self.load_and_debayer(self.bayer(num + b, n), out=rgb[b:b+n])
 
-    return app
+    if out is not None:
+      return out
+    if pix_fmt == "rgb24":
+      return list(rgb)
+    return [rgb24toyuv420(frame) for frame in rgb]
 
 
 class VideoStreamDecompressor:
-  def __init__(self, fn, vid_fmt, w, h, pix_fmt):
+  def __init__(self, fn, vid_fmt, w, h, pix_fmt, prefix=b"", offset=0, length=None):
+    # decodes length bytes of fn starting at offset, after prefix
     self.fn = fn
     self.vid_fmt = vid_fmt
     self.w = w
     self.h = h
     self.pix_fmt = pix_fmt
+    self.prefix = prefix
+    self.offset = offset
+    self.length = length
 
     if pix_fmt == "yuv420p":
       self.out_size = w*h*3//2  # yuv420p
@@ -343,15 +421,27 @@ class VideoStreamDecompressor:
   def write_thread(self):
     try:
       with FileReader(self.fn) as f:
-        while True:
-          r = f.read(1024*1024)
+        if self.prefix:
+          self.proc.stdin.write(self.prefix)
+        f.seek(self.offset)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+          r = f.read(1024*1024 if remaining is None else min(1024*1024, remaining))
           if len(r) == 0:
             break
           self.proc.stdin.write(r)
+          if remaining is not None:
+            remaining -= len(r)
+    except BrokenPipeError:
+      # the reader stopped early and killed ffmpeg
+      pass
     finally:
-      self.proc.stdin.close()
+      try:
+        self.proc.stdin.close()
+      except BrokenPipeError:
+        pass
 
-  def read(self):
+  def _start(self):
     threads = os.getenv("FFMPEG_THREADS", "0")
     cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
     cmd = [
@@ -373,9 +463,15 @@ class VideoStreamDecompressor:
       "pipe:1"
     ]
     self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    try:
-      self.t.start()
+    self.t.start()
 
+  def _stop(self):
+    self.proc.kill()
+    self.t.join()
+
+  def read(self):
+    self._start()
+    try:
       while True:
         dat = self.proc.stdout.read(self.out_size)
         if len(dat) == 0:
@@ -394,8 +490,35 @@ class VideoStreamDecompressor:
       result_code = self.proc.wait()
       assert result_code == 0, result_code
     finally:
-      self.proc.kill()
-      self.t.join()
+      self._stop()
+
+  def _readinto_frame(self, buf):
+    n = 0
+    while n < self.out_size:
+      r = self.proc.stdout.readinto(buf[n:])
+      if not r:
+        break
+      n += r
+    assert n in (0, self.out_size), n
+    return n > 0
+
+  def read_into(self, out, skip=0):
+    """Decodes frames straight into out, a preallocated array or list of frames,
+       after dropping the first skip frames. Returns the number of frames written."""
+    self._start()
+    try:
+      scratch = memoryview(bytearray(self.out_size))
+      for _ in range(skip):
+        if not self._readinto_frame(scratch):
+          return 0
+
+      for i in range(len(out)):
+        if not self._readinto_frame(memoryview(out[i]).cast("B")):
+          return i
+      return len(out)
+    finally:
+      self._stop()
+
 
 class StreamGOPReader(GOPReader):
   def __init__(self, fn, frame_type, index_data):
@@ -444,6 +567,13 @@ class StreamGOPReader(GOPReader):
 
     return (frame_b, frame_e, offset_b, offset_e)
 
+  def get_gop_range(self, num, count):
+    # returns (start_frame_num, offset_b, offset_e) of the consecutive gops holding frames num to num+count
+    frame_b, _, offset_b, _ = self._lookup_gop(num)
+    _, _, _, offset_e = self._lookup_gop(num + count - 1)
+    assert num >= self.first_iframe
+    return frame_b, offset_b, offset_e
+
   def get_gop(self, num):
     frame_b, frame_e, offset_b, offset_e = self._lookup_gop(num)
     assert frame_b <= num < frame_e
@@ -467,15 +597,47 @@ class StreamGOPReader(GOPReader):
     return frame_b, num_frames, skip_frames, rawdat
 
 
+class FrameCache:
+  # LRU cache of decoded frames, bounded by their total size in bytes
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._frames = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    # returns None if the frame isn't cached, lookups can race with evictions by the readahead thread
+    with self._lock:
+      frame = self._frames.get(key)
+      if frame is not None:
+        self._frames.move_to_end(key)
+      return frame
+
+  def __setitem__(self, key, frame):
+    # frame should own its memory, a view would keep its whole base array alive after being evicted
+    with self._lock:
+      if key in self._frames:
+        self.size -= self._frames.pop(key).nbytes
+      self._frames[key] = frame
+      self.size += frame.nbytes
+      while self.size > self.max_bytes and len(self._frames) > 1:
+        _, evicted = self._frames.popitem(last=False)
+        self.size -= evicted.nbytes
+
+  def __len__(self):
+    return len(self._frames)
+
+
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, cache_bytes=FRAME_CACHE_BYTES):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = FrameCache(cache_bytes)
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -513,22 +675,43 @@ class GOPFrameReader(BaseFrameReader):
       assert self.readahead_last
       num, pix_fmt = self.readahead_last
 
-      if self.readbehind:
-        for k in range(num - 1, max(0, num - self.readahead_len), -1):
-          self._get_one(k, pix_fmt)
-      else:
-        for k in range(num, min(self.frame_count, num + self.readahead_len)):
-          self._get_one(k, pix_fmt)
+      try:
+        self._readahead(num, pix_fmt)
+      except Exception:
+        # keep reading ahead on the next request, the frames are decoded again by get if needed
+        print(f"readahead of {self.fn} from frame {num} failed", file=sys.stderr)
+        traceback.print_exc()
+
+  def _readahead(self, num, pix_fmt):
+    if self.readbehind:
+      for k in range(num - 1, max(0, num - self.readahead_len), -1):
+        self._get_one(k, pix_fmt)
+      return
+
+    # decode the whole window through one ffmpeg process, holding the cache lock so
+    # get doesn't start decoding the same frames at the same time
+    with self.cache_lock:
+      end = min(self.frame_count, num + self.readahead_len)
+      while num < end and self.frame_cache.get((num, pix_fmt)) is not None:
+        num += 1
+      if num < end:
+        # decode into separate arrays, so each frame is freed on its own when evicted
+        frames = [np.empty(self._frame_shape(pix_fmt), dtype=np.uint8) for _ in range(end - num)]
+        self._decode_range(num, end - num, pix_fmt, out=frames)
+        for i, frame in enumerate(frames):
+          self.frame_cache[(num + i, pix_fmt)] = frame
 
   def _get_one(self, num, pix_fmt):
     assert num < self.frame_count
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+    frame = self.frame_cache.get((num, pix_fmt))
+    if frame is not None:
+      return frame
 
     with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+      frame = self.frame_cache.get((num, pix_fmt))
+      if frame is not None:
+        return frame
 
       frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
 
@@ -537,9 +720,58 @@ class GOPFrameReader(BaseFrameReader):
       assert ret.shape[0] == num_frames
 
       for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i].copy()
+
+      # the frame may not fit in the cache
+      return ret[num - frame_b]
+
+  def _frame_shape(self, pix_fmt):
+    if pix_fmt == "rgb24":
+      return (self.h, self.w, 3)
+    elif pix_fmt == "yuv420p":
+      return (self.w*self.h*3//2,)
+    elif pix_fmt == "yuv444p":
+      return (3, self.h, self.w)
+    raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
+
+  def _decode_range(self, num, count, pix_fmt, out=None):
+    # out is an array of count frames, or a list of count frame arrays
+    if out is None:
+      out = np.empty((count,) + self._frame_shape(pix_fmt), dtype=np.uint8)
+    frame_b, offset_b, offset_e = self.get_gop_range(num, count)
+    dec = VideoStreamDecompressor(self.fn, self.vid_fmt, self.w, self.h, pix_fmt,
+                                  prefix=self.prefix, offset=offset_b, length=offset_e - offset_b)
+    decoded = dec.read_into(out, skip=num - frame_b)
+    if decoded != count:
+      raise DataUnreadableError(f"ffmpeg decoded {decoded} of {count} frames from {self.fn}")
+    return out
+
+  def get_range(self, num, count, pix_fmt="yuv420p", out=None):
+    """Returns count consecutive frames from num as a single array of shape
+       (count, *frame shape), decoded through one ffmpeg process. If out is
+       given the frames are written to it."""
+    assert self.frame_count is not None
+
+    if num + count > self.frame_count:
+      raise ValueError(f"{num + count} > {self.frame_count}")
+
+    shape = (count,) + self._frame_shape(pix_fmt)
+    if out is None:
+      out = np.empty(shape, dtype=np.uint8)
+    elif out.shape != shape:
+      raise ValueError(f"out has shape {out.shape}, expected {shape}")
 
-      return self.frame_cache[(num, pix_fmt)]
+    # frames at the start of the range may already be cached, e.g. by readahead
+    i = 0
+    while i < count:
+      frame = self.frame_cache.get((num + i, pix_fmt))
+      if frame is None:
+        break
+      out[i] = frame
+      i += 1
+    if i < count:
+      self._decode_range(num + i, count - i, pix_fmt, out=out[i:])
+    return out
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -562,9 +794,9 @@ class GOPFrameReader(BaseFrameReader):
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, cache_bytes=FRAME_CACHE_BYTES):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, cache_bytes)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
@@ -577,5 +809,5 @@ def FrameIterator(fn, pix_fmt, **kwargs):
   if isinstance(fr, GOPReader):
     yield from GOPFrameIterator(fr, pix_fmt)
   else:
-    for i in range(fr.frame_count):
-      yield fr.get(i, pix_fmt=pix_fmt)[0]
+    for i in range(0, fr.frame_count, fr.batch_size):
+      yield from fr.get(i, min(fr.batch_size, fr.frame_count - i), pix_fmt=pix_fmt)
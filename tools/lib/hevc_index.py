@@ -0,0 +1,147 @@
+import numpy as np
+
+# Table 7-1
+HEVC_NAL_TYPE_BLA_W_LP = 16
+HEVC_NAL_TYPE_RSV_IRAP_VCL23 = 23
+HEVC_NAL_TYPE_VPS_NUT = 32
+HEVC_NAL_TYPE_SPS_NUT = 33
+HEVC_NAL_TYPE_PPS_NUT = 34
+
+# trailing, leading and irap slices
+HEVC_SLICE_NAL_TYPES = np.array(list(range(0, 10)) + list(range(16, 22)))
+HEVC_PREFIX_NAL_TYPES = np.array([HEVC_NAL_TYPE_VPS_NUT, HEVC_NAL_TYPE_SPS_NUT, HEVC_NAL_TYPE_PPS_NUT])
+
+
+class BitReader:
+  def __init__(self, dat):
+    self.dat = dat
+    self.pos = 0
+
+  def u(self, n):
+    ret = 0
+    for _ in range(n):
+      byte = self.dat[self.pos // 8] if self.pos // 8 < len(self.dat) else 0
+      ret = (ret << 1) | ((byte >> (7 - self.pos % 8)) & 1)
+      self.pos += 1
+    return ret
+
+  def ue(self):
+    zeros = 0
+    while self.u(1) == 0 and zeros < 32:
+      zeros += 1
+    return (1 << zeros) - 1 + self.u(zeros)
+
+
+def _rbsp(nal):
+  # removes emulation prevention bytes, 00 00 03 -> 00 00
+  return nal.replace(b"\x00\x00\x03", b"\x00\x00")
+
+
+def _skip_profile_tier_level(bs, max_sub_layers_minus1):
+  bs.u(96)  # general profile, tier and level
+  sub_layer_profile_present = []
+  sub_layer_level_present = []
+  for _ in range(max_sub_layers_minus1):
+    sub_layer_profile_present.append(bs.u(1))
+    sub_layer_level_present.append(bs.u(1))
+  if max_sub_layers_minus1 > 0:
+    bs.u(2 * (8 - max_sub_layers_minus1))
+  for profile_present, level_present in zip(sub_layer_profile_present, sub_layer_level_present):
+    bs.u(88 * profile_present + 8 * level_present)
+
+
+def parse_sps(nal):
+  """Returns the cropped (width, height) from an SPS nal unit, including its start code."""
+  bs = BitReader(_rbsp(bytes(nal[3:])))
+  bs.u(16)  # nal_unit_header
+  bs.u(4)  # sps_video_parameter_set_id
+  max_sub_layers_minus1 = bs.u(3)
+  bs.u(1)  # sps_temporal_id_nesting_flag
+  _skip_profile_tier_level(bs, max_sub_layers_minus1)
+  bs.ue()  # sps_seq_parameter_set_id
+  chroma_format_idc = bs.ue()
+  separate_colour_plane = bs.u(1) if chroma_format_idc == 3 else 0
+  width = bs.ue()
+  height = bs.ue()
+
+  if bs.u(1):  # conformance_window_flag
+    left, right, top, bottom = bs.ue(), bs.ue(), bs.ue(), bs.ue()
+    # Table 6-1
+    sub_width = 2 if chroma_format_idc in (1, 2) and not separate_colour_plane else 1
+    sub_height = 2 if chroma_format_idc == 1 and not separate_colour_plane else 1
+    width -= sub_width * (left + right)
+    height -= sub_height * (top + bottom)
+  return width, height
+
+
+def _nal_starts(buf, size):
+  # offsets of all 00 00 01 start codes, the same ones the vidindex scan finds
+  ones = np.flatnonzero(buf[2:size - 2] == 1)
+  return ones[(buf[ones] == 0) & (buf[ones + 1] == 0)]
+
+
+def _read_ue(words, bit_offsets):
+  # decodes an exp-golomb code starting bit_offsets into each big endian uint32 in words
+  v = (words << bit_offsets.astype(np.uint64)) & 0xFFFFFFFF
+  v = np.maximum(v, 1)
+  leading_zeros = 31 - np.floor(np.log2(v.astype(np.float64))).astype(np.int64)
+  code_len = 2 * leading_zeros + 1
+  return (v >> np.maximum(32 - code_len, 0).astype(np.uint64)) - 1
+
+
+def hevc_index(dat):
+  """Indexes an hevc elementary stream in a buffer (bytes or an mmap).
+
+     Returns the same (index, prefix) as the vidindex tool: index is an (n+1, 2) uint32
+     array of (slice type, offset) for each frame, ending with (0xFFFFFFFF, size), and
+     prefix is the VPS, SPS and PPS nal units."""
+  buf = np.frombuffer(dat, dtype=np.uint8)
+  size = len(buf)
+  if size <= 4 or buf[0] != 0 or bytes(buf[1:4]) != b"\x00\x00\x01":
+    raise ValueError("not an hevc stream")
+
+  starts = _nal_starts(buf, size)
+  starts = starts[starts >= 1]
+  # the last nal unit ends where the scan for the next start code stops
+  ends = np.append(starts[1:], max(size - 4, starts[-1] + 1))
+  short = np.flatnonzero(ends - starts < 6)
+  if len(short):
+    starts, ends = starts[:short[0]], ends[:short[0]]
+
+  nal_types = (buf[starts + 3] >> 1) & 0x3F
+
+  is_prefix = np.isin(nal_types, HEVC_PREFIX_NAL_TYPES)
+  prefix = b"".join(bytes(buf[b:e]) for b, e in zip(starts[is_prefix], ends[is_prefix]))
+
+  # slice_segment_header, only the first slice of each picture is indexed
+  is_slice = np.isin(nal_types, HEVC_SLICE_NAL_TYPES)
+  slice_starts, slice_types = starts[is_slice], nal_types[is_slice]
+  first_slice = (buf[slice_starts + 5] & 0x80) != 0
+  slice_starts, slice_types = slice_starts[first_slice], slice_types[first_slice]
+
+  # after first_slice_segment_in_pic_flag, no_output_of_prior_pics_flag for irap
+  # slices, and slice_pic_parameter_set_id, which vidindex reads as a single bit
+  irap = (slice_types >= HEVC_NAL_TYPE_BLA_W_LP) & (slice_types <= HEVC_NAL_TYPE_RSV_IRAP_VCL23)
+  bit_offsets = np.where(irap, 3, 2)
+  word_bytes = np.minimum(slice_starts[:, None] + np.arange(5, 9), size - 1)
+  words = buf[word_bytes].astype(np.uint64) @ np.array([1 << 24, 1 << 16, 1 << 8, 1], dtype=np.uint64)
+
+  index = np.empty((len(slice_starts) + 1, 2), dtype=np.uint32)
+  index[:-1, 0] = _read_ue(words, bit_offsets)
+  index[:-1, 1] = slice_starts
+  index[-1] = (0xFFFFFFFF, size)
+  return index, prefix
+
+
+def hevc_probe(prefix):
+  """Returns the parts of ffprobe's output the frame readers use, from the stream's prefix."""
+  starts = _nal_starts(np.frombuffer(prefix + b"\x00" * 4, dtype=np.uint8), len(prefix) + 4)
+  ends = np.append(starts[1:], len(prefix))
+  for b, e in zip(starts, ends):
+    if (prefix[b + 3] >> 1) & 0x3F == HEVC_NAL_TYPE_SPS_NUT:
+      width, height = parse_sps(prefix[b:e])
+      return {
+        'streams': [{'codec_name': 'hevc', 'codec_type': 'video', 'width': width, 'height': height}],
+        'format': {'format_name': 'hevc'},
+      }
+  raise ValueError("no SPS in hevc prefix")
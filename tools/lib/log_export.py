@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from cereal import log as capnp_log
+from tools.lib.logreader import LogReader
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+  pq = None
+
+# how deep nested structs are flattened into columns
+MAX_DEPTH = 3
+DONE_DIR = "_done"
+# written to the marker of a log exported with all its services
+ALL_SERVICES = "*"
+
+if pa is not None:
+  ARROW_TYPES = {
+    'bool': pa.bool_(),
+    'int8': pa.int8(), 'int16': pa.int16(), 'int32': pa.int32(), 'int64': pa.int64(),
+    'uint8': pa.uint8(), 'uint16': pa.uint16(), 'uint32': pa.uint32(), 'uint64': pa.uint64(),
+    'float32': pa.float32(), 'float64': pa.float64(),
+    'text': pa.string(), 'enum': pa.string(),
+  }
+
+
+def _check_pyarrow():
+  if pa is None:
+    raise ImportError("exporting logs requires pyarrow, install it with `pip install pyarrow`")
+
+
+def _field_columns(schema, path=(), depth=0):
+  """Returns (name, path, arrow type, is_list) for each column of a capnp struct schema.
+     Each step of the path is (field name, is union member)."""
+  columns = []
+  for name in schema.fieldnames:
+    if name.endswith("DEPRECATED"):
+      continue
+    field = schema.fields[name]
+    proto = field.proto
+    step = path + ((name, proto.discriminantValue != 0xffff),)
+
+    if proto.which() == 'group':
+      if depth < MAX_DEPTH:
+        columns += _field_columns(field.schema, step, depth + 1)
+      continue
+
+    typ = proto.slot.type.which()
+    if typ in ARROW_TYPES:
+      columns.append((".".join(s[0] for s in step), step, ARROW_TYPES[typ], False))
+    elif typ == 'list':
+      element_type = proto.slot.type.list.elementType.which()
+      if element_type in ARROW_TYPES:
+        columns.append((".".join(s[0] for s in step), step, pa.list_(ARROW_TYPES[element_type]), True))
+    elif typ == 'struct' and depth < MAX_DEPTH:
+      columns += _field_columns(field.schema, step, depth + 1)
+  return columns
+
+
+def _get_value(msg, path, is_list):
+  obj = msg
+  for name, is_union in path:
+    if is_union and obj.which() != name:
+      return None
+    obj = getattr(obj, name)
+
+  if is_list:
+    return [v if isinstance(v, (bool, int, float, str)) else str(v) for v in obj]
+  if isinstance(obj, (bool, int, float, str)):
+    return obj
+  return str(obj)  # enums
+
+
+@lru_cache(maxsize=None)
+def service_columns(service):
+  """Returns the flattened columns of a service, see _field_columns."""
+  _check_pyarrow()
+  event_schema = capnp_log.Event.schema
+  columns = [
+    ("logMonoTime", (("logMonoTime", False),), pa.uint64(), False),
+    ("valid", (("valid", False),), pa.bool_(), False),
+  ]
+  field = event_schema.fields[service]
+  typ = field.proto.slot.type.which()
+  # lists of structs like can and sendcan only get the columns above
+  if typ == 'struct':
+    # the tables are per service already, leave it out of the column names
+    columns += [(name.split(".", 1)[1], path, t, is_list)
+                for name, path, t, is_list in _field_columns(field.schema, ((service, True),))]
+  elif typ in ARROW_TYPES:
+    columns.append((service, ((service, True),), ARROW_TYPES[typ], False))
+  return columns
+
+
+def events_to_tables(events, services=None):
+  """Converts capnp events to one arrow table per service, with a column per scalar field.
+     Nested structs are flattened into dotted names like cruiseState.speed, lists of
+     scalars become list columns and lists of structs are left out."""
+  _check_pyarrow()
+  by_service = {}
+  for msg in events:
+    service = msg.which()
+    if services is None or service in services:
+      by_service.setdefault(service, []).append(msg)
+
+  tables = {}
+  for service, msgs in by_service.items():
+    columns = service_columns(service)
+    arrays = [pa.array([_get_value(m, path, is_list) for m in msgs], type=typ) for _, path, typ, is_list in columns]
+    tables[service] = pa.Table.from_arrays(arrays, names=[c[0] for c in columns])
+  return tables
+
+
+def exported_services(out_dir, name):
+  """Returns the set of services a log was exported with, which holds ALL_SERVICES
+     if it was exported with all of them, or None if it wasn't exported."""
+  try:
+    with open(os.path.join(out_dir, DONE_DIR, name)) as f:
+      return set(f.read().split())
+  except FileNotFoundError:
+    return None
+
+
+def is_exported(out_dir, name, services=None):
+  exported = exported_services(out_dir, name)
+  if exported is None:
+    return False
+  return ALL_SERVICES in exported or (services is not None and set(services) <= exported)
+
+
+def export_log(log_path, out_dir, name, services=None):
+  """Writes out_dir/<service>/<name>.parquet for each service in the log."""
+  tables = events_to_tables(LogReader(log_path, services=services), services)
+  for service, table in tables.items():
+    os.makedirs(os.path.join(out_dir, service), exist_ok=True)
+    fn = os.path.join(out_dir, service, f"{name}.parquet")
+    pq.write_table(table, fn + ".tmp")
+    os.replace(fn + ".tmp", fn)
+
+  # marks the log as exported with these services, so logs without some of them aren't exported again
+  if services is None:
+    done = {ALL_SERVICES}
+  else:
+    done = set(services) | (exported_services(out_dir, name) or set())
+  os.makedirs(os.path.join(out_dir, DONE_DIR), exist_ok=True)
+  fn = os.path.join(out_dir, DONE_DIR, name)
+  with open(fn + ".tmp", "w") as f:
+    f.write("\n".join(sorted(done)))
+  os.replace(fn + ".tmp", fn)
+  return name
+
+
+def export_logs(log_paths, out_dir, services=None, processes=None, names=None):
+  """Exports logs to parquet in parallel, one file per log and service.
+
+     Logs are named by their index in log_paths unless names is given, so the
+     list from Route.log_paths() gives one file per segment number. Logs that were
+     already exported to out_dir with the requested services are skipped, so new
+     segments can be appended."""
+  _check_pyarrow()
+  if names is None:
+    names = [f"{i:05d}" for i in range(len(log_paths))]
+  todo = [(p, n) for p, n in zip(log_paths, names) if p is not None and not is_exported(out_dir, n, services)]
+  if not todo:
+    return []
+
+  with ProcessPoolExecutor(max_workers=processes) as pool:
+    futures = [pool.submit(export_log, p, out_dir, n, services) for p, n in todo]
+    return [f.result() for f in futures]
+
+
+def load_table(out_dir, service, columns=None):
+  """Reads the exported logs of a service back as a single arrow table, in log order."""
+  _check_pyarrow()
+  service_dir = os.path.join(out_dir, service)
+  files = sorted(f for f in os.listdir(service_dir) if f.endswith(".parquet"))
+  tables = [pq.read_table(os.path.join(service_dir, f), columns=columns) for f in files]
+  return pa.concat_tables(tables)
+
+
+def load_columns(out_dir, service, columns):
+  """Returns the given scalar columns of a service as numpy arrays, e.g.
+     load_columns(out_dir, "carState", ["vEgo"])["vEgo"]."""
+  table = load_table(out_dir, service, columns)
+  return {c: np.asarray(table.column(c).to_numpy()) for c in columns}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Export rlogs or qlogs to one parquet table per service")
+  parser.add_argument("out_dir")
+  parser.add_argument("log_paths", nargs="+")
+  parser.add_argument("--services", nargs="+", help="only export these services")
+  parser.add_argument("-j", "--processes", type=int, default=None)
+  args = parser.parse_args()
+
+  exported = export_logs(args.log_paths, args.out_dir, args.services, args.processes)
+  print(f"exported {len(exported)} logs to {args.out_dir}")
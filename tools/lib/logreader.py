@@ -2,31 +2,386 @@
 import os
 import sys
 import bz2
+import mmap
+import struct
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
 import capnp
+import numpy as np
 
+from common.file_helpers import atomic_write_in_dir
+from tools.lib.cache import cache_path_for_file_path
 from tools.lib.filereader import FileReader
+from tools.lib.url_file import URLFile
 from cereal import log as capnp_log
 
+STREAM_CHUNK_SIZE = 1024 * 1024
+PREFETCH_MAX_BYTES = 2 * 1024 * 1024 * 1024
+LOG_CACHE_MAX_BYTES = int(os.getenv("LOG_CACHE_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))
+LOG_CACHE_DATA_SUFFIX = ".log"
+LOG_CACHE_INDEX_SUFFIX = ".log_index.npy"
+
+_EVENT_STRUCT = capnp_log.Event.schema.node.struct
+# byte offset of the union discriminant in the data section of an Event
+_EVENT_DISCRIMINANT_OFFSET = _EVENT_STRUCT.discriminantOffset * 2
+# byte offset of logMonoTime in the data section of an Event
+_EVENT_LOG_MONO_TIME_OFFSET = next(f.slot.offset for f in _EVENT_STRUCT.fields if f.name == "logMonoTime") * 8
+# segment count - 1 and size of the first segment
+_FRAME_HEADER = struct.Struct("<II")
+EVENT_SERVICES = {f.name: f.discriminantValue for f in _EVENT_STRUCT.fields if f.discriminantValue != 0xffff}
+# service of events with a union type missing from the local schema, never selected by a services filter
+UNKNOWN_SERVICE = 0xffff
+FRAME_TABLE_DTYPE = np.dtype([('offset', np.int64), ('size', np.int64), ('service', np.uint16), ('logMonoTime', np.int64)])
+
+def _capnp_frame_size(dat, offset=0):
+  """Returns the header size and total size in bytes of the capnp message starting
+     at offset, or None if the buffer doesn't hold the full segment table yet."""
+  if len(dat) - offset < 4:
+    return None
+  n_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  header_size = 4 * (n_segments + 1)
+  header_size += header_size % 8
+  if len(dat) - offset < header_size:
+    return None
+  segment_sizes = struct.unpack_from(f"<{n_segments}I", dat, offset + 4)
+  return header_size, header_size + 8 * sum(segment_sizes)
+
+def _iter_frames(dat):
+  """Yields (offset, header_size, size) for each complete capnp message in dat."""
+  offset = 0
+  while True:
+    sizes = _capnp_frame_size(dat, offset)
+    if sizes is None or offset + sizes[1] > len(dat):
+      return
+    yield offset, sizes[0], sizes[1]
+    offset += sizes[1]
+
+def _complete_frames_end(dat):
+  """Returns the offset just past the last complete capnp message in dat."""
+  end = 0
+  for offset, _, size in _iter_frames(dat):
+    end = offset + size
+  return end
+
+def _service_discriminants(services):
+  unknown = set(services) - EVENT_SERVICES.keys()
+  if unknown:
+    raise ValueError(f"unknown services {sorted(unknown)}")
+  return {EVENT_SERVICES[s] for s in services}
+
+def _frame_table(dat):
+  """Locates the complete capnp messages in dat and reads their Event union
+     discriminant and logMonoTime, without building capnp readers for them."""
+  # walk the message headers, almost all events are single segment messages
+  starts, ends = [], []
+  multi_segment = []
+  unpack_header = _FRAME_HEADER.unpack_from
+  offset, n = 0, len(dat)
+  while offset + 16 <= n:
+    n_segments, segment_size = unpack_header(dat, offset)
+    if n_segments == 0:
+      end = offset + 8 + 8 * segment_size
+      if end > n:
+        break
+    else:
+      sizes = _capnp_frame_size(dat, offset)
+      if sizes is None or offset + sizes[1] > n:
+        break
+      multi_segment.append(len(starts))
+      end = offset + sizes[1]
+    starts.append(offset)
+    ends.append(end)
+    offset = end
+
+  table = np.zeros(len(starts), dtype=FRAME_TABLE_DTYPE)
+  if not starts:
+    return table
+  table['offset'] = starts
+  table['size'] = np.array(ends, dtype=np.int64) - table['offset']
+
+  # then read the fields of all single segment messages at once
+  starts_np = table['offset']
+  ptr_offset = np.frombuffer(dat, dtype="<i4", count=n // 4)[(starts_np + 8) // 4]
+  data_words = np.frombuffer(dat, dtype="<u2", count=n // 2)[(starts_np + 12) // 2].astype(np.int64)
+  data_start = starts_np + 16 + (ptr_offset.astype(np.int64) >> 2) * 8
+  struct_ptr = (ptr_offset & 3) == 0
+  # fields outside of a truncated data section have their default value
+  has_discriminant = struct_ptr & (data_words * 8 >= _EVENT_DISCRIMINANT_OFFSET + 2)
+  disc_idx = np.where(has_discriminant, np.clip((data_start + _EVENT_DISCRIMINANT_OFFSET) // 2, 0, n // 2 - 1), 0)
+  table['service'] = np.where(has_discriminant, np.frombuffer(dat, dtype="<u2", count=n // 2)[disc_idx], 0)
+  has_mono_time = struct_ptr & (data_words >= _EVENT_LOG_MONO_TIME_OFFSET // 8 + 1)
+  mono_idx = np.where(has_mono_time, np.clip((data_start + _EVENT_LOG_MONO_TIME_OFFSET) // 8, 0, n // 8 - 1), 0)
+  table['logMonoTime'] = np.where(has_mono_time, np.frombuffer(dat, dtype="<i8", count=n // 8)[mono_idx], 0)
+
+  # multi segment messages and unusual root pointers, let capnp decode those
+  for i in set(multi_segment) | set(np.flatnonzero(~struct_ptr).tolist()):
+    ev = next(capnp_log.Event.read_multiple_bytes(dat[starts[i]:ends[i]]))
+    try:
+      table['service'][i] = EVENT_SERVICES[ev.which()]
+    except capnp.lib.capnp.KjException:
+      table['service'][i] = UNKNOWN_SERVICE
+    table['logMonoTime'][i] = ev.logMonoTime
+  return table
+
+def _join_frames(dat, table):
+  mv = memoryview(dat)
+  ret = b"".join([mv[offset:offset + size] for offset, size in zip(table['offset'].tolist(), table['size'].tolist())])
+  mv.release()
+  return ret
+
+def _read_frames(dat, table):
+  """Returns the events of the table rows, read in place from dat without copying
+     them out of it. Runs of adjacent frames are read together."""
+  if not len(table):
+    return []
+  starts, ends = table['offset'], table['offset'] + table['size']
+  breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+  run_starts = starts[np.concatenate(([0], breaks))].tolist()
+  run_ends = ends[np.concatenate((breaks - 1, [len(table) - 1]))].tolist()
+  mv = memoryview(dat)
+  ents = []
+  for start, end in zip(run_starts, run_ends):
+    ents.extend(capnp_log.Event.read_multiple_bytes(mv[start:end]))
+  return ents
+
+def _filter_frames(dat, discriminants):
+  """Returns the concatenated capnp messages of dat whose Event union type is in
+     discriminants, and the offset just past the last complete message."""
+  table = _frame_table(dat)
+  if not len(table):
+    return b"", 0
+  keep = table[np.isin(table['service'], list(discriminants))]
+  return _join_frames(dat, keep), int(table['offset'][-1] + table['size'][-1])
+
+def _read_chunks(f, ext, chunk_size):
+  """Yields decompressed chunks of the log file, reading chunk_size bytes at a time."""
+  decompressor = bz2.BZ2Decompressor() if ext == ".bz2" else None
+  while True:
+    dat = f.read(chunk_size)
+    if not dat:
+      break
+    if decompressor is None:
+      yield dat
+      continue
+
+    while dat:
+      yield decompressor.decompress(dat)
+      if not decompressor.eof:
+        break
+      # logs can be made of multiple concatenated bz2 streams
+      dat = decompressor.unused_data
+      decompressor = bz2.BZ2Decompressor()
+
+def stream_events(fn, chunk_size=STREAM_CHUNK_SIZE, services=None):
+  """Generator over the events in a log, decompressing and parsing incrementally.
+
+     Only one chunk of the log is buffered at a time, so memory usage does not
+     grow with the length of the log. If services is given, events of other
+     types are skipped without being decoded."""
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ("", ".bz2"):
+    raise Exception(f"unknown extension {ext}")
+  discriminants = _service_discriminants(services) if services is not None else None
+
+  with FileReader(fn) as f:
+    buf = b""
+    for dat in _read_chunks(f, ext, chunk_size):
+      buf += dat
+      if discriminants is None:
+        end = _complete_frames_end(buf)
+        frames = buf[:end]
+      else:
+        frames, end = _filter_frames(buf, discriminants)
+      if len(frames):
+        yield from capnp_log.Event.read_multiple_bytes(frames)
+      buf = buf[end:]
+
+  if len(buf):
+    raise Exception(f"log {fn} ends with a truncated message ({len(buf)} bytes)")
+
+def read_log_bytes(fn, services=None):
+  """Reads and decompresses a log, returning the raw capnp messages.
+
+     Plain bytes can be sent between processes, unlike capnp readers."""
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  with FileReader(fn) as f:
+    dat = f.read()
+
+  if ext == "":
+    # old rlogs weren't bz2 compressed
+    pass
+  elif ext == ".bz2":
+    dat = bz2.decompress(dat)
+  else:
+    raise Exception(f"unknown extension {ext}")
+
+  if services is not None:
+    # skip decoding unwanted events, a truncated message at the end is kept so it still fails to parse
+    frames, end = _filter_frames(dat, _service_discriminants(services))
+    dat = frames + dat[end:]
+  return dat
+
+def _evict_log_cache(cache_dir, max_bytes, keep=None):
+  """Removes the least recently used cached logs until the cache is under max_bytes."""
+  entries = []
+  for f in os.scandir(cache_dir):
+    if not f.name.endswith(LOG_CACHE_INDEX_SUFFIX):
+      continue
+    base = f.path[:-len(LOG_CACHE_INDEX_SUFFIX)]
+    try:
+      size = f.stat().st_size + os.path.getsize(base + LOG_CACHE_DATA_SUFFIX)
+    except FileNotFoundError:
+      continue
+    entries.append((f.stat().st_mtime, size, base))
+
+  total = sum(size for _, size, _ in entries)
+  for _, size, base in sorted(entries):
+    if total <= max_bytes:
+      break
+    if base == keep:
+      continue
+    # remove the index first, it marks the entry as complete
+    for suffix in (LOG_CACHE_INDEX_SUFFIX, LOG_CACHE_DATA_SUFFIX):
+      try:
+        os.remove(base + suffix)
+      except FileNotFoundError:
+        pass
+    total -= size
+
+def _log_source_version(fn):
+  """Returns the size and mtime of a log file, or its Content-Length for urls, to detect changed sources."""
+  with FileReader(fn) as f:
+    if isinstance(f, URLFile):
+      return np.array([f.get_length_online(), -1], dtype=np.int64)
+    st = os.fstat(f.fileno())
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+def _load_log_cache_index(index_path, source_version=None):
+  """Returns the table of a cached log, or None if it isn't cached or was cached from another version
+     of it. The version isn't checked if source_version is None."""
+  try:
+    with open(index_path, "rb") as f:
+      cached_version = np.load(f)
+      if source_version is not None and not np.array_equal(cached_version, source_version):
+        return None
+      return np.load(f)
+  except (FileNotFoundError, EOFError, ValueError):
+    return None
+
+def load_cached_log(fn, max_bytes=LOG_CACHE_MAX_BYTES):
+  """Returns the decompressed log memory-mapped from the local cache, and the
+     table of its messages (see FRAME_TABLE_DTYPE). The log is read, decompressed
+     and indexed the first time, later calls don't need to decompress or scan it.
+     The entry of a local file is rebuilt if its size or mtime changed since. Urls are
+     assumed immutable, their entries are used without checking the source again."""
+  cache_path = cache_path_for_file_path(fn)
+  data_path, index_path = cache_path + LOG_CACHE_DATA_SUFFIX, cache_path + LOG_CACHE_INDEX_SUFFIX
+
+  is_url = urllib.parse.urlparse(fn).scheme != ""
+  source_version = None if is_url else _log_source_version(fn)
+  table = _load_log_cache_index(index_path, source_version)
+  if table is not None:
+    # touch the entry, eviction goes by mtime
+    os.utime(index_path)
+  else:
+    if source_version is None:
+      source_version = _log_source_version(fn)
+    dat = read_log_bytes(fn)
+    table = _frame_table(dat)
+    with atomic_write_in_dir(data_path, mode="wb", overwrite=True) as f:
+      f.write(dat)
+    # the index holds the source version followed by the table
+    with atomic_write_in_dir(index_path, mode="wb", overwrite=True) as f:
+      np.save(f, source_version)
+      np.save(f, table)
+    _evict_log_cache(os.path.dirname(cache_path), max_bytes, keep=cache_path)
+
+  if os.path.getsize(data_path) == 0:
+    return b"", table
+  with open(data_path, "rb") as f:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), table
+
 # this is an iterator itself, and uses private variables from LogReader
 class MultiLogIterator:
-  def __init__(self, log_paths, sort_by_time=False):
+  def __init__(self, log_paths, sort_by_time=False, services=None, prefetch=0, max_prefetch_bytes=PREFETCH_MAX_BYTES):
+    """If prefetch is set, the next prefetch logs are read and decompressed ahead of
+       the cursor in a process pool. Logs behind the cursor are released and prefetching
+       pauses to keep the loaded log data under max_prefetch_bytes."""
     self._log_paths = log_paths
     self.sort_by_time = sort_by_time
+    self.services = services
+    self.prefetch = prefetch
+    self.max_prefetch_bytes = max_prefetch_bytes
 
     self._first_log_idx = next(i for i in range(len(log_paths)) if log_paths[i] is not None)
     self._current_log = self._first_log_idx
     self._idx = 0
     self._log_readers = [None]*len(log_paths)
-    self.start_time = self._log_reader(self._first_log_idx)._ts[0]
+    self._log_sizes = [0]*len(log_paths)
+    self._pool = ProcessPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+    self._prefetched = {}
+    # with a services filter the first logs may not contain any events
+    self.start_time = next((self._log_reader(i)._ts[0] for i in range(self._first_log_idx, len(log_paths))
+                            if log_paths[i] is not None and len(self._log_reader(i)._ts)), None)
 
   def _log_reader(self, i):
     if self._log_readers[i] is None and self._log_paths[i] is not None:
       log_path = self._log_paths[i]
-      self._log_readers[i] = LogReader(log_path, sort_by_time=self.sort_by_time)
+      future = self._prefetched.pop(i, None)
+      dat = future.result() if future is not None else None
+      self._log_readers[i] = LogReader(log_path, sort_by_time=self.sort_by_time, services=self.services, dat=dat)
+      self._log_sizes[i] = self._log_readers[i]._size
+      if self._pool is not None:
+        self._prefetch(i)
 
     return self._log_readers[i]
 
+  def _loaded_bytes(self):
+    loaded = sum(self._log_sizes)
+    loaded_count = sum(size > 0 for size in self._log_sizes)
+    # sizes of logs that are still being read are estimated from the ones already loaded
+    pending = sum(len(f.result()) if f.done() else loaded / max(loaded_count, 1) for f in self._prefetched.values())
+    return loaded + pending
+
+  def _prefetch(self, i):
+    upcoming = [j for j in range(i + 1, len(self._log_paths))
+                if self._log_paths[j] is not None and self._log_readers[j] is None][:self.prefetch]
+
+    # release logs behind the cursor first, they are read again if we seek back
+    for j in range(self._current_log):
+      if self._loaded_bytes() <= self.max_prefetch_bytes:
+        break
+      self._log_readers[j] = None
+      self._log_sizes[j] = 0
+
+    for j in upcoming:
+      if j in self._prefetched:
+        continue
+      if self._loaded_bytes() > self.max_prefetch_bytes:
+        break
+      self._prefetched[j] = self._pool.submit(read_log_bytes, self._log_paths[j], self.services)
+
+  def close(self):
+    """Stops prefetching and shuts down the process pool, called once iteration is done."""
+    if self._pool is not None:
+      for future in self._prefetched.values():
+        future.cancel()
+      self._prefetched = {}
+      self._pool.shutdown()
+      self._pool = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __del__(self):
+    # iterators dropped before the end, don't block the collector on running reads
+    pool = getattr(self, "_pool", None)
+    if pool is not None:
+      pool.shutdown(wait=False, cancel_futures=True)
+
   def __iter__(self):
     return self
 
@@ -35,61 +390,107 @@ class MultiLogIterator:
     if self._idx < len(lr._ents)-1:
       self._idx += 1
     else:
-      self._idx = 0
-      self._current_log = next(i for i in range(self._current_log + 1, len(self._log_readers) + 1)
-                               if i == len(self._log_readers) or self._log_paths[i] is not None)
-      if self._current_log == len(self._log_readers):
-        raise StopIteration
+      self._inc_log()
+
+  def _inc_log(self):
+    self._idx = 0
+    self._current_log = next(i for i in range(self._current_log + 1, len(self._log_readers) + 1)
+                             if i == len(self._log_readers) or self._log_paths[i] is not None)
 
   def __next__(self):
     while 1:
+      if self._current_log == len(self._log_readers):
+        self.close()
+        raise StopIteration
       lr = self._log_reader(self._current_log)
+      if self._idx >= len(lr._ents):
+        # no events of the requested services in this log
+        self._inc()
+        continue
       ret = lr._ents[self._idx]
       self._inc()
       return ret
 
   def tell(self):
     # returns seconds from start of log
+    if self.start_time is None:
+      # no events of the requested services in any log
+      return 0.
     return (self._log_reader(self._current_log)._ts[self._idx] - self.start_time) * 1e-9
 
   def seek(self, ts):
     # seek to nearest minute
     minute = int(ts/60)
-    if minute >= len(self._log_paths) or self._log_paths[minute] is None:
+    if minute >= len(self._log_paths) or self._log_paths[minute] is None or self.start_time is None:
       return False
 
+    # then bisect for the first event at or after ts, continuing into the next logs if needed
+    target = self.start_time + ts * 1e9
     self._current_log = minute
-
-    # HACK: O(n) seek afterward
     self._idx = 0
-    while self.tell() < ts:
-      self._inc()
+    while self._current_log < len(self._log_readers):
+      lr = self._log_reader(self._current_log)
+      self._idx = int(np.searchsorted(lr._ts_index, target))
+      if self._idx < len(lr._ts_index):
+        break
+      self._inc_log()
     return True
 
 
 class LogReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, stream=False, services=None, dat=None, cache=False):
+    """dat can hold the output of read_log_bytes for fn, e.g. when it was read in another process.
+       If cache is set, the decompressed log is kept on disk and memory-mapped on later opens, see load_cached_log."""
     data_version = None
-    _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-    with FileReader(fn) as f:
-      dat = f.read()
+    self.data_version = data_version
+    self._only_union_types = only_union_types
+    self._fn = fn
+    self._stream = stream
+    self._services = services
+    if stream:
+      # events are decoded lazily while iterating, see stream_events
+      if sort_by_time:
+        raise ValueError("sort_by_time is not supported when streaming")
+      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+      if ext not in ("", ".bz2"):
+        raise Exception(f"unknown extension {ext}")
+      return
 
-    if ext == "":
-      # old rlogs weren't bz2 compressed
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    elif ext == ".bz2":
-      dat = bz2.decompress(dat)
-      ents = capnp_log.Event.read_multiple_bytes(dat)
+    ts = None
+    if dat is None and cache:
+      # the cached table gives the timestamps without touching the events
+      dat, table = load_cached_log(fn)
+      if services is not None:
+        table = table[np.isin(table['service'], list(_service_discriminants(services)))]
+      ts = table['logMonoTime']
+      # the events are read in place from the memory-mapped log
+      self._size = int(table['size'].sum())
+      ents = _read_frames(dat, table)
     else:
-      raise Exception(f"unknown extension {ext}")
+      if dat is None:
+        dat = read_log_bytes(fn, services)
+      self._size = len(dat)
+      ents = capnp_log.Event.read_multiple_bytes(dat)
+    # the events point into dat, which may be memory-mapped
+    self._dat = dat
 
-    self._ents = list(sorted(ents, key=lambda x: x.logMonoTime) if sort_by_time else ents)
-    self._ts = [x.logMonoTime for x in self._ents]
-    self.data_version = data_version
-    self._only_union_types = only_union_types
+    if ts is None:
+      self._ents = list(sorted(ents, key=lambda x: x.logMonoTime) if sort_by_time else ents)
+      self._ts = np.fromiter((x.logMonoTime for x in self._ents), dtype=np.int64, count=len(self._ents))
+    elif sort_by_time:
+      order = np.argsort(ts, kind='stable')
+      ents = list(ents)
+      self._ents = [ents[i] for i in order.tolist()]
+      self._ts = ts[order]
+    else:
+      self._ents = list(ents)
+      self._ts = ts
+    # running max of logMonoTime, sorted even if the events aren't, used by MultiLogIterator.seek
+    self._ts_index = np.maximum.accumulate(self._ts)
 
   def __iter__(self):
-    for ent in self._ents:
+    ents = stream_events(self._fn, services=self._services) if self._stream else self._ents
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -3,18 +3,29 @@ import os
 import bz2
 import urllib.parse
 import subprocess
-import tqdm
 import glob
 from tempfile import TemporaryDirectory
 import capnp
 
-from tools.lib.logreader import FileReader, LogReader
+from tools.lib.logreader import FileReader, LogReader, _iter_frames
 from cereal import log as capnp_log
 
 
+def complete_events_end(dat):
+  """Returns the offset just past the last message that capnp can read, parsing the
+     messages one at a time so a truncated log is recovered in linear time."""
+  end = 0
+  for offset, _, size in _iter_frames(dat):
+    try:
+      next(capnp_log.Event.read_multiple_bytes(dat[offset:offset + size]))
+    except capnp.lib.capnp.KjException:
+      break
+    end = offset + size
+  return end
+
+
 class RobustLogReader(LogReader):
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False):  # pylint: disable=super-init-not-called
-    data_version = None
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False):
     _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
     with FileReader(fn) as f:
       dat = f.read()
@@ -33,28 +44,23 @@ class RobustLogReader(LogReader):
           subprocess.check_call(["bzip2recover", "out.bz2"], cwd=directory)
 
           # Decompress and concatenate parts
-          dat = b""
+          parts = []
           for n in sorted(glob.glob(f"{directory}/rec*.bz2")):
             print(f"Decompressing {n}")
             with open(n, 'rb') as f:
-              dat += bz2.decompress(f.read())
+              parts.append(bz2.decompress(f.read()))
+          dat = b"".join(parts)
     else:
       raise Exception(f"unknown extension {ext}")
 
-    progress = None
-    while True:
-      try:
-        ents = capnp_log.Event.read_multiple_bytes(dat)
-        self._ents = list(sorted(ents, key=lambda x: x.logMonoTime) if sort_by_time else ents)
-        break
-      except capnp.lib.capnp.KjException:
-        if progress is None:
-          progress = tqdm.tqdm(total=len(dat))
-
-        # Cut off bytes at the end until capnp is able to read
-        dat = dat[:-1]
-        progress.update(1)
-
-    self._ts = [x.logMonoTime for x in self._ents]
-    self.data_version = data_version
-    self._only_union_types = only_union_types
+    self.discarded_bytes = 0
+    try:
+      super().__init__(fn, canonicalize=canonicalize, only_union_types=only_union_types, sort_by_time=sort_by_time,
+                       dat=dat)
+    except capnp.lib.capnp.KjException:
+      # Cut off everything after the last message capnp is able to read
+      end = complete_events_end(dat)
+      self.discarded_bytes = len(dat) - end
+      print(f"Log is truncated, discarded the last {self.discarded_bytes} bytes")
+      super().__init__(fn, canonicalize=canonicalize, only_union_types=only_union_types, sort_by_time=sort_by_time,
+                       dat=dat[:end])
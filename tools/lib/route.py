@@ -1,12 +1,19 @@
+import hashlib
+import json
 import os
 import re
+import time
 from urllib.parse import urlparse
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
 
+from common.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
 from tools.lib.auth_config import get_token
+from tools.lib.cache import DEFAULT_CACHE_DIR
 from tools.lib.api import CommaApi
 from tools.lib.helpers import RE
+from tools.lib.logreader import LogReader
 
 QLOG_FILENAMES = ['qlog.bz2']
 QCAMERA_FILENAMES = ['qcamera.ts']
@@ -15,14 +22,39 @@ CAMERA_FILENAMES = ['fcamera.hevc', 'video.hevc']
 DCAMERA_FILENAMES = ['dcamera.hevc']
 ECAMERA_FILENAMES = ['ecamera.hevc']
 
+# the attribute of Segment each file name is stored in
+FILE_KINDS = {
+  **{fn: 'log_path' for fn in LOG_FILENAMES},
+  **{fn: 'qlog_path' for fn in QLOG_FILENAMES},
+  **{fn: 'camera_path' for fn in CAMERA_FILENAMES},
+  **{fn: 'dcamera_path' for fn in DCAMERA_FILENAMES},
+  **{fn: 'ecamera_path' for fn in ECAMERA_FILENAMES},
+  **{fn: 'qcamera_path' for fn in QCAMERA_FILENAMES},
+}
+SEGMENT_FILE_KINDS = ['log_path', 'qlog_path', 'camera_path', 'dcamera_path', 'ecamera_path', 'qcamera_path']
+
+EXPLORER_FILE_RE = re.compile(RE.EXPLORER_FILE)
+OP_SEGMENT_DIR_RE = re.compile(RE.OP_SEGMENT_DIR)
+
+# route manifests, so routes aren't listed again while unchanged
+ROUTE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "routes")
+# seconds a remote route listing is reused for, 0 to always ask the api.
+# file urls are signed and expire, so keep this short
+ROUTE_CACHE_TTL = float(os.getenv("ROUTE_CACHE_TTL", "0"))
+
 class Route:
-  def __init__(self, name, data_dir=None):
+  def __init__(self, name, data_dir=None, cache=True, cache_ttl=None):
+    """With cache set the segment listing is saved to a manifest in ROUTE_CACHE_DIR
+       (~/.commacache/routes), also for routes in a local data_dir. Local manifests are
+       reused while the route directories are unchanged, remote ones for cache_ttl
+       seconds. The cache is best effort, set cache=False to not write to it."""
     self._name = RouteName(name)
     self.files = None
     if data_dir is not None:
-      self._segments = self._get_segments_local(data_dir)
+      self._segments = self._get_segments_local_cached(data_dir) if cache else self._get_segments_local(data_dir)[0]
     else:
-      self._segments = self._get_segments_remote()
+      cache_ttl = ROUTE_CACHE_TTL if cache_ttl is None else cache_ttl
+      self._segments = self._get_segments_remote_cached(cache_ttl if cache else 0)
     self.max_seg_number = self._segments[-1].name.segment_num
 
   @property
@@ -57,6 +89,37 @@ class Route:
     qcamera_path_by_seg_num = {s.name.segment_num: s.qcamera_path for s in self._segments}
     return [qcamera_path_by_seg_num.get(i, None) for i in range(self.max_seg_number+1)]
 
+  def parallel_map(self, fn, services=None, qlog=False, processes=None):
+    """Calls fn with a LogReader for each segment's rlog (or qlog) in a process pool.
+
+       fn must be picklable, e.g. a module level function, and so must its return
+       value. Returns the results in segment order, segments without a log are skipped."""
+    log_paths = [p for p in (self.qlog_paths() if qlog else self.log_paths()) if p is not None]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+      return list(pool.map(_map_log, [fn] * len(log_paths), log_paths, [services] * len(log_paths)))
+
+  def _get_segments_local_cached(self, data_dir):
+    source = os.path.abspath(data_dir)
+    manifest = _load_manifest(self.name.canonical_name, source)
+    if manifest is not None and _manifest_fresh(manifest['dir_mtimes']):
+      return [Segment(*seg) for seg in manifest['segments']]
+
+    segments, dir_mtimes = self._get_segments_local(data_dir)
+    _save_manifest(self.name.canonical_name, source, segments, dir_mtimes=dir_mtimes)
+    return segments
+
+  def _get_segments_remote_cached(self, ttl):
+    if ttl > 0:
+      manifest = _load_manifest(self.name.canonical_name, "remote")
+      if manifest is not None and time.time() - manifest['time'] < ttl:
+        self.files = manifest['files']
+        return [Segment(*seg) for seg in manifest['segments']]
+
+    segments = self._get_segments_remote()
+    if ttl > 0:
+      _save_manifest(self.name.canonical_name, "remote", segments, time=time.time(), files=self.files)
+    return segments
+
   # TODO: refactor this, it's super repetitive
   def _get_segments_remote(self):
     api = CommaApi(get_token())
@@ -91,71 +154,86 @@ class Route:
     return sorted(segments.values(), key=lambda seg: seg.name.segment_num)
 
   def _get_segments_local(self, data_dir):
-    files = os.listdir(data_dir)
+    dongle_id = self.name.dongle_id
     segment_files = defaultdict(list)
-
-    for f in files:
-      fullpath = os.path.join(data_dir, f)
-      explorer_match = re.match(RE.EXPLORER_FILE, f)
-      op_match = re.match(RE.OP_SEGMENT_DIR, f)
-
-      if explorer_match:
-        segment_name = explorer_match.group('segment_name')
-        fn = explorer_match.group('file_name')
-        if segment_name.replace('_', '|').startswith(self.name.canonical_name):
-          segment_files[segment_name].append((fullpath, fn))
-      elif op_match and os.path.isdir(fullpath):
-        segment_name = op_match.group('segment_name')
-        if segment_name.startswith(self.name.canonical_name):
-          for seg_f in os.listdir(fullpath):
-            segment_files[segment_name].append((os.path.join(fullpath, seg_f), seg_f))
-      elif f == self.name.canonical_name:
-        for seg_num in os.listdir(fullpath):
-          if not seg_num.isdigit():
-            continue
-
-          segment_name = f'{self.name.canonical_name}--{seg_num}'
-          for seg_f in os.listdir(os.path.join(fullpath, seg_num)):
-            segment_files[segment_name].append((os.path.join(fullpath, seg_num, seg_f), seg_f))
+    # mtimes of every scanned directory, the manifest is stale once any of them changes
+    dir_mtimes = {data_dir: os.stat(data_dir).st_mtime_ns}
+
+    with os.scandir(data_dir) as entries:
+      for entry in entries:
+        f = entry.name
+        if not f.startswith(dongle_id):
+          continue
+
+        explorer_match = EXPLORER_FILE_RE.match(f)
+        op_match = OP_SEGMENT_DIR_RE.match(f)
+
+        if explorer_match:
+          segment_name = explorer_match.group('segment_name')
+          fn = explorer_match.group('file_name')
+          if segment_name.replace('_', '|').startswith(self.name.canonical_name):
+            segment_files[segment_name].append((entry.path, fn))
+        elif op_match and entry.is_dir():
+          segment_name = op_match.group('segment_name')
+          if segment_name.startswith(self.name.canonical_name):
+            segment_files[segment_name] += _scan_dir(entry.path, dir_mtimes)
+        elif f == self.name.canonical_name:
+          dir_mtimes[entry.path] = entry.stat().st_mtime_ns
+          with os.scandir(entry.path) as seg_entries:
+            for seg_entry in seg_entries:
+              if not seg_entry.name.isdigit():
+                continue
+
+              segment_name = f'{self.name.canonical_name}--{seg_entry.name}'
+              segment_files[segment_name] += _scan_dir(seg_entry.path, dir_mtimes)
 
     segments = []
     for segment, files in segment_files.items():
-
-      try:
-        log_path = next(path for path, filename in files if filename in LOG_FILENAMES)
-      except StopIteration:
-        log_path = None
-
-      try:
-        qlog_path = next(path for path, filename in files if filename in QLOG_FILENAMES)
-      except StopIteration:
-        qlog_path = None
-
-      try:
-        camera_path = next(path for path, filename in files if filename in CAMERA_FILENAMES)
-      except StopIteration:
-        camera_path = None
-
-      try:
-        dcamera_path = next(path for path, filename in files if filename in DCAMERA_FILENAMES)
-      except StopIteration:
-        dcamera_path = None
-
-      try:
-        ecamera_path = next(path for path, filename in files if filename in ECAMERA_FILENAMES)
-      except StopIteration:
-        ecamera_path = None
-
-      try:
-        qcamera_path = next(path for path, filename in files if filename in QCAMERA_FILENAMES)
-      except StopIteration:
-        qcamera_path = None
-
-      segments.append(Segment(segment, log_path, qlog_path, camera_path, dcamera_path, ecamera_path, qcamera_path))
+      paths = {}
+      for path, filename in files:
+        kind = FILE_KINDS.get(filename)
+        if kind is not None and kind not in paths:
+          paths[kind] = path
+      segments.append(Segment(segment, *(paths.get(kind) for kind in SEGMENT_FILE_KINDS)))
 
     if len(segments) == 0:
       raise ValueError(f'Could not find segments for route {self.name.canonical_name} in data directory {data_dir}')
-    return sorted(segments, key=lambda seg: seg.name.segment_num)
+    return sorted(segments, key=lambda seg: seg.name.segment_num), dir_mtimes
+
+def _scan_dir(path, dir_mtimes):
+  dir_mtimes[path] = os.stat(path).st_mtime_ns
+  with os.scandir(path) as entries:
+    return [(entry.path, entry.name) for entry in entries]
+
+def _manifest_path(route_name, source):
+  key = hashlib.sha256(f"{route_name}|{source}".encode()).hexdigest()
+  return os.path.join(ROUTE_CACHE_DIR, f"{key}.json")
+
+def _load_manifest(route_name, source):
+  try:
+    with open(_manifest_path(route_name, source)) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def _save_manifest(route_name, source, segments, **kwargs):
+  manifest = dict(kwargs, segments=[[str(seg.name)] + [getattr(seg, kind) for kind in SEGMENT_FILE_KINDS]
+                                    for seg in segments])
+  try:
+    mkdirs_exists_ok(ROUTE_CACHE_DIR)
+    with atomic_write_in_dir(_manifest_path(route_name, source), mode="w", overwrite=True) as f:
+      json.dump(manifest, f)
+  except OSError:
+    pass  # the cache is best effort
+
+def _manifest_fresh(dir_mtimes):
+  try:
+    return all(os.stat(path).st_mtime_ns == mtime for path, mtime in dir_mtimes.items())
+  except OSError:
+    return False
+
+def _map_log(fn, log_path, services):
+  return fn(LogReader(log_path, services=services))
 
 class Segment:
   def __init__(self, name, log_path, qlog_path, camera_path, dcamera_path, ecamera_path, qcamera_path):
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+import os
+import re
+import sqlite3
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from tools.lib.cache import DEFAULT_CACHE_DIR
+from tools.lib.helpers import RE
+from tools.lib.logreader import LogReader
+from tools.lib.route import LOG_FILENAMES, QLOG_FILENAMES, SegmentName
+
+DEFAULT_DB = os.path.join(DEFAULT_CACHE_DIR, "route_index.db")
+
+SUMMARY_SERVICES = ["carParams", "carState", "controlsState", "carEvents", "gpsLocationExternal"]
+# gaps between messages longer than this, e.g. dropped logs, aren't counted as engaged time or distance
+MAX_DT = 1.0
+# GpsLocationFlags bit for a valid fix
+GPS_FLAG_VALID = 1
+
+OP_SEGMENT_DIR_RE = re.compile(RE.OP_SEGMENT_DIR)
+ROUTE_DIR_RE = re.compile(r'^{}$'.format(RE.ROUTE_NAME))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+  name TEXT PRIMARY KEY,
+  route TEXT,
+  segment_num INTEGER,
+  log_path TEXT,
+  log_size INTEGER,
+  log_mtime INTEGER,
+  car_fingerprint TEXT,
+  duration REAL,
+  engaged_time REAL,
+  distance REAL,
+  min_lat REAL,
+  max_lat REAL,
+  min_lon REAL,
+  max_lon REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+  name TEXT,
+  segment TEXT,
+  count INTEGER,
+  PRIMARY KEY (name, segment)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS segments_car ON segments (car_fingerprint);
+CREATE INDEX IF NOT EXISTS segments_route ON segments (route, segment_num);
+CREATE INDEX IF NOT EXISTS events_segment ON events (segment);
+"""
+
+
+def _segment_log(path, qlog):
+  # the first rlog (or qlog) in a segment directory
+  names = {}
+  with os.scandir(path) as entries:
+    for entry in entries:
+      names.setdefault(entry.name, entry)
+  for fn in (QLOG_FILENAMES if qlog else LOG_FILENAMES + QLOG_FILENAMES):
+    if fn in names:
+      return names[fn]
+  return None
+
+
+def find_segments(archive, qlog=False):
+  """Yields (segment name, log DirEntry) for every segment under archive, in both the
+     <route>--<num>/ and <route>/<num>/ layouts, at any depth. The rlog is used where
+     there is one, unless qlog is set."""
+  stack = [(archive, None)]
+  while stack:
+    path, route = stack.pop()
+    with os.scandir(path) as entries:
+      for entry in entries:
+        if not entry.is_dir():
+          continue
+
+        if route is not None and entry.name.isdigit():
+          segment_name = f"{route}--{entry.name}"
+        elif OP_SEGMENT_DIR_RE.match(entry.name):
+          segment_name = entry.name
+        else:
+          stack.append((entry.path, entry.name if ROUTE_DIR_RE.match(entry.name) else None))
+          continue
+
+        log = _segment_log(entry.path, qlog)
+        if log is not None:
+          # explorer style names separate dongle id and time with _
+          yield SegmentName(segment_name[:16] + "|" + segment_name[17:]).canonical_name, log
+
+
+def _integrate(t, values, dt_max=MAX_DT):
+  # sum of values[i] * (t[i+1] - t[i]), skipping gaps
+  if len(t) < 2:
+    return 0.
+  dt = np.diff(t)
+  dt[dt > dt_max] = 0.
+  return float(np.dot(values[:-1], dt))
+
+
+def summarize_log(log_path):
+  """Reads the summary of a segment's log: car fingerprint, carEvents counts,
+     engaged time and distance in seconds and meters, and the bbox of valid gps fixes."""
+  car_fingerprint = None
+  events = Counter()
+  t_min, t_max = None, None
+  car_t, v_ego = [], []
+  controls_t, enabled = [], []
+  lat, lon = [], []
+
+  for msg in LogReader(log_path, services=SUMMARY_SERVICES):
+    t = msg.logMonoTime * 1e-9
+    t_min = t if t_min is None else min(t_min, t)
+    t_max = t if t_max is None else max(t_max, t)
+
+    which = msg.which()
+    if which == "carState":
+      car_t.append(t)
+      v_ego.append(msg.carState.vEgo)
+    elif which == "controlsState":
+      controls_t.append(t)
+      enabled.append(msg.controlsState.enabled)
+    elif which == "carEvents":
+      events.update(set(str(ev.name) for ev in msg.carEvents))
+    elif which == "gpsLocationExternal":
+      gps = msg.gpsLocationExternal
+      if gps.flags & GPS_FLAG_VALID:
+        lat.append(gps.latitude)
+        lon.append(gps.longitude)
+    elif which == "carParams" and car_fingerprint is None:
+      car_fingerprint = msg.carParams.carFingerprint
+
+  return {
+    'car_fingerprint': car_fingerprint,
+    'duration': 0. if t_min is None else t_max - t_min,
+    'engaged_time': _integrate(np.array(controls_t), np.array(enabled, dtype=np.float64)),
+    'distance': _integrate(np.array(car_t), np.array(v_ego, dtype=np.float64)),
+    'min_lat': min(lat, default=None),
+    'max_lat': max(lat, default=None),
+    'min_lon': min(lon, default=None),
+    'max_lon': max(lon, default=None),
+    'events': dict(events),
+  }
+
+
+def _summarize(segment_name, log_path):
+  try:
+    return segment_name, summarize_log(log_path), None
+  except Exception as e:  # a corrupt log shouldn't stop the ingest
+    return segment_name, None, f"{type(e).__name__}: {e}"
+
+
+class RouteIndex:
+  """Per-segment summaries of a log archive in sqlite, see update and query."""
+  def __init__(self, db_path=DEFAULT_DB):
+    self.db_path = db_path
+    if os.path.dirname(db_path):
+      os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    self.db = sqlite3.connect(db_path, timeout=60)
+    self.db.row_factory = sqlite3.Row
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript(SCHEMA)
+
+  def close(self):
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def update(self, archive, processes=None, qlog=False, prune=False, verbose=False):
+    """Indexes the segments of archive that are new or whose log changed since they were
+       indexed, reading logs in parallel. With prune, segments under archive that no longer
+       exist are dropped. Returns the number of segments indexed."""
+    archive = os.path.abspath(archive)
+    indexed = {row['name']: (row['log_path'], row['log_size'], row['log_mtime'])
+               for row in self.db.execute("SELECT name, log_path, log_size, log_mtime FROM segments")}
+
+    todo = {}
+    seen = set()
+    for segment_name, log in find_segments(archive, qlog):
+      seen.add(segment_name)
+      st = log.stat()
+      key = (log.path, st.st_size, st.st_mtime_ns)
+      if indexed.get(segment_name) != key:
+        todo[segment_name] = key
+
+    if prune:
+      archive_prefix = os.path.join(archive, "")
+      gone = [(name,) for name, (path, _, _) in indexed.items()
+              if name not in seen and path.startswith(archive_prefix)]
+      with self.db:
+        self.db.executemany("DELETE FROM events WHERE segment = ?", gone)
+        self.db.executemany("DELETE FROM segments WHERE name = ?", gone)
+
+    if not todo:
+      return 0
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+      futures = [pool.submit(_summarize, name, key[0]) for name, key in todo.items()]
+      for future in as_completed(futures):
+        segment_name, summary, error = future.result()
+        if summary is None:
+          print(f"failed to index {segment_name}: {error}")
+          continue
+        self._insert(segment_name, todo[segment_name], summary)
+        count += 1
+        if verbose:
+          print(f"indexed {segment_name} ({count}/{len(todo)})")
+    return count
+
+  def _insert(self, segment_name, log_key, summary):
+    name = SegmentName(segment_name)
+    with self.db:
+      self.db.execute("DELETE FROM events WHERE segment = ?", (segment_name,))
+      self.db.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (segment_name, name.route_name.canonical_name, name.segment_num, *log_key,
+                       summary['car_fingerprint'], summary['duration'], summary['engaged_time'], summary['distance'],
+                       summary['min_lat'], summary['max_lat'], summary['min_lon'], summary['max_lon']))
+      self.db.executemany("INSERT INTO events VALUES (?, ?, ?)",
+                          [(event, segment_name, n) for event, n in summary['events'].items()])
+
+  def query(self, car=None, event=None, route=None, min_engaged_time=None, bbox=None):
+    """Returns the summaries of matching segments, ordered by route and segment number.
+
+       car is matched with LIKE, so % wildcards work, e.g. car="TOYOTA RAV4%". event is a
+       carEvents name like "steerSaturated", and bbox (min_lat, min_lon, max_lat, max_lon)
+       matches segments whose gps track overlaps it."""
+    sql = "SELECT segments.* FROM segments"
+    where, args = [], []
+    if event is not None:
+      sql += " JOIN events ON events.segment = segments.name"
+      where.append("events.name = ?")
+      args.append(event)
+    if car is not None:
+      where.append("car_fingerprint LIKE ?")
+      args.append(car)
+    if route is not None:
+      where.append("route = ?")
+      args.append(str(route))
+    if min_engaged_time is not None:
+      where.append("engaged_time >= ?")
+      args.append(min_engaged_time)
+    if bbox is not None:
+      where.append("max_lat >= ? AND min_lon <= ? AND min_lat <= ? AND max_lon >= ?")
+      args += [bbox[0], bbox[3], bbox[2], bbox[1]]
+
+    if where:
+      sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY route, segment_num"
+    return [dict(row) for row in self.db.execute(sql, args)]
+
+  def event_counts(self, segment_name):
+    return {row['name']: row['count'] for row in
+            self.db.execute("SELECT name, count FROM events WHERE segment = ?", (segment_name,))}
+
+  def __len__(self):
+    return self.db.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Index a log archive and query segments by their summaries")
+  parser.add_argument("--db", default=DEFAULT_DB)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  index_parser = subparsers.add_parser("index", help="index new and changed segments of an archive")
+  index_parser.add_argument("archive")
+  index_parser.add_argument("-j", "--processes", type=int, default=None)
+  index_parser.add_argument("--qlog", action="store_true", help="index qlogs instead of rlogs")
+  index_parser.add_argument("--prune", action="store_true", help="drop segments that were removed from the archive")
+
+  query_parser = subparsers.add_parser("query", help="list matching segments")
+  query_parser.add_argument("--car", help="car fingerprint, % matches anything")
+  query_parser.add_argument("--event", help="carEvents name, e.g. steerSaturated")
+  query_parser.add_argument("--route")
+  query_parser.add_argument("--min-engaged-time", type=float)
+  args = parser.parse_args()
+
+  with RouteIndex(args.db) as index:
+    if args.command == "index":
+      n = index.update(args.archive, args.processes, args.qlog, args.prune, verbose=True)
+      print(f"indexed {n} segments, {len(index)} total")
+    else:
+      for seg in index.query(args.car, args.event, args.route, args.min_engaged_time):
+        print(seg['name'], seg['car_fingerprint'], f"{seg['engaged_time']:.0f}s engaged", f"{seg['distance']:.0f}m", seg['log_path'])
@@ -2,9 +2,10 @@
 import os
 import shutil
 import unittest
+from unittest import mock
 
 os.environ["COMMA_CACHE"] = "/tmp/__test_cache__"
-from tools.lib.url_file import URLFile, CACHE_DIR
+from tools.lib.url_file import URLFile, CACHE_DIR, CHUNK_SIZE
 
 
 class TestFileDownload(unittest.TestCase):
@@ -64,6 +65,86 @@ class TestFileDownload(unittest.TestCase):
     self.compare_loads(large_file_url, length - 100, 100)
     self.compare_loads(large_file_url)
 
+  def test_readahead(self):
+    large_file_url = "https://commadataci.blob.core.windows.net/openpilotci/0375fdf7b1ce594d/2019-06-13--08-32-25/3/qlog.bz2"
+    expected = URLFile(large_file_url, cache=False).read()
+
+    for cache in (False, True):
+      shutil.rmtree(CACHE_DIR)
+      f = URLFile(large_file_url, cache=cache, readahead=4)
+      # sequential reads smaller than a chunk, served from chunks fetched ahead
+      dats = []
+      while True:
+        dat = f.read(ll=300 * 1000)
+        if len(dat) == 0:
+          break
+        dats.append(dat)
+      self.assertEqual(b"".join(dats), expected)
+
+      buf = bytearray(1000)
+      f.seek(len(expected) - 500)
+      self.assertEqual(f.readinto(buf), 500)
+      self.assertEqual(buf[:500], expected[-500:])
+
+
+class TestURLFileOffline(unittest.TestCase):
+  URL = "https://example.com/offline_test_file"
+
+  def setUp(self):
+    self.content = os.urandom(3 * CHUNK_SIZE + 1234)
+    self.download_sizes = []
+
+    def download(url_file, start, end, out=None):
+      data = self.content[start:end]
+      if out is None:
+        return data
+      self.download_sizes.append(len(out))
+      out[:len(data)] = data
+      return len(data)
+
+    self.patches = [
+      mock.patch.object(URLFile, "_download", autospec=True, side_effect=download),
+      mock.patch.object(URLFile, "get_length_online", autospec=True, return_value=len(self.content)),
+    ]
+    self.download = self.patches[0].start()
+    self.patches[1].start()
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+  def tearDown(self):
+    for p in self.patches:
+      p.stop()
+
+  def test_force_download_readinto(self):
+    f = URLFile(self.URL, cache=False)
+    f.seek(100)
+    buf = bytearray(2 * CHUNK_SIZE + 10)
+    self.assertEqual(f.readinto(buf), len(buf))
+    self.assertEqual(buf, self.content[100:100 + len(buf)])
+    # every download only gets the part of the buffer of its own range
+    self.assertEqual(self.download_sizes, [CHUNK_SIZE, CHUNK_SIZE, 10])
+
+    # reads past the end are cut at the file length
+    f.seek(len(self.content) - 500)
+    self.assertEqual(f.readinto(buf), 500)
+    self.assertEqual(buf[:500], self.content[-500:])
+
+  def test_readahead(self):
+    for cache in (False, True):
+      f = URLFile(self.URL, cache=cache, readahead=2)
+      dats = []
+      while True:
+        dat = f.read(ll=300 * 1000)
+        if len(dat) == 0:
+          break
+        dats.append(dat)
+      self.assertEqual(b"".join(dats), self.content)
+
+      # served from the cache the second time
+      if cache:
+        downloads = self.download.call_count
+        self.assertEqual(URLFile(self.URL, cache=True).read(), self.content)
+        self.assertEqual(self.download.call_count, downloads)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from tools.lib.download_cache import STORES, CacheStats, DirectoryChunkStore
+
+
+class TestChunkStores(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def test_get_put(self):
+    for name, store_cls in STORES.items():
+      with self.subTest(store=name):
+        store = store_cls(os.path.join(self.tmpdir.name, name))
+        self.assertIsNone(store.get("a"))
+        store.put("a", b"123")
+        store.put("b", b"4567")
+        self.assertEqual(store.get("a"), b"123")
+        self.assertEqual(store.get("b"), b"4567")
+        self.assertEqual(store.size(), 7)
+
+  def test_lru_eviction(self):
+    for name, store_cls in STORES.items():
+      with self.subTest(store=name):
+        store = store_cls(os.path.join(self.tmpdir.name, name), max_bytes=3500)
+        for i in range(3):
+          store.put(str(i), bytes(1000))
+          time.sleep(0.01)
+        # touch the oldest entry so the second one is evicted first
+        self.assertIsNotNone(store.get("0"))
+        time.sleep(0.01)
+        store.put("3", bytes(1000))
+
+        self.assertIsNotNone(store.get("0"))
+        self.assertIsNone(store.get("1"))
+        self.assertIsNotNone(store.get("3"))
+        self.assertLessEqual(store.size(), 3500)
+
+  def test_size_not_scanned_on_every_put(self):
+    for name, store_cls in STORES.items():
+      with self.subTest(store=name):
+        store = store_cls(os.path.join(self.tmpdir.name, name), max_bytes=100000)
+        store.put("a", bytes(10))
+        with mock.patch.object(store, "size", side_effect=AssertionError), \
+             mock.patch.object(store, "_scan_size", side_effect=AssertionError, create=True):
+          for i in range(10):
+            store.put(str(i), bytes(1000))
+
+  def test_get_evicted_while_reading(self):
+    store = DirectoryChunkStore(self.tmpdir.name, max_bytes=100000)
+    store.put("a", b"123")
+    with mock.patch("os.utime", side_effect=FileNotFoundError):
+      self.assertEqual(store.get("a"), b"123")
+
+  def test_stats(self):
+    stats = CacheStats()
+    stats.record_miss(1000)
+    stats.record_hit(1000)
+    stats.record_hit(500)
+    self.assertEqual(stats.as_dict(), {
+      'hits': 2,
+      'misses': 1,
+      'hit_rate': 2 / 3,
+      'bytes_saved': 1500,
+      'bytes_downloaded': 1000,
+      'evictions': 0,
+    })
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import numpy as np
+
+from tools.lib.framereader import index_stream, index_videos
+from tools.lib.hevc_index import hevc_index, hevc_probe
+from tools.lib.cache import cache_path_for_file_path
+
+VIDINDEX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "vidindex")
+
+
+class BitWriter:
+  def __init__(self):
+    self.bits = []
+
+  def u(self, n, v):
+    self.bits += [(v >> (n - 1 - i)) & 1 for i in range(n)]
+
+  def ue(self, v):
+    n = (v + 1).bit_length()
+    self.u(n - 1, 0)
+    self.u(n, v + 1)
+
+  def rbsp(self):
+    bits = self.bits + [1]
+    bits += [0] * (-len(bits) % 8)
+    return bytes(int("".join(map(str, bits[i:i+8])), 2) for i in range(0, len(bits), 8))
+
+
+def nal(nal_type, payload):
+  out = bytearray()
+  for b in payload:
+    # emulation prevention
+    if len(out) >= 2 and out[-1] == 0 and out[-2] == 0 and b <= 3:
+      out.append(3)
+    out.append(b)
+  return b"\x00\x00\x00\x01" + bytes([nal_type << 1, 1]) + bytes(out)
+
+
+def make_sps(width, height, crop_right=0, crop_bottom=0, max_sub_layers_minus1=0):
+  bs = BitWriter()
+  bs.u(4, 0)
+  bs.u(3, max_sub_layers_minus1)
+  bs.u(1, 1)
+  bs.u(96, 0x01_60000000_900000000000_5d)
+  for _ in range(max_sub_layers_minus1):
+    bs.u(2, 0b01)  # only level present
+  if max_sub_layers_minus1:
+    bs.u(2 * (8 - max_sub_layers_minus1), 0)
+  bs.u(8 * max_sub_layers_minus1, 0)
+  bs.ue(0)
+  bs.ue(1)  # 4:2:0
+  bs.ue(width)
+  bs.ue(height)
+  bs.u(1, int(bool(crop_right or crop_bottom)))
+  if crop_right or crop_bottom:
+    for v in (0, crop_right // 2, 0, crop_bottom // 2):
+      bs.ue(v)
+  bs.u(20, 0)
+  return nal(33, bs.rbsp())
+
+
+def make_slice(nal_type, slice_type, first=True, payload_len=200):
+  bs = BitWriter()
+  bs.u(1, int(first))
+  if 16 <= nal_type <= 23:
+    bs.u(1, 0)
+  bs.u(1, 1)  # pps id
+  bs.ue(slice_type)
+  bs.u(8 * payload_len, random.getrandbits(8 * payload_len))
+  return nal(nal_type, bs.rbsp())
+
+
+def make_stream(frames=60, gop=20):
+  random.seed(0)
+  dat = nal(32, b"\x0c\x01\xff\xff") + make_sps(1928, 1216, crop_bottom=8) + nal(34, b"\xc1\x72\xb4\x62\x40")
+  slice_types = []
+  for i in range(frames):
+    if i % gop == 0:
+      dat += nal(39, b"\x05\x10" + bytes(16))  # SEI
+      dat += make_slice(19, 2)
+      slice_types.append(2)
+    else:
+      slice_type = 0 if i % 3 == 0 else 1
+      dat += make_slice(1, slice_type)
+      slice_types.append(slice_type)
+    dat += make_slice(1, 1, first=False, payload_len=50)
+  return dat, slice_types
+
+
+class TestHevcIndex(unittest.TestCase):
+  def setUp(self):
+    self.dat, self.slice_types = make_stream()
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_index(self):
+    index, prefix = hevc_index(self.dat)
+    self.assertEqual(index.dtype, np.uint32)
+    self.assertEqual(list(index[:-1, 0]), self.slice_types)
+    self.assertEqual(tuple(index[-1]), (0xFFFFFFFF, len(self.dat)))
+    for offset in index[:-1, 1]:
+      self.assertEqual(self.dat[offset:offset+3], b"\x00\x00\x01")
+    self.assertTrue(prefix.startswith(b"\x00\x00\x01\x40"))
+
+  def test_probe(self):
+    _, prefix = hevc_index(self.dat)
+    stream = hevc_probe(prefix)['streams'][0]
+    self.assertEqual((stream['width'], stream['height']), (1928, 1208))
+
+    sps = make_sps(1164, 874, max_sub_layers_minus1=2)
+    stream = hevc_probe(sps[1:])['streams'][0]
+    self.assertEqual((stream['width'], stream['height']), (1164, 874))
+
+  @unittest.skipIf(shutil.which("make") is None, "needs make and a C compiler")
+  def test_matches_vidindex(self):
+    fn = os.path.join(self.tmpdir, "fcamera.hevc")
+    with open(fn, "wb") as f:
+      f.write(self.dat)
+    subprocess.check_call(["make"], cwd=VIDINDEX_DIR, stdout=subprocess.DEVNULL)
+    subprocess.check_call([os.path.join(VIDINDEX_DIR, "vidindex"), "hevc", fn, fn + ".prefix", fn + ".index"])
+    with open(fn + ".index", "rb") as f:
+      expected_index = np.frombuffer(f.read(), np.uint32).reshape(-1, 2)
+    with open(fn + ".prefix", "rb") as f:
+      expected_prefix = f.read()
+
+    index, prefix = hevc_index(self.dat)
+    np.testing.assert_array_equal(index, expected_index)
+    self.assertEqual(prefix, expected_prefix)
+
+  def test_index_videos(self):
+    paths = []
+    for i in range(3):
+      paths.append(os.path.join(self.tmpdir, f"{i}", "fcamera.hevc"))
+      os.makedirs(os.path.dirname(paths[-1]))
+      with open(paths[-1], "wb") as f:
+        f.write(self.dat)
+    index_videos(paths, cache_prefix=self.tmpdir, processes=2)
+
+    for fn in paths:
+      self.assertTrue(os.path.exists(cache_path_for_file_path(fn, self.tmpdir)))
+      index_data = index_stream(fn, "hevc", cache_prefix=self.tmpdir)
+      self.assertEqual(len(index_data['index']), len(self.slice_types) + 1)
+      self.assertEqual(index_data['probe']['streams'][0]['width'], 1928)
+
+
+if __name__ == "__main__":
+  unittest.main()
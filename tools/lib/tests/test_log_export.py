@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from tools.lib.log_export import pa, export_logs, load_columns, load_table
+from tools.lib.tests.test_logreader import make_events
+
+
+@unittest.skipIf(pa is None, "pyarrow not installed")
+class TestLogExport(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.out_dir = os.path.join(self.tmpdir.name, "export")
+    self.log_paths = []
+    for seg in range(3):
+      fn = os.path.join(self.tmpdir.name, f"rlog_{seg}")
+      with open(fn, "wb") as f:
+        f.write(b"".join(ev.to_bytes() for ev in make_events(300, t0=int(seg * 60e9))))
+      self.log_paths.append(fn)
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def test_export(self):
+    self.assertEqual(export_logs(self.log_paths[:2], self.out_dir, processes=2), ["00000", "00001"])
+    self.assertEqual(sorted(os.listdir(self.out_dir)), ["_done", "can", "carState", "controlsState"])
+
+    # only the new segment is exported
+    self.assertEqual(export_logs(self.log_paths, self.out_dir), ["00002"])
+
+    cols = load_columns(self.out_dir, "carState", ["logMonoTime", "vEgo"])
+    np.testing.assert_array_equal(cols["vEgo"], np.tile(np.arange(0, 300, 3), 3))
+    self.assertTrue(np.all(np.diff(cols["logMonoTime"].astype(np.int64)) > 0))
+
+    table = load_table(self.out_dir, "controlsState")
+    self.assertEqual(table.num_rows, 300)
+    self.assertIn("curvature", table.column_names)
+    self.assertEqual(table.column("state")[0].as_py(), "disabled")
+
+  def test_export_services(self):
+    export_logs(self.log_paths, self.out_dir, services=["carState"])
+    self.assertEqual(sorted(os.listdir(self.out_dir)), ["_done", "carState"])
+    self.assertEqual(load_table(self.out_dir, "carState", ["vEgo"]).num_rows, 300)
+
+    # other services are exported later, and a full export doesn't skip logs exported with some services only
+    self.assertEqual(export_logs(self.log_paths, self.out_dir, services=["carState"]), [])
+    self.assertEqual(export_logs(self.log_paths[:1], self.out_dir, services=["controlsState"]), ["00000"])
+    self.assertEqual(export_logs(self.log_paths[:1], self.out_dir, services=["carState", "controlsState"]), [])
+    self.assertEqual(export_logs(self.log_paths, self.out_dir), ["00000", "00001", "00002"])
+    self.assertEqual(sorted(os.listdir(self.out_dir)), ["_done", "can", "carState", "controlsState"])
+    self.assertEqual(load_table(self.out_dir, "controlsState").num_rows, 300)
+    self.assertEqual(export_logs(self.log_paths, self.out_dir, services=["can"]), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from cereal import log as capnp_log
+from tools.lib import logreader
+from tools.lib.logreader import LogReader, MultiLogIterator
+from tools.lib.robust_logreader import RobustLogReader
+
+
+def make_events(n, t0=0):
+  events = []
+  for i in range(n):
+    service = ["carState", "controlsState", "can"][i % 3]
+    ev = capnp_log.Event.new_message(logMonoTime=t0 + i * int(1e7))
+    if service == "carState":
+      ev.init(service).vEgo = float(i)
+    elif service == "controlsState":
+      ev.init(service).curvature = i * 1e-3
+    else:
+      ev.init(service, 4)
+    events.append(ev)
+  return events
+
+
+class TestLogReader(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.events = make_events(3000)
+    self.frames = [ev.to_bytes() for ev in self.events]
+    dat = b"".join(self.frames)
+
+    self.raw_fn = os.path.join(self.tmpdir.name, "rlog")
+    with open(self.raw_fn, "wb") as f:
+      f.write(dat)
+
+    # two concatenated bz2 streams, like bzip2recover or cat'd logs produce
+    self.bz2_fn = os.path.join(self.tmpdir.name, "rlog.bz2")
+    with open(self.bz2_fn, "wb") as f:
+      f.write(bz2.compress(dat[:len(dat) // 2]) + bz2.compress(dat[len(dat) // 2:]))
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def _check_events(self, lr):
+    msgs = list(lr)
+    self.assertEqual(len(msgs), len(self.events))
+    for msg, ev in zip(msgs, self.events):
+      self.assertEqual(msg.which(), ev.which())
+      self.assertEqual(msg.logMonoTime, ev.logMonoTime)
+
+  def test_read(self):
+    for fn in (self.raw_fn, self.bz2_fn):
+      self._check_events(LogReader(fn))
+
+  def test_stream(self):
+    for fn in (self.raw_fn, self.bz2_fn):
+      self._check_events(LogReader(fn, stream=True))
+
+  def test_stream_small_chunks(self):
+    from tools.lib.logreader import stream_events
+    self._check_events(stream_events(self.bz2_fn, chunk_size=1000))
+
+  def test_stream_truncated(self):
+    with open(self.raw_fn, "rb") as f:
+      dat = f.read()
+    with open(self.raw_fn, "wb") as f:
+      f.write(dat[:-10])
+
+    with self.assertRaises(Exception):
+      list(LogReader(self.raw_fn, stream=True))
+
+  def test_services(self):
+    services = ["carState", "controlsState"]
+    expected = [ev for ev in self.events if ev.which() in services]
+    for fn in (self.raw_fn, self.bz2_fn):
+      for stream in (False, True):
+        msgs = list(LogReader(fn, stream=stream, services=services))
+        self.assertEqual([m.which() for m in msgs], [ev.which() for ev in expected])
+        self.assertEqual([m.logMonoTime for m in msgs], [ev.logMonoTime for ev in expected])
+
+    with self.assertRaises(ValueError):
+      LogReader(self.raw_fn, services=["notAService"])
+
+  def test_services_unknown_union_type(self):
+    # a multi segment event of a union type newer than the local schema
+    ev = capnp_log.Event.new_message(logMonoTime=1)
+    ev.init("can", 2000)
+    dat = bytearray(ev.to_bytes())
+    header_size, _ = logreader._capnp_frame_size(dat)
+    root_ptr = struct.unpack_from("<i", dat, header_size)[0]
+    data_start = header_size + 8 + (root_ptr >> 2) * 8
+    struct.pack_into("<H", dat, data_start + logreader._EVENT_DISCRIMINANT_OFFSET, 0xfff0)
+    with open(self.raw_fn, "wb") as f:
+      f.write(bytes(dat) + b"".join(self.frames))
+
+    table = logreader._frame_table(bytes(dat))
+    self.assertEqual(table['service'][0], logreader.UNKNOWN_SERVICE)
+    msgs = list(LogReader(self.raw_fn, services=["carState"]))
+    self.assertEqual(len(msgs), len(self.events) // 3)
+
+  def test_multilogiterator_services(self):
+    lr = MultiLogIterator([self.raw_fn, None, self.bz2_fn], services=["carState"])
+    msgs = list(lr)
+    self.assertEqual(len(msgs), 2 * len(self.events) // 3)
+    self.assertTrue(all(m.which() == "carState" for m in msgs))
+
+    # logs without any of the requested events are skipped
+    lr = MultiLogIterator([self.raw_fn, self.bz2_fn], services=["gpsNMEA"])
+    self.assertIsNone(lr.start_time)
+    self.assertEqual(lr.tell(), 0.)
+    self.assertFalse(lr.seek(0.))
+    self.assertEqual(list(lr), [])
+
+  def test_multilogiterator_prefetch(self):
+    log_paths = [self.raw_fn, None, self.bz2_fn, self.raw_fn, self.bz2_fn]
+    expected = [(m.which(), m.logMonoTime) for m in MultiLogIterator(log_paths)]
+
+    # a small budget releases logs behind the cursor, seeking back reads them again
+    lr = MultiLogIterator(log_paths, prefetch=2, max_prefetch_bytes=1)
+    self.assertEqual([(m.which(), m.logMonoTime) for m in lr], expected)
+    self.assertIsNone(lr._pool)
+    self.assertIsNone(lr._log_readers[0])
+
+    lr = MultiLogIterator(log_paths, prefetch=4)
+    self.assertEqual([(m.which(), m.logMonoTime) for m in lr], expected)
+
+    # the pool is shut down when leaving the context, even if not iterated to the end
+    with MultiLogIterator(log_paths, prefetch=2) as lr:
+      msgs = [next(lr) for _ in range(2)]
+      self.assertEqual([(m.which(), m.logMonoTime) for m in msgs], expected[:2])
+      pool = lr._pool
+    self.assertIsNone(lr._pool)
+    with self.assertRaises(RuntimeError):
+      pool.submit(len, b"")
+
+  def test_multilogiterator_seek(self):
+    # three one minute logs, with a gap where the second one is
+    log_paths = []
+    for seg in range(4):
+      fn = os.path.join(self.tmpdir.name, f"rlog_{seg}")
+      with open(fn, "wb") as f:
+        f.write(b"".join(ev.to_bytes() for ev in make_events(6000, t0=int(seg * 60e9))))
+      log_paths.append(fn if seg != 1 else None)
+
+    lr = MultiLogIterator(log_paths)
+    all_ts = [m.logMonoTime for m in MultiLogIterator(log_paths)]
+    for ts in (0., 0.005, 12.34, 59.995, 125., 239.99):
+      self.assertTrue(lr.seek(ts))
+      expected = next(t for t in all_ts if t >= ts * 1e9)
+      self.assertAlmostEqual(lr.tell(), expected * 1e-9, places=6)
+      self.assertEqual(next(lr).logMonoTime, expected)
+
+    # seeking into the gap or past the end
+    self.assertFalse(lr.seek(61.))
+    self.assertFalse(lr.seek(300.))
+    self.assertTrue(lr.seek(239.999))
+    self.assertEqual(list(lr), [])
+
+  def test_cache(self):
+    cache_dir = os.path.join(self.tmpdir.name, "cache")
+    with mock.patch("tools.lib.cache.DEFAULT_CACHE_DIR", cache_dir):
+      self._check_events(LogReader(self.bz2_fn, cache=True))
+      self.assertEqual(len(os.listdir(os.path.join(cache_dir, "local"))), 2)
+
+      # later opens are served from the cache without decompressing the log, or copying the events of a service
+      with mock.patch.object(logreader, "read_log_bytes", side_effect=AssertionError), \
+           mock.patch.object(logreader, "_join_frames", side_effect=AssertionError):
+        lr = LogReader(self.bz2_fn, cache=True)
+        self._check_events(lr)
+        self.assertEqual(list(lr._ts), [ev.logMonoTime for ev in self.events])
+
+        msgs = list(LogReader(self.bz2_fn, cache=True, services=["carState"]))
+        self.assertEqual(len(msgs), len(self.events) // 3)
+        self.assertTrue(all(m.which() == "carState" for m in msgs))
+
+      # least recently used logs are evicted once the cache is full
+      _, table = logreader.load_cached_log(self.raw_fn, max_bytes=1)
+      self.assertEqual(len(table), len(self.events))
+      self.assertEqual(len(os.listdir(os.path.join(cache_dir, "local"))), 2)
+
+      # a log rewritten in place is read again
+      with open(self.raw_fn, "wb") as f:
+        f.write(b"".join(self.frames[:10]))
+      dat, table = logreader.load_cached_log(self.raw_fn)
+      self.assertEqual(len(dat), sum(len(frame) for frame in self.frames[:10]))
+      self.assertEqual(list(table['logMonoTime']), [ev.logMonoTime for ev in self.events[:10]])
+
+      # urls are only checked when cached
+      url = "https://example.com/rlog"
+      with mock.patch.object(logreader, "_log_source_version", return_value=np.array([1, -1])), \
+           mock.patch.object(logreader, "read_log_bytes", return_value=b"".join(self.frames)):
+        logreader.load_cached_log(url)
+      with mock.patch.object(logreader, "_log_source_version", side_effect=AssertionError), \
+           mock.patch.object(logreader, "read_log_bytes", side_effect=AssertionError):
+        _, table = logreader.load_cached_log(url)
+      self.assertEqual(len(table), len(self.events))
+
+  def test_robust_truncated(self):
+    with open(self.raw_fn, "rb") as f:
+      dat = f.read()
+    last_size = len(self.frames[-1])
+    with open(self.raw_fn, "wb") as f:
+      f.write(dat[:-10])
+
+    lr = RobustLogReader(self.raw_fn)
+    self.assertEqual(lr.discarded_bytes, last_size - 10)
+    self.assertEqual([m.logMonoTime for m in lr], [ev.logMonoTime for ev in self.events[:-1]])
+
+    lr = RobustLogReader(self.bz2_fn)
+    self.assertEqual(lr.discarded_bytes, 0)
+    self._check_events(lr)
+
+
+if __name__ == "__main__":
+  unittest.main()
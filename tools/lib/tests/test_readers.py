@@ -1,11 +1,18 @@
 #!/usr/bin/env python
+import io
+import struct
+import subprocess
 import unittest
 import requests
 import tempfile
+import time
 
 from collections import defaultdict
+from unittest import mock
 import numpy as np
-from tools.lib.framereader import FrameReader
+from tools.lib.exceptions import DataUnreadableError
+from tools.lib.framereader import FrameCache, FrameReader, FrameType, RawFrameReader, StreamFrameReader, \
+                                  VideoStreamDecompressor, HEVC_SLICE_I, HEVC_SLICE_P, rgb24toyuv420
 from tools.lib.logreader import LogReader
 
 
@@ -63,5 +70,154 @@ class TestReaders(unittest.TestCase):
     fr_url = FrameReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/video.hevc?raw=true")
     _check_data(fr_url)
 
+  def test_raw_framereader(self):
+    bayer = np.random.default_rng(0).integers(0, 256, (5, 960, 1280), dtype=np.uint8)
+    with tempfile.NamedTemporaryFile(suffix=".raw") as fp:
+      for frame in bayer:
+        fp.write(struct.pack("I", frame.nbytes) + frame.tobytes())
+      fp.flush()
+
+      with FrameReader(fp.name) as fr:
+        self.assertIsInstance(fr, RawFrameReader)
+        self.assertEqual(fr.frame_count, 5)
+
+        rgb = fr.get(1, 3, pix_fmt="rgb24")
+        for i, frame in enumerate(rgb):
+          img = bayer[i + 1]
+          green = (img[0::2, 0::2].astype(np.uint16) + img[1::2, 1::2]) >> 1
+          np.testing.assert_array_equal(frame, np.dstack([img[0::2, 1::2], green, img[1::2, 0::2]]))
+
+        out = np.zeros((3, 480, 640, 3), dtype=np.uint8)
+        self.assertIs(fr.get(1, 3, pix_fmt="rgb24", out=out), out)
+        np.testing.assert_array_equal(out, np.stack(rgb))
+
+        np.testing.assert_array_equal(fr.get(2, pix_fmt="yuv420p")[0], rgb24toyuv420(rgb[1]))
+
+
+class TestGOPFrameReader(unittest.TestCase):
+  # the "video" is made of raw yuv420p frames and cat stands in for ffmpeg
+  W, H = 8, 4
+  FRAME_COUNT = 12
+  GOP_SIZE = 5
+
+  def setUp(self):
+    self.frames = np.random.default_rng(0).integers(0, 256, (self.FRAME_COUNT, self.W * self.H * 3 // 2), dtype=np.uint8)
+    self.fp = tempfile.NamedTemporaryFile(suffix=".hevc")
+    self.fp.write(self.frames.tobytes())
+    self.fp.flush()
+
+    slice_types = [HEVC_SLICE_I if i % self.GOP_SIZE == 0 else HEVC_SLICE_P for i in range(self.FRAME_COUNT)]
+    self.index_data = {
+      'index': np.array([[t, i * self.frames.shape[1]] for i, t in enumerate(slice_types + [HEVC_SLICE_I])]),
+      'global_prefix': b"",
+      'probe': {'streams': [{'width': self.W, 'height': self.H}]},
+    }
+
+    popen = subprocess.Popen
+    self.popen_patch = mock.patch("subprocess.Popen", side_effect=lambda cmd, **kwargs: popen(["cat"], **kwargs))
+    self.popen_patch.start()
+
+  def tearDown(self):
+    self.popen_patch.stop()
+    self.fp.close()
+
+  def _frame_reader(self, **kwargs):
+    return StreamFrameReader(self.fp.name, FrameType.h265_stream, self.index_data, **kwargs)
+
+  def test_get_range(self):
+    with self._frame_reader() as fr:
+      np.testing.assert_array_equal(fr.get_range(3, 6), self.frames[3:9])
+
+      # frames 3 and 4 are cached with their gop, the rest is decoded
+      np.testing.assert_array_equal(fr.get(3)[0], self.frames[3])
+      out = np.zeros((6, self.frames.shape[1]), dtype=np.uint8)
+      self.assertIs(fr.get_range(3, 6, out=out), out)
+      np.testing.assert_array_equal(out, self.frames[3:9])
+
+      with self.assertRaises(ValueError):
+        fr.get_range(10, 3)
+
+  def test_get_larger_than_cache(self):
+    with self._frame_reader(cache_bytes=self.frames[0].nbytes) as fr:
+      for i in range(self.GOP_SIZE):
+        np.testing.assert_array_equal(fr.get(i)[0], self.frames[i])
+      self.assertEqual(len(fr.frame_cache), 1)
+
+  def _wait_for(self, condition):
+    for _ in range(1000):
+      if condition():
+        return
+      time.sleep(0.01)
+    self.fail("timed out")
+
+  def test_readahead(self):
+    with self._frame_reader(readahead=True) as fr:
+      fr.get(0)
+      self._wait_for(lambda: fr.frame_cache.get((self.FRAME_COUNT - 1, "yuv420p")) is not None)
+
+      for i in range(self.FRAME_COUNT):
+        frame = fr.frame_cache.get((i, "yuv420p"))
+        np.testing.assert_array_equal(frame, self.frames[i])
+        # cached frames don't keep the other frames decoded with them alive
+        self.assertIsNone(frame.base)
+      self.assertEqual(fr.frame_cache.size, self.frames.nbytes)
+
+  def test_readahead_error(self):
+    with self._frame_reader(readahead=True) as fr:
+      decode_range = fr._decode_range
+      calls = []
+
+      def failing_once(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+          raise DataUnreadableError("ffmpeg failed")
+        return decode_range(*args, **kwargs)
+
+      with mock.patch.object(fr, "_decode_range", side_effect=failing_once), \
+           mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+        fr.get(0)
+        self._wait_for(lambda: len(calls) == 1 and "ffmpeg failed" in stderr.getvalue())
+
+        # the readahead thread is still running
+        fr.get(self.GOP_SIZE)
+        self._wait_for(lambda: fr.frame_cache.get((self.FRAME_COUNT - 1, "yuv420p")) is not None)
+      np.testing.assert_array_equal(fr.frame_cache.get((self.FRAME_COUNT - 1, "yuv420p")), self.frames[-1])
+
+  def test_read_into(self):
+    frame_size = self.frames.shape[1]
+    def decompressor():
+      return VideoStreamDecompressor(self.fp.name, "hevc", self.W, self.H, "yuv420p",
+                                     offset=5 * frame_size, length=5 * frame_size)
+
+    out = np.zeros((3, frame_size), dtype=np.uint8)
+    self.assertEqual(decompressor().read_into(out, skip=1), 3)
+    np.testing.assert_array_equal(out, self.frames[6:9])
+
+    # a list of frames, longer than the stream
+    out = [np.zeros(frame_size, dtype=np.uint8) for _ in range(6)]
+    self.assertEqual(decompressor().read_into(out, skip=2), 3)
+    np.testing.assert_array_equal(out[:3], self.frames[7:10])
+
+
+class TestFrameCache(unittest.TestCase):
+  def test_eviction(self):
+    cache = FrameCache(300)
+    for i in range(3):
+      cache[i] = np.zeros(100, dtype=np.uint8)
+    self.assertEqual(cache.size, 300)
+
+    # the least recently used frame is evicted first
+    self.assertIsNotNone(cache.get(0))
+    cache[3] = np.zeros(100, dtype=np.uint8)
+    self.assertIsNone(cache.get(1))
+    self.assertEqual([k for k in range(4) if cache.get(k) is not None], [0, 2, 3])
+    self.assertEqual(cache.size, 300)
+
+    # a frame larger than the budget is still kept on its own
+    cache[4] = np.zeros(1000, dtype=np.uint8)
+    self.assertEqual(len(cache), 1)
+    self.assertEqual(cache.size, 1000)
+
+
 if __name__ == "__main__":
   unittest.main()
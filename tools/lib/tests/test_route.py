@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import tempfile
+import unittest
+from collections import Counter
+from unittest import mock
+
+import tools.lib.route as route
+from tools.lib.route import Route
+from tools.lib.tests.test_logreader import make_events
+
+ROUTE_NAME = "a2a0ccea32023010|2021-06-04--12-36-25"
+
+
+def count_services(lr):
+  return Counter(m.which() for m in lr)
+
+
+class TestRoute(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.cachedir = tempfile.TemporaryDirectory()
+    self.patcher = mock.patch.object(route, "ROUTE_CACHE_DIR", self.cachedir.name)
+    self.patcher.start()
+    dat = bz2.compress(b"".join(ev.to_bytes() for ev in make_events(300)))
+    for seg in (0, 1, 3):
+      seg_dir = os.path.join(self.tmpdir.name, f"{ROUTE_NAME}--{seg}")
+      os.mkdir(seg_dir)
+      with open(os.path.join(seg_dir, "rlog.bz2"), "wb") as f:
+        f.write(dat)
+
+  def tearDown(self):
+    self.patcher.stop()
+    self.tmpdir.cleanup()
+    self.cachedir.cleanup()
+
+  def test_parallel_map(self):
+    r = Route(ROUTE_NAME, data_dir=self.tmpdir.name)
+    self.assertEqual(r.max_seg_number, 3)
+
+    counts = r.parallel_map(count_services, services=["carState"], processes=2)
+    self.assertEqual(counts, [Counter(carState=100)] * 3)
+
+    counts = r.parallel_map(count_services)
+    self.assertEqual(counts, [Counter(carState=100, controlsState=100, can=100)] * 3)
+
+  def test_manifest_cache(self):
+    with mock.patch.object(Route, "_get_segments_local", autospec=True, side_effect=Route._get_segments_local) as scan:
+      r = Route(ROUTE_NAME, data_dir=self.tmpdir.name)
+      self.assertEqual(scan.call_count, 1)
+
+      r = Route(ROUTE_NAME, data_dir=self.tmpdir.name)
+      self.assertEqual(scan.call_count, 1)
+      self.assertEqual([s.name.segment_num for s in r.segments], [0, 1, 3])
+      self.assertTrue(r.log_paths()[1].endswith("rlog.bz2"))
+      self.assertIsNone(r.log_paths()[2])
+
+      # new files in a segment invalidate the manifest
+      seg_dir = os.path.join(self.tmpdir.name, f"{ROUTE_NAME}--1")
+      open(os.path.join(seg_dir, "qlog.bz2"), "wb").close()
+      os.utime(seg_dir, ns=(0, 0))
+      r = Route(ROUTE_NAME, data_dir=self.tmpdir.name)
+      self.assertEqual(scan.call_count, 2)
+      self.assertEqual(r.qlog_paths()[:2], [None, os.path.join(seg_dir, "qlog.bz2")])
+
+      # and so do new segments
+      os.mkdir(os.path.join(self.tmpdir.name, f"{ROUTE_NAME}--4"))
+      os.utime(self.tmpdir.name, ns=(0, 0))
+      r = Route(ROUTE_NAME, data_dir=self.tmpdir.name)
+      self.assertEqual(scan.call_count, 3)
+      self.assertEqual(r.max_seg_number, 4)
+
+      Route(ROUTE_NAME, data_dir=self.tmpdir.name, cache=False)
+      self.assertEqual(scan.call_count, 4)
+
+  def test_unwritable_cache(self):
+    # a file where the cache directory should be
+    cache_dir = os.path.join(self.cachedir.name, "file", "routes")
+    open(os.path.join(self.cachedir.name, "file"), "w").close()
+    with mock.patch.object(route, "ROUTE_CACHE_DIR", cache_dir):
+      r = Route(ROUTE_NAME, data_dir=self.tmpdir.name)
+    self.assertEqual(r.max_seg_number, 3)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import tempfile
+import unittest
+
+from cereal import car, log as capnp_log
+from tools.lib.route_index import RouteIndex, find_segments
+
+ROUTES = {
+  "a2a0ccea32023010|2021-06-04--12-36-25": "TOYOTA RAV4 2017",
+  "b0c9d2329ad1606b|2021-07-01--09-00-00": "HONDA CIVIC 2016",
+}
+
+
+def make_segment_log(car_fingerprint, engaged, saturated, lat):
+  events = []
+  ev = capnp_log.Event.new_message(logMonoTime=0)
+  ev.init("carParams").carFingerprint = car_fingerprint
+  events.append(ev)
+  for i in range(100):
+    t = i * int(1e8)
+    ev = capnp_log.Event.new_message(logMonoTime=t)
+    ev.init("carState").vEgo = 10.
+    events.append(ev)
+
+    ev = capnp_log.Event.new_message(logMonoTime=t + 1)
+    ev.init("controlsState").enabled = engaged and i < 50
+    events.append(ev)
+
+    if i % 10 == 0:
+      ev = capnp_log.Event.new_message(logMonoTime=t + 2)
+      names = ["steerSaturated", "preDriverDistracted"] if saturated else ["preDriverDistracted"]
+      ev.init("carEvents", len(names))
+      for e, name in zip(ev.carEvents, names):
+        e.name = car.CarEvent.EventName.schema.enumerants[name]
+      events.append(ev)
+
+      ev = capnp_log.Event.new_message(logMonoTime=t + 3)
+      gps = ev.init("gpsLocationExternal")
+      gps.flags = 1
+      gps.latitude = lat + i * 1e-4
+      gps.longitude = -117.
+      events.append(ev)
+  return bz2.compress(b"".join(ev.to_bytes() for ev in events))
+
+
+class TestRouteIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.archive = os.path.join(self.tmpdir.name, "archive")
+    for i, (route, fingerprint) in enumerate(ROUTES.items()):
+      for seg in range(3):
+        # one route in the <route>--<num> layout, one in <route>/<num>
+        seg_dir = os.path.join(self.archive, f"{route}--{seg}" if i == 0 else os.path.join(route, str(seg)))
+        os.makedirs(seg_dir)
+        with open(os.path.join(seg_dir, "rlog.bz2"), "wb") as f:
+          f.write(make_segment_log(fingerprint, seg != 2, seg == 1, 32. + i))
+    self.index = RouteIndex(os.path.join(self.tmpdir.name, "index.db"))
+
+  def tearDown(self):
+    self.index.close()
+    self.tmpdir.cleanup()
+
+  def test_find_segments(self):
+    names = sorted(name for name, _ in find_segments(self.archive))
+    self.assertEqual(len(names), 6)
+    self.assertEqual(names[0], "a2a0ccea32023010|2021-06-04--12-36-25--0")
+
+  def test_index_and_query(self):
+    self.assertEqual(self.index.update(self.archive, processes=2), 6)
+    self.assertEqual(len(self.index), 6)
+
+    segs = self.index.query(car="TOYOTA RAV4%", event="steerSaturated")
+    self.assertEqual([s['name'] for s in segs], ["a2a0ccea32023010|2021-06-04--12-36-25--1"])
+    self.assertEqual(len(self.index.query(event="preDriverDistracted")), 6)
+    self.assertEqual(self.index.event_counts(segs[0]['name']), {"steerSaturated": 10, "preDriverDistracted": 10})
+
+    seg = segs[0]
+    self.assertAlmostEqual(seg['engaged_time'], 5.0, places=2)
+    self.assertAlmostEqual(seg['distance'], 99., places=2)
+    self.assertAlmostEqual(seg['min_lat'], 32.)
+    self.assertEqual(len(self.index.query(min_engaged_time=1.)), 4)
+    self.assertEqual(len(self.index.query(bbox=(32.5, -118., 33.5, -116.))), 3)
+    self.assertEqual(len(self.index.query(route="b0c9d2329ad1606b|2021-07-01--09-00-00")), 3)
+
+  def test_incremental(self):
+    self.index.update(self.archive)
+    self.assertEqual(self.index.update(self.archive), 0)
+
+    route = next(iter(ROUTES))
+    with open(os.path.join(self.archive, f"{route}--2", "rlog.bz2"), "wb") as f:
+      f.write(make_segment_log("TOYOTA RAV4 2017", True, True, 32.))
+    os.makedirs(os.path.join(self.archive, f"{route}--3"))
+    with open(os.path.join(self.archive, f"{route}--3", "qlog.bz2"), "wb") as f:
+      f.write(make_segment_log("TOYOTA RAV4 2017", False, False, 32.))
+
+    self.assertEqual(self.index.update(self.archive), 2)
+    self.assertEqual(len(self.index.query(event="steerSaturated", route=route)), 2)
+    self.assertEqual(len(self.index), 7)
+
+    os.remove(os.path.join(self.archive, f"{route}--3", "qlog.bz2"))
+    self.index.update(self.archive, prune=True)
+    self.assertEqual(len(self.index), 6)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -6,15 +6,21 @@ import tempfile
 import threading
 import urllib.parse
 import pycurl
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from io import BytesIO
 from tenacity import retry, wait_random_exponential, stop_after_attempt
-from common.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+from common.file_helpers import mkdirs_exists_ok
+from tools.lib.download_cache import get_store, stats as cache_stats
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
 
 CACHE_DIR = os.environ.get("COMMA_CACHE", "/tmp/comma_download_cache/")
+#  Number of chunks downloaded at the same time, shared by all URLFiles
+MAX_WORKERS = int(os.environ.get("URLFILE_MAX_WORKERS", "8"))
+#  Number of chunks fetched ahead of sequential reads
+READAHEAD = int(os.environ.get("URLFILE_READAHEAD", "0"))
 
 
 def hash_256(link):
@@ -24,8 +30,10 @@ def hash_256(link):
 
 class URLFile:
   _tlocal = threading.local()
+  _pool = None
+  _pool_lock = threading.Lock()
 
-  def __init__(self, url, debug=False, cache=None):
+  def __init__(self, url, debug=False, cache=None, readahead=None):
     self._url = url
     self._pos = 0
     self._length = None
@@ -35,22 +43,42 @@ class URLFile:
     self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
     if cache is not None:
       self._force_download = not cache
+    self._readahead = READAHEAD if readahead is None else readahead
+    #  Futures of chunks being fetched ahead of the current position, by chunk number
+    self._chunks = {}
+    self._last_read_end = None
+    self._store = get_store(CACHE_DIR)
 
-    try:
-      self._curl = self._tlocal.curl
-    except AttributeError:
-      self._curl = self._tlocal.curl = pycurl.Curl()
     mkdirs_exists_ok(CACHE_DIR)
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
+    for future in self._chunks.values():
+      future.cancel()
+    self._chunks = {}
     if self._local_file is not None:
       os.remove(self._local_file.name)
       self._local_file.close()
       self._local_file = None
 
+  @property
+  def _curl(self):
+    #  One handle per thread, libcurl keeps the connections of each handle alive between requests
+    try:
+      return self._tlocal.curl
+    except AttributeError:
+      self._tlocal.curl = pycurl.Curl()
+      return self._tlocal.curl
+
+  @classmethod
+  def _get_pool(cls):
+    with cls._pool_lock:
+      if cls._pool is None:
+        cls._pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="URLFile")
+      return cls._pool
+
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def get_length_online(self):
     c = self._curl
@@ -68,68 +96,140 @@ class URLFile:
   def get_length(self):
     if self._length is not None:
       return self._length
-    file_length_path = os.path.join(CACHE_DIR, hash_256(self._url) + "_length")
-    if os.path.exists(file_length_path) and not self._force_download:
-      with open(file_length_path) as file_length:
-          content = file_length.read()
-          self._length = int(content)
-          return self._length
+    length_key = hash_256(self._url) + "_length"
+    if not self._force_download:
+      content = self._store.get(length_key)
+      if content is not None:
+        self._length = int(content)
+        return self._length
 
     self._length = self.get_length_online()
     if not self._force_download:
-      with atomic_write_in_dir(file_length_path, mode="w") as file_length:
-        file_length.write(str(self._length))
+      self._store.put(length_key, str(self._length).encode())
     return self._length
 
-  def read(self, ll=None):
-    if self._force_download:
-      return self.read_aux(ll=ll)
+  def _chunk_key(self, chunk_number):
+    return hash_256(self._url) + "_" + str(float(chunk_number))
 
+  def _fetch_chunk(self, chunk_number):
+    """Returns the data of a whole chunk, from the cache if enabled, downloading it otherwise."""
+    start = chunk_number * CHUNK_SIZE
+    end = min(start + CHUNK_SIZE, self.get_length())
+    if self._force_download:
+      return self._download(start, end)
+
+    key = self._chunk_key(chunk_number)
+    data = self._store.get(key)
+    #  If we don't have it cached, download it
+    if data is None:
+      data = self._download(start, end)
+      self._store.put(key, data)
+      cache_stats.record_miss(len(data))
+    else:
+      cache_stats.record_hit(len(data))
+    return data
+
+  def _chunk_future(self, chunk_number):
+    future = self._chunks.pop(chunk_number, None)
+    if future is None:
+      future = self._get_pool().submit(self._fetch_chunk, chunk_number)
+    return future
+
+  def readinto(self, b):
+    """Reads into the writable buffer b, returns the number of bytes read."""
+    mv = memoryview(b).cast("B")
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(CACHE_DIR, str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+    file_end = min(file_begin + len(mv), self.get_length())
+    if file_end <= file_begin:
+      return 0
+
+    if self._force_download and self._readahead == 0:
+      #  Download the requested range in chunk sized pieces at the same time, straight into b.
+      #  Each piece only gets its own part of b, so a wrong sized response can't overwrite the others.
+      starts = range(file_begin, file_end, CHUNK_SIZE)
+      futures = [self._get_pool().submit(self._download, s, min(s + CHUNK_SIZE, file_end),
+                                         mv[s - file_begin:min(s + CHUNK_SIZE, file_end) - file_begin])
+                 for s in starts]
+    else:
+      #  We have to align with chunks we store. Fetch all needed chunks at the same time
+      chunk_numbers = range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1)
+      futures = [self._chunk_future(i) for i in chunk_numbers]
+
+      #  Sequential reads get the following chunks fetched in the background
+      if self._readahead > 0 and self._last_read_end == file_begin:
+        for i in range(chunk_numbers[-1] + 1, chunk_numbers[-1] + 1 + self._readahead):
+          if i * CHUNK_SIZE >= self.get_length():
+            break
+          if i not in self._chunks:
+            self._chunks[i] = self._get_pool().submit(self._fetch_chunk, i)
+      for i in list(self._chunks):
+        if i < chunk_numbers[0] or i > chunk_numbers[-1] + self._readahead:
+          self._chunks.pop(i).cancel()
+
+    for i, future in enumerate(futures):
+      data = future.result()
+      if self._force_download and self._readahead == 0:
+        continue
+      position = (file_begin // CHUNK_SIZE + i) * CHUNK_SIZE
+      data = memoryview(data)[max(0, file_begin - position): file_end - position]
+      dest = max(0, position - file_begin)
+      mv[dest:dest + len(data)] = data
+
+    self._pos = file_end
+    self._last_read_end = file_end
+    return file_end - file_begin
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+  def read(self, ll=None):
+    if self._force_download and ll is None and self._pos == 0 and self._readahead == 0:
+      return self.read_aux()
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    file_end = self.get_length() if ll is None else min(self._pos + ll, self.get_length())
+    buf = bytearray(max(0, file_end - self._pos))
+    n = self.readinto(buf)
+    return bytes(buf[:n]) if n < len(buf) else bytes(buf)
 
-  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def read_aux(self, ll=None):
-    download_range = False
-    headers = ["Connection: keep-alive"]
     if self._pos != 0 or ll is not None:
       if ll is None:
-        end = self.get_length() - 1
+        end = self.get_length()
       else:
-        end = min(self._pos + ll, self.get_length()) - 1
+        end = min(self._pos + ll, self.get_length())
       if self._pos >= end:
         return b""
-      headers.append(f"Range: bytes={self._pos}-{end}")
+    else:
+      end = None
+
+    ret = self._download(self._pos, end)
+    self._pos += len(ret)
+    return ret
+
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  def _download(self, start, end, out=None):
+    """Downloads bytes [start, end) of the file, or the whole file if end is None.
+       If out is given the data is written to it and the number of bytes is returned."""
+    download_range = False
+    headers = ["Connection: keep-alive"]
+    if end is not None:
+      headers.append(f"Range: bytes={start}-{end - 1}")
       download_range = True
 
-    dats = BytesIO()
     c = self._curl
+    c.reset()
+    if out is None:
+      dats = BytesIO()
+      c.setopt(pycurl.WRITEDATA, dats)
+    else:
+      written = 0
+
+      def write(data):
+        nonlocal written
+        if written + len(data) > len(out):
+          return 0  # makes curl abort the transfer
+        out[written:written + len(data)] = data
+        written += len(data)
+
+      c.setopt(pycurl.WRITEFUNCTION, write)
     c.setopt(pycurl.URL, self._url)
-    c.setopt(pycurl.WRITEDATA, dats)
     c.setopt(pycurl.NOSIGNAL, 1)
     c.setopt(pycurl.TIMEOUT_MS, 500000)
     c.setopt(pycurl.HTTPHEADER, headers)
@@ -156,19 +256,22 @@ class URLFile:
     if self._debug:
       t2 = time.time()
       if t2 - t1 > 0.1:
-        print(f"get {self._url} {headers!r} {t2 - t1:.f} slow")
+        print(f"get {self._url} {headers!r} {t2 - t1:.3f} slow")
 
     response_code = c.getinfo(pycurl.RESPONSE_CODE)
+    body = dats.getvalue() if out is None else bytes(out[:written])
     if response_code == 416:  # Requested Range Not Satisfiable
-      raise Exception(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+      raise Exception(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(body)[:500]}")
     if download_range and response_code != 206:  # Partial Content
-      raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+      raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(body)[:500]}")
     if (not download_range) and response_code != 200:  # OK
-      raise Exception(f"Error {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+      raise Exception(f"Error {response_code} {headers} ({self._url}): {repr(body)[:500]}")
 
-    ret = dats.getvalue()
-    self._pos += len(ret)
-    return ret
+    if out is not None:
+      if written != end - start:
+        raise Exception(f"Error, expected {end - start} bytes but got {written} {headers} ({self._url})")
+      return written
+    return dats.getvalue()
 
   def seek(self, pos):
     self._pos = pos
@@ -193,6 +296,7 @@ class URLFile:
 
       self._local_file = local_file
       self.read = self._local_file.read
+      self.readinto = self._local_file.readinto
       self.seek = self._local_file.seek
 
     return self._local_file.name